@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite of the bybop protocol stack.
+
+Usage: benchmark.py [-o results.json] [-c previous.json] [-q] [name ...]
+
+Each benchmark measures one layer of the stack (commands packing, ARNetworkAL
+frames parsing, ARNetwork over loopback, device State, connection to a local
+simulator). The results are written as json, so runs made on different
+commits can be compared with the -c option.
+"""
+
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'src'))
+
+import Bybop_Commands
+import Bybop_Connection
+import Bybop_Device
+import Bybop_Network
+import Bybop_NetworkAL
+import Bybop_Simulator
+from Bybop_NetworkAL import DataType
+
+
+_default_values = {
+    'u8': 1, 'i8': -1, 'u16': 1, 'i16': -1, 'u32': 1, 'i32': -1,
+    'u64': 1, 'i64': -1, 'float': 1.0, 'double': 1.0, 'string': 'bybop',
+    'enum': 0, 'multisetting': {},
+}
+
+
+def _free_udp_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _rate(count, elapsed):
+    return count / elapsed if elapsed else 0.0
+
+
+def _latency_stats(samples):
+    """ Summary, in microseconds, of a list of latencies in seconds """
+    samples = sorted(samples)
+    n = len(samples)
+    return {
+        'count': n,
+        'mean_us': statistics.mean(samples) * 1e6,
+        'p50_us': samples[n // 2] * 1e6,
+        'p99_us': samples[min(n - 1, int(n * 0.99))] * 1e6,
+        'max_us': samples[-1] * 1e6,
+    }
+
+
+def bench_commands(quick):
+    """ pack_command/unpack_command throughput, for each known command """
+    iterations = 200 if quick else 2000
+    per_command = {}
+    total_pack = 0.0
+    total_unpack = 0.0
+    skipped = []
+    for name, cmd in Bybop_Commands.iter_commands():
+        try:
+            args = [_default_values[Bybop_Commands.arg_type_name(arg)]
+                    for arg in cmd.args]
+        except Exception:
+            skipped.append(name)
+            continue
+        pr, cl, cm = name.split('.')
+        try:
+            packed, _, _ = Bybop_Commands.pack_command(pr, cl, cm, *args)
+        except Bybop_Commands.CommandError:
+            skipped.append(name)
+            continue
+        start = time.perf_counter()
+        for _ in range(iterations):
+            Bybop_Commands.pack_command(pr, cl, cm, *args)
+        pack = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(iterations):
+            Bybop_Commands.unpack_command(packed)
+        unpack = time.perf_counter() - start
+        total_pack += pack
+        total_unpack += unpack
+        per_command[name] = {
+            'pack_per_second': _rate(iterations, pack),
+            'unpack_per_second': _rate(iterations, unpack),
+        }
+    nb = len(per_command) * iterations
+    return {
+        'commands': len(per_command),
+        'skipped': skipped,
+        'pack_per_second': _rate(nb, total_pack),
+        'unpack_per_second': _rate(nb, total_unpack),
+        'per_command': per_command,
+    }
+
+
+def bench_frames(quick):
+    """ ARNetworkAL frames parsing rate """
+    iterations = 2000 if quick else 20000
+    frames_per_datagram = 8
+    payload = Bybop_Commands.pack_command(
+        'ardrone3', 'PilotingState', 'SpeedChanged', 1.0, 2.0, 3.0)[0]
+    frame = struct.pack('<BBBI', DataType.DATA, 127, 0,
+                        len(payload) + 7) + payload
+    datagram = frame * frames_per_datagram
+    count = 0
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for _ in Bybop_NetworkAL.split_frames(datagram):
+            count += 1
+    elapsed = time.perf_counter() - start
+    return {
+        'frames': count,
+        'frames_per_second': _rate(count, elapsed),
+        'datagrams_per_second': _rate(iterations, elapsed),
+    }
+
+
+class _NullListener(object):
+    def data_received(self, buf, data):
+        pass
+
+    def did_disconnect(self):
+        pass
+
+
+def bench_network(quick):
+    """ Acknowledged round trips and commands rate through Network.send_data """
+    iterations = 300 if quick else 3000
+    sim = Bybop_Simulator.SimulatedDevice(ping_period=None)
+    d2c_port = _free_udp_port()
+    connection = Bybop_Connection.Connection('127.0.0.1',
+                                             sim.get_discovery_port())
+    answer = connection.connect(d2c_port, 'benchmark', 'bybop-benchmark')
+    network = Bybop_Network.Network('127.0.0.1', answer['c2d_port'],
+                                    d2c_port, [10, 11], [127, 126],
+                                    _NullListener())
+    try:
+        ack_cmd = Bybop_Commands.pack_command(
+            'common', 'Common', 'CurrentDate', '2000-01-01')[0]
+        rtts = []
+        timeouts = 0
+        for _ in range(iterations):
+            start = time.perf_counter()
+            status = network.send_data(11, ack_cmd, DataType.DATA_WITH_ACK,
+                                       timeout=1.0, tries=1)
+            if status == Bybop_Network.NetworkStatus.OK:
+                rtts.append(time.perf_counter() - start)
+            else:
+                timeouts += 1
+
+        nack_cmd = Bybop_Commands.pack_command(
+            'ardrone3', 'Piloting', 'PCMD', 0, 0, 0, 0, 0, 0)[0]
+        count = iterations * 10
+        start = time.perf_counter()
+        for _ in range(count):
+            network.send_data(10, nack_cmd, DataType.DATA)
+        elapsed = time.perf_counter() - start
+        # Let the simulator read the remaining datagrams
+        time.sleep(0.2)
+        received = sim.get_stats()['commands_received'] - len(rtts)
+    finally:
+        network.stop()
+        sim.stop()
+    ret = {
+        'ack_timeouts': timeouts,
+        'send_per_second': _rate(count, elapsed),
+        'send_delivered_ratio': received / count,
+    }
+    if rtts:
+        ret['ack_rtt'] = _latency_stats(rtts)
+    return ret
+
+
+def bench_state(quick):
+    """ State put/get_value/duplicate throughput under contention """
+    iterations = 2000 if quick else 20000
+    results = {}
+    for nb_threads in (1, 4):
+        state = Bybop_Device.State()
+        for i in range(50):
+            state.put('ardrone3', 'PilotingState', 'Cmd%d' % i, {'v': i})
+
+        def writer():
+            for i in range(iterations):
+                state.put('ardrone3', 'PilotingState', 'Cmd%d' % (i % 50),
+                          {'v': i})
+
+        def reader():
+            for i in range(iterations):
+                state.get_value('ardrone3.PilotingState.Cmd%d' % (i % 50))
+
+        def duplicator():
+            for _ in range(iterations // 100):
+                state.duplicate()
+
+        threads = []
+        for _ in range(nb_threads):
+            threads += [threading.Thread(target=writer),
+                        threading.Thread(target=reader),
+                        threading.Thread(target=duplicator)]
+        start = time.perf_counter()
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        elapsed = time.perf_counter() - start
+        ops = nb_threads * (2 * iterations + iterations // 100)
+        results['threads_%d' % (3 * nb_threads)] = {
+            'ops_per_second': _rate(ops, elapsed),
+            'elapsed': elapsed,
+        }
+    return results
+
+
+def bench_connect(quick):
+    """ create_and_connect time, up to the end of the initial state sync """
+    iterations = 3 if quick else 10
+    states = [('common.CommonState.BatteryStateChanged', (100,))] + \
+        [('ardrone3.PilotingState.SpeedChanged', (0.0, 0.0, 0.0))] * 50
+    sim = Bybop_Simulator.SimulatedDevice(states=states)
+    times = []
+    try:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            device = Bybop_Device.create_and_connect(
+                sim.get_device(), _free_udp_port(), 'benchmark',
+                'bybop-benchmark')
+            times.append(time.perf_counter() - start)
+            if device is not None:
+                device.stop()
+    finally:
+        sim.stop()
+    return {'connect': _latency_stats(times)}
+
+
+_benchmarks = [
+    ('commands', bench_commands),
+    ('frames', bench_frames),
+    ('network', bench_network),
+    ('state', bench_state),
+    ('connect', bench_connect),
+]
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _flatten(dico, prefix=''):
+    ret = {}
+    for key, value in dico.items():
+        if key == 'per_command':
+            continue
+        if isinstance(value, dict):
+            ret.update(_flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and \
+                not isinstance(value, bool):
+            ret[prefix + key] = value
+    return ret
+
+
+def compare(old, new):
+    """ Print the ratios between two benchmark results """
+    old_values = _flatten(old['results'])
+    new_values = _flatten(new['results'])
+    print('%-50s %14s %14s %8s' % ('metric', old.get('revision'),
+                                   new.get('revision'), 'ratio'))
+    for key in sorted(new_values):
+        if key not in old_values:
+            continue
+        ratio = new_values[key] / old_values[key] if old_values[key] \
+            else float('nan')
+        print('%-50s %14.2f %14.2f %8.2f' % (key, old_values[key],
+                                             new_values[key], ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='bybop benchmarks')
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run (default all : %s)' %
+                        ', '.join(n for n, _ in _benchmarks))
+    parser.add_argument('-o', '--output', help='json output file')
+    parser.add_argument('-c', '--compare',
+                        help='json results of a previous run to compare with')
+    parser.add_argument('-q', '--quick', action='store_true',
+                        help='less iterations, for a quick check')
+    args = parser.parse_args()
+
+    results = {}
+    for name, fn in _benchmarks:
+        if args.names and name not in args.names:
+            continue
+        print('Running ' + name, file=sys.stderr)
+        results[name] = fn(args.quick)
+
+    output = {
+        'revision': _git_revision(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'quick': args.quick,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), output)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,24 +8,24 @@ import rlcompleter
 
 sys.path.append('../src')
 
-from Bybop_Discovery import Discovery, DeviceID, get_name
+from Bybop_Discovery import Discovery, DiscoveryCache, DeviceID, get_name
 import Bybop_Device
 
 print('Searching for devices')
 
-discovery = Discovery(DeviceID.ALL)
-
-discovery.wait_for_change()
+discovery = Discovery(DeviceID.ALL, cache=DiscoveryCache())
 
 devices = discovery.get_devices()
-
-discovery.stop()
+if not devices:
+    discovery.wait_for_change(timeout=30.0)
+    devices = discovery.get_devices()
 
 if not devices:
+    discovery.stop()
     print('Oops ...')
     sys.exit(1)
 
-device = next(iter(devices.values()))
+name, device = next(iter(devices.items()))
 
 print('Will connect to ' + get_name(device))
 
@@ -36,6 +36,17 @@ controller_name = "bybop shell"
 drone = Bybop_Device.create_and_connect(
     device, d2c_port, controller_type, controller_name)
 
+if drone is None and discovery.is_cached(name):
+    # The cached entry may be outdated, wait for MDNS to revalidate it
+    print('Cached entry failed, waiting for the device to be found')
+    discovery.wait_for_change(timeout=30.0)
+    device = discovery.get_devices().get(name)
+    if device is not None and not discovery.is_cached(name):
+        drone = Bybop_Device.create_and_connect(
+            device, d2c_port, controller_type, controller_name)
+
+discovery.stop()
+
 if drone is None:
     print('Unable to connect to a product')
     sys.exit(1)
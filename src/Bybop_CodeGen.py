@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+Generator of the typed commands module.
+
+The generated module (Bybop_GeneratedCommands) has one function per command,
+with the command arguments as parameters, a hard-wired header and a
+precompiled struct. It also has a namespace class per project (and per
+class), so commands can be written as ardrone3.Piloting.PCMD(...).
+
+The generated module only depends on the struct module (and on this module
+for the error reporting), so it imports much faster than the parsing of the
+XML files done by Bybop_Commands.
+
+Usage: Bybop_CodeGen.py [output path]
+"""
+
+import hashlib
+import importlib.util
+import keyword
+import os
+import struct
+import sys
+import tempfile
+import threading
+
+MY_PATH, _ = os.path.split(os.path.realpath(__file__))
+XML_PATH = os.path.join(MY_PATH, '..', 'arsdk-xml', 'xml')
+
+MODULE_NAME = 'Bybop_GeneratedCommands'
+# In the user cache, as the library directory may not be writable
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'bybop',
+                            MODULE_NAME + '.py')
+
+# Version of the generated code, part of the module signature so that the
+# modules generated by an older generator are generated again
+GENERATOR_VERSION = 2
+
+_ranges = {
+    'u8': (0, 0xff),
+    'i8': (-0x80, 0x7f),
+    'u16': (0, 0xffff),
+    'i16': (-0x8000, 0x7fff),
+    'u32': (0, 0xffffffff),
+    'i32': (-0x80000000, 0x7fffffff),
+    'u64': (0, 0xffffffffffffffff),
+    'i64': (-0x8000000000000000, 0x7fffffffffffffff),
+}
+
+
+_signature = None
+_signature_lock = threading.Lock()
+
+
+def xml_signature():
+    """
+    Get the signature (sha1) of the XML files the commands are generated
+    from (and of the generator version).
+
+    The signature is computed once per process.
+    """
+    global _signature
+    with _signature_lock:
+        if _signature is None:
+            _signature = _compute_signature()
+        return _signature
+
+
+def _compute_signature():
+    sha = hashlib.sha1()
+    sha.update(bytes('generator %d' % GENERATOR_VERSION, 'utf-8'))
+    try:
+        names = sorted(f for f in os.listdir(XML_PATH) if f.endswith('.xml'))
+    except OSError:
+        names = []
+    for name in names:
+        sha.update(bytes(name, 'utf-8'))
+        with open(os.path.join(XML_PATH, name), 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def bad_args(name, spec, values):
+    """
+    Raise a CommandError describing the first bad argument of a command.
+
+    This function is called by the generated module when a command can not
+    be packed.
+
+    Arguments:
+    - name : The full name of the command
+    - spec : Tuple of the (name, type) of each argument
+    - values : Tuple of the arguments values
+    """
+    import Bybop_Commands
+    for (arg, typ), value in zip(spec, values):
+        if typ in _ranges:
+            lo, hi = _ranges[typ]
+            ok = isinstance(value, int) and lo <= value <= hi
+        elif typ in ('float', 'double'):
+            ok = isinstance(value, (int, float))
+        elif typ == 'string':
+            ok = isinstance(value, (str, bytes))
+        else:
+            ok = True
+        if not ok:
+            raise Bybop_Commands.CommandError(
+                'Bad value %r for argument %s (%s) of %s' %
+                (value, arg, typ, name))
+    raise Bybop_Commands.CommandError('Bad arguments for ' + name)
+
+
+def encode_symbolic(name, idx, value):
+    """
+    Convert an enum name (or a bitfield names iterable) to an integer.
+
+    This function is called by the generated module for the enum and
+    bitfield arguments which are not integers (see
+    Bybop_Commands.pack_command).
+
+    Arguments:
+    - name : The full name of the command
+    - idx : The index of the argument
+    - value : The argument value
+    """
+    import Bybop_Commands
+    cmd = Bybop_Commands.find_command(*Bybop_Commands.command_ids(name))[1]
+    args = [0] * len(cmd.args)
+    args[idx] = value
+    return Bybop_Commands._encode_symbolic(cmd, args)[idx]
+
+
+def _identifier(name):
+    return name + '_' if keyword.iskeyword(name) else name
+
+
+def _gen_command(name, ids, cmd, idx):
+    """ Return the lines of the function packing one command """
+    import Bybop_Commands
+    types = [Bybop_Commands.arg_type_name(a) for a in cmd.args]
+    params = [_identifier(a.name) for a in cmd.args]
+    fname = '_cmd%d' % idx
+    lines = ['', '']
+    if params:
+        lines.append('_a%d = %r' % (idx, tuple((a.name, t) for a, t in
+                                              zip(cmd.args, types))))
+    ret = ', %d, %d' % (cmd.bufferType, cmd.timeoutPolicy)
+    body = []
+    if 'multisetting' in types:
+        # Rare and variable sized, use the generic implementation
+        pr, cl, cm = name.split('.')
+        body.append('import Bybop_Commands')
+        body.append('return Bybop_Commands.pack_command(%r, %r, %r, %s)' %
+                    (pr, cl, cm, ', '.join(params)))
+    else:
+        # Enum and bitfield arguments may be given by names
+        for aidx in sorted(Bybop_Commands._encoders_for(cmd)):
+            param = params[aidx]
+            body.append('if not isinstance(%s, int):' % param)
+            body.append('    %s = Bybop_CodeGen.encode_symbolic(%r, %d, %s)'
+                        % (param, name, aidx, param))
+        # Split the arguments in fixed size runs and strings
+        parts = []
+        fmt = '<BBH'
+        values = [str(i) for i in ids]
+        first = True
+        for param, typ in zip(params, types):
+            if typ == 'string':
+                if fmt != '<' or values:
+                    parts.append((fmt, values))
+                fmt, values = '<', []
+                parts.append(('z', param))
+            else:
+                fmt += Bybop_Commands._struct_fmt_for_type[typ]
+                values.append(param)
+        if fmt != '<' or values:
+            parts.append((fmt, values))
+        exprs = []
+        for sidx, part in enumerate(parts):
+            if part[0] == 'z':
+                body.append('if isinstance(%s, str):' % part[1])
+                body.append('    %s = %s.encode(\'utf-8\')' % (part[1],
+                                                               part[1]))
+                exprs.append('%s + b\'\\0\'' % part[1])
+            elif first and len(part[1]) == 3:
+                # Header only, pack it once
+                lines.append('_h%d = %r' % (idx, struct.pack(
+                    part[0], *[int(v) for v in part[1]])))
+                exprs.append('_h%d' % idx)
+            else:
+                lines.append('_s%d_%d = struct.Struct(%r)' % (idx, sidx,
+                                                             part[0]))
+                exprs.append('_s%d_%d.pack(%s)' % (idx, sidx,
+                                                   ', '.join(part[1])))
+            first = False
+        if params:
+            body.append('try:')
+            body.append('    return %s%s' % (' + '.join(exprs), ret))
+            body.append('except (struct.error, TypeError):')
+            body.append('    Bybop_CodeGen.bad_args(%r, _a%d, (%s%s))' %
+                        (name, idx, ', '.join(params),
+                         ',' if len(params) == 1 else ''))
+        else:
+            body.append('return %s%s' % (' + '.join(exprs), ret))
+    lines.append('')
+    lines.append('')
+    lines.append('def %s(%s):' % (fname, ', '.join(params)))
+    lines.append('    """ Pack %s (see Bybop_Commands.pack_command) """' %
+                 name)
+    lines.extend('    ' + b for b in body)
+    return fname, lines
+
+
+def generate(path=None):
+    """
+    Generate the typed commands module from the XML files.
+
+    Return the path of the generated module.
+
+    Keyword arguments:
+    - path : The path of the module (default Bybop_GeneratedCommands.py, in
+             ~/.cache/bybop)
+    """
+    import Bybop_Commands
+    if path is None:
+        path = DEFAULT_PATH
+    lines = [
+        '# Generated by Bybop_CodeGen from the arsdk-xml files, do not edit.',
+        '',
+        'import struct',
+        '',
+        'import Bybop_CodeGen',
+        '',
+        'XML_SIGNATURE = %r' % xml_signature(),
+        '',
+        '# Each command has its arguments spec (_a), and its packed header',
+        '# (_h) or precompiled structs (_s).',
+    ]
+    namespaces = {}
+    commands = []
+    for idx, (name, cmd) in enumerate(Bybop_Commands.iter_commands()):
+        ids = Bybop_Commands.command_ids(name)
+        fname, cmd_lines = _gen_command(name, ids, cmd, idx)
+        lines.extend(cmd_lines)
+        commands.append((name, fname))
+        pr, cl, cm = name.split('.')
+        namespaces.setdefault(pr, {}).setdefault(cl, []).append(
+            (_identifier(cm), fname))
+
+    for pr in sorted(namespaces):
+        lines.extend(['', '', 'class %s(object):' % _identifier(pr)])
+        classes = namespaces[pr]
+        for cl in sorted(classes):
+            indent = '    '
+            if cl:
+                lines.append('    class %s(object):' % _identifier(cl))
+                indent = '        '
+            for cm, fname in classes[cl]:
+                lines.append('%s%s = staticmethod(%s)' % (indent, cm, fname))
+            if cl:
+                lines.append('')
+        if lines[-1] == '':
+            lines.pop()
+
+    lines.extend(['', '', 'COMMANDS = {'])
+    for name, fname in commands:
+        lines.append('    %r: %s,' % (name, fname))
+    lines.append('}')
+
+    # A unique temporary file, as many processes may generate the module
+    # at the same time
+    dirname = os.path.dirname(os.path.abspath(path))
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=MODULE_NAME,
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return path
+
+
+def load(path=None, regenerate=True):
+    """
+    Load the typed commands module.
+
+    If the module is missing, or was generated from other XML files, it is
+    generated again (unless regenerate is False).
+
+    Return the module. An OSError is raised if the module can not be
+    written.
+
+    Keyword arguments:
+    - path : The path of the module (default Bybop_GeneratedCommands.py, in
+             ~/.cache/bybop)
+    - regenerate : Generate the module if needed (default True)
+    """
+    if path is None:
+        path = DEFAULT_PATH
+    module = None
+    if os.path.exists(path):
+        module = _import(path)
+        if regenerate and module.XML_SIGNATURE != xml_signature():
+            module = None
+    if module is None:
+        if not regenerate:
+            raise ImportError('No generated commands module at ' + path)
+        module = _import(generate(path))
+    return module
+
+
+def _import(path):
+    spec = importlib.util.spec_from_file_location(MODULE_NAME, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+if __name__ == '__main__':
+    print(generate(sys.argv[1] if len(sys.argv) > 1 else None))
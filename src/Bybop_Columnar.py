@@ -0,0 +1,245 @@
+# This module uses http://www.numpy.org/ for its arrays
+
+import json
+import struct
+
+import numpy
+
+import Bybop_Commands
+import Bybop_NetworkAL
+from Bybop_Recorder import Direction, is_log_source, read_frames
+
+
+_dtype_for_type = {
+    'u8': 'u1',
+    'i8': 'i1',
+    'u16': '<u2',
+    'i16': '<i2',
+    'u32': '<u4',
+    'i32': '<i4',
+    'u64': '<u8',
+    'i64': '<i8',
+    'float': '<f4',
+    'double': '<f8',
+}
+
+_header = struct.Struct('<BBH')
+
+
+class _Group(object):
+    """ All the messages of one command, before decoding """
+
+    def __init__(self, name, cmd):
+        self.name = name
+        self.cmd = cmd
+        self.timestamps = []
+        self.payloads = []
+        self.types = [Bybop_Commands.arg_type_name(arg) for arg in cmd.args]
+        # Strings and multisettings have variable sizes
+        self.has_strings = 'string' in self.types or \
+            'multisetting' in self.types
+
+
+def _iter_source(source, directions):
+    """ Yield (timestamp, payload) tuples from any supported source """
+    if is_log_source(source):
+        ack = Bybop_NetworkAL.DataType.ACK
+        for frame in read_frames(source):
+            # Skip acks, pings and pongs, which are not ARCommands
+            if frame.direction not in directions or frame.type == ack or \
+                    frame.buf in (0, 1):
+                continue
+            yield frame.timestamp, frame.data
+        return
+    for idx, item in enumerate(source):
+        if isinstance(item, (bytes, bytearray, memoryview)):
+            yield idx, bytes(item)
+        else:
+            yield item[0], bytes(item[1])
+
+
+def _group_messages(source, directions):
+    groups = {}
+    for ts, payload in _iter_source(source, directions):
+        if len(payload) < _header.size:
+            continue
+        key = _header.unpack_from(payload)
+        group = groups.get(key)
+        if group is None:
+            name, cmd = Bybop_Commands.find_command(*key)
+            if cmd is None:
+                groups[key] = False
+                continue
+            group = _Group(name, cmd)
+            groups[key] = group
+        elif group is False:
+            continue
+        group.timestamps.append(ts)
+        group.payloads.append(payload)
+    return [g for g in groups.values() if g]
+
+
+def _out_dtype(group):
+    fields = [('timestamp', '<i8')]
+    for arg, typ in zip(group.cmd.args, group.types):
+        fields.append((arg.name, object if typ in ('string', 'multisetting')
+                       else _dtype_for_type[typ]))
+    return numpy.dtype(fields)
+
+
+def _decode_fixed(group, out):
+    """ Vectorized decoding of a command without string arguments """
+    names = [arg.name for arg in group.cmd.args]
+    in_dtype = numpy.dtype({
+        'names': names,
+        'formats': [_dtype_for_type[t] for t in group.types],
+        'offsets': _offsets(group.types),
+        'itemsize': _header.size + _args_size(group.types),
+    })
+    size = in_dtype.itemsize
+    good = [i for i, p in enumerate(group.payloads) if len(p) == size]
+    if len(good) == len(group.payloads):
+        raw = numpy.frombuffer(b''.join(group.payloads), dtype=in_dtype)
+        ts = group.timestamps
+    else:
+        # Drop the malformed messages
+        raw = numpy.frombuffer(
+            b''.join([group.payloads[i] for i in good]), dtype=in_dtype)
+        ts = [group.timestamps[i] for i in good]
+        out = out[:len(good)]
+    out['timestamp'] = ts
+    for name in names:
+        out[name] = raw[name]
+    return out
+
+
+def _offsets(types):
+    ret = []
+    off = _header.size
+    for t in types:
+        ret.append(off)
+        off += numpy.dtype(_dtype_for_type[t]).itemsize
+    return ret
+
+
+def _args_size(types):
+    return sum(numpy.dtype(_dtype_for_type[t]).itemsize for t in types)
+
+
+def _decode_strings(group, out):
+    """ Per message decoding of a command with string arguments """
+    names = [arg.name for arg in group.cmd.args]
+    nb = 0
+    for ts, payload in zip(group.timestamps, group.payloads):
+        try:
+            dico, ok = Bybop_Commands.unpack_command(payload)
+        except Bybop_Commands.CommandError:
+            continue
+        if not ok:
+            continue
+        row = out[nb]
+        row['timestamp'] = ts
+        for name in names:
+            row[name] = dico['args'][name]
+        nb += 1
+    return out[:nb]
+
+
+def decode_bulk(source, directions=(Direction.IN,)):
+    """
+    Decode many ARCommands at once into structured numpy arrays.
+
+    The messages are grouped by command, and each group is decoded in a single
+    vectorized pass (the fields dtypes are built from the ARCommands argument
+    types). Commands with string arguments can not be decoded this way, and
+    are decoded message by message, their strings (and multisettings
+    dictionnaries) being saved in object fields.
+
+    Each returned array has a 'timestamp' field (int64), followed by one field
+    per argument of the command. The timestamps are the recorded monotonic
+    clock values (nanoseconds) when decoding a log, or the values given in the
+    source. Messages given without timestamps are timestamped with their
+    index in the source.
+
+    Unknown commands and malformed messages are ignored.
+
+    Return a dictionnary of arrays, indexed by the full command names
+    (project.class.command).
+
+    Arguments:
+    - source : Either a log file path, a list of log file paths, a log
+               basename (see Bybop_Recorder), or an iterable of packed
+               commands, or of (timestamp, packed command) tuples.
+
+    Keyword arguments:
+    - directions : The directions of the recorded frames to decode (default
+                   incoming frames only). Ignored when source is not a log.
+    """
+    ret = {}
+    for group in _group_messages(source, directions):
+        out = numpy.zeros(len(group.payloads), dtype=_out_dtype(group))
+        if group.has_strings:
+            ret[group.name] = _decode_strings(group, out)
+        else:
+            ret[group.name] = _decode_fixed(group, out)
+    return ret
+
+
+# Suffix of the columns saved as JSON strings
+_JSON_SUFFIX = ':json'
+
+
+def save_columns(decoded, path):
+    """
+    Save decoded arrays in a columnar file.
+
+    The file is a compressed numpy archive (.npz), with one array per column,
+    named 'project.class.command/field'. String fields are saved as fixed size
+    unicode arrays. Multisetting fields (dictionnaries) are saved as JSON
+    strings, in columns named 'project.class.command/field:json', and are
+    decoded back by load_columns.
+
+    Arguments:
+    - decoded : The dictionnary returned by decode_bulk
+    - path : Path of the output file
+    """
+    columns = {}
+    for name, arr in decoded.items():
+        for field in arr.dtype.names:
+            col = arr[field]
+            key = name + '/' + field
+            if col.dtype == object:
+                if any(isinstance(v, dict) for v in col):
+                    col = [json.dumps(v, sort_keys=True) for v in col]
+                    key += _JSON_SUFFIX
+                else:
+                    col = [str(v) for v in col]
+                col = numpy.array(col, dtype=str) if len(col) else \
+                    numpy.zeros(0, dtype='U1')
+            columns[key] = col
+    numpy.savez_compressed(path, **columns)
+
+
+def load_columns(path):
+    """
+    Load a columnar file written by save_columns.
+
+    Return a dictionnary, indexed by the full command names, of dictionnaries
+    of columns, indexed by the field names. The multisetting columns are
+    object arrays of dictionnaries.
+
+    Arguments:
+    - path : Path of the file
+    """
+    ret = {}
+    with numpy.load(path) as data:
+        for key in data.files:
+            name, field = key.rsplit('/', 1)
+            col = data[key]
+            if field.endswith(_JSON_SUFFIX):
+                field = field[:-len(_JSON_SUFFIX)]
+                values = [json.loads(str(v)) for v in col]
+                col = numpy.empty(len(values), dtype=object)
+                col[:] = values
+            ret.setdefault(name, {})[field] = col
+    return ret
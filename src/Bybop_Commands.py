@@ -1,3 +1,4 @@
+import enum
 import os
 import sys
 import struct
@@ -40,21 +41,46 @@ _struct_fmt_for_type = {
     'double': 'd',
     'string': 'z',
     'enum': 'i',
+    'multisetting': 'M',
 }
 
 
+class Decoding(object):
+    RAW = 0
+    NAMES = 1
+    ENUMS = 2
+
+
+# Multisetting arguments are encoded as their total size, followed by the
+# member commands, each one prefixed by its size.
+_multisetting_size = struct.Struct('<H')
+
+
+def arg_type_name(arg):
+    """
+    Get the wire type name ('u8', 'i32', 'float', 'string' ...) of a command
+    argument.
+
+    Enums are sent as 'i32', and bitfields as their underlying type.
+    Multisettings have the 'multisetting' type name.
+
+    Arguments:
+    - arg : The arsdkparser argument
+    """
+    if isinstance(arg.argType, arsdkparser.ArMultiSetting):
+        return 'multisetting'
+    elif isinstance(arg.argType, arsdkparser.ArBitfield):
+        return arsdkparser.ArArgType.TO_STRING[arg.argType.btfType]
+    elif isinstance(arg.argType, arsdkparser.ArEnum):
+        return 'i32'
+    else:
+        return arsdkparser.ArArgType.TO_STRING[arg.argType]
+
+
 def _format_string_for_cmd(cmd):
     ret = '<'
     for arg in cmd.args:
-        if isinstance(arg.argType, arsdkparser.ArMultiSetting):
-            raise Exception('Multisettings not supported !')
-        elif isinstance(arg.argType, arsdkparser.ArBitfield):
-            arg_str_type = arsdkparser.ArArgType.TO_STRING[arg.argType.btfType]
-        elif isinstance(arg.argType, arsdkparser.ArEnum):
-            arg_str_type = 'i32'
-        else:
-            arg_str_type = arsdkparser.ArArgType.TO_STRING[arg.argType]
-        ret += _struct_fmt_for_type[arg_str_type]
+        ret += _struct_fmt_for_type[arg_type_name(arg)]
     return ret, bool(cmd.args)
 
 
@@ -111,24 +137,14 @@ def _struct_unpack(fmt, string):
     return tuple(ret)
 
 
-def pack_command(s_proj, s_cls, s_cmd, *args):
+def _find_cmd_by_name(s_proj, s_cls, s_cmd):
     """
-    Pack a command into a string.
+    Find a command from its names.
 
-    Arguments:
-    - s_proj : Name of the project
-    - s_cls  : Name of the class within the project (ignored for features)
-    - s_cmd  : Name of the command within the class
-    - *args  : Arguments of the command.
+    Return a (project id, class id, command) tuple.
 
     If the project, the class or the command can not be found in the command
     table, a CommandError will be raised.
-
-    If the number and type of arguments in *arg do not match the expected ones,
-    a CommandError will be raised.
-
-    Return the command string, the command recommanded buffer and the command
-    recommanded timeout policy.
     """
     proj = None
     feat = None
@@ -136,8 +152,6 @@ def pack_command(s_proj, s_cls, s_cmd, *args):
     cls = None
     clsid = 0
     cmd = None
-    # Let an exception be raised if we do not know the command
-    # or if the format is bad
 
     # Find the project
     if s_proj in _ctx.projectsByName:
@@ -168,21 +182,80 @@ def pack_command(s_proj, s_cls, s_cmd, *args):
         # Find the command
         if s_cmd in feat.cmdsByName:
             cmd = feat.cmdsByName[s_cmd]
+        elif s_cmd in feat.evtsByName:
+            cmd = feat.evtsByName[s_cmd]
         if cmd is None:
             raise CommandError('Unknown command ' +
                                s_cmd + ' in feature ' + s_proj)
 
+    return projid, clsid, cmd
+
+
+def command_ids(name):
+    """
+    Get the ids of a command.
+
+    Return a (project id, class id, command id) tuple. The class id is 0 for
+    features.
+
+    If the command is unknown, a CommandError will be raised.
+
+    Arguments:
+    - name : The command, in 'project.class.command' notation
+    """
+    try:
+        s_proj, s_cls, s_cmd = name.split('.')
+    except ValueError:
+        raise CommandError('Bad command name ' + name)
+    projid, clsid, cmd = _find_cmd_by_name(s_proj, s_cls, s_cmd)
+    return projid, clsid, cmd.cmdId
+
+
+def pack_command(s_proj, s_cls, s_cmd, *args):
+    """
+    Pack a command into a string.
+
+    Arguments:
+    - s_proj : Name of the project
+    - s_cls  : Name of the class within the project (ignored for features)
+    - s_cmd  : Name of the command within the class
+    - *args  : Arguments of the command.
+
+    If the project, the class or the command can not be found in the command
+    table, a CommandError will be raised.
+
+    If the number and type of arguments in *arg do not match the expected ones,
+    a CommandError will be raised.
+
+    Multisetting arguments are given as dictionnaries of member commands,
+    indexed by their full names (project.class.command), with a tuple or a
+    dictionnary of arguments as values. Unpacked multisettings use the same
+    format, with dictionnaries of arguments.
+
+    Enum arguments can be given as integers, IntEnum members or names, and
+    bitfield arguments as integers, IntFlag values, or iterables of names.
+
+    Return the command string, the command recommanded buffer and the command
+    recommanded timeout policy.
+    """
+    projid, clsid, cmd = _find_cmd_by_name(s_proj, s_cls, s_cmd)
+
     ret = struct.pack('<BBH', projid, clsid, cmd.cmdId)
     argsfmt, needed = _format_string_for_cmd(cmd)
     if needed:
         try:
+            if _encoders_for(cmd):
+                args = _encode_symbolic(cmd, args)
             cmd_args = []
             for arg in args:
                 if isinstance(arg, str):
                     cmd_args.append(bytes(arg, 'utf-8'))
                 else:
                     cmd_args.append(arg)
-            ret += _struct_pack(argsfmt, *cmd_args)
+            if 'M' in argsfmt:
+                ret += _pack_with_multisettings(cmd, argsfmt, cmd_args)
+            else:
+                ret += _struct_pack(argsfmt, *cmd_args)
         except IndexError:
             raise CommandError('Missing arguments')
         except TypeError:
@@ -193,45 +266,162 @@ def pack_command(s_proj, s_cls, s_cmd, *args):
     return ret, cmd.bufferType, cmd.timeoutPolicy
 
 
-def unpack_command(buf):
+_cmds_ids = {}
+
+
+def _cmd_ids(cmd):
+    """ Get the (project id, class id, command id) of a command object """
+    if not _cmds_ids:
+        for proj in _ctx.projects:
+            for cls in proj.classes:
+                for c in cls.cmds:
+                    _cmds_ids[id(c)] = (proj.projectId, cls.classId, c.cmdId)
+        for feat in _ctx.features:
+            for c in list(feat.cmds) + list(feat.evts):
+                _cmds_ids[id(c)] = (feat.featureId, 0, c.cmdId)
+    return _cmds_ids[id(cmd)]
+
+
+def multisetting_members(multisetting):
     """
-    Unpack a command string into a dictionnary of arguments
+    Get the member commands of a multisetting.
+
+    Return a list of (name, command) tuples, where name is the full name of
+    the command (project.class.command).
 
     Arguments:
-    - buf : The packed command
+    - multisetting : The arsdkparser multisetting (argument type)
+    """
+    return [find_command(*_cmd_ids(msg)) for msg in multisetting.msgs]
 
-    Return a dictionnary describing the command, and a boolean indicating
-    whether the command is known.
-    If the boolean is False, then the dictionnary is {}
 
-    Return dictionnary format:
-    {
-      'name' : full name of the command (project.class.command)
-      'project' : project of the command
-      'class' : class of the command
-      'cmd' : command name
-      'listtype' : list type (none/list/map) of the command
-      'args' : arguments in the commands, in the form { 'name':value, ... }
-      'arg0' : value of the first argument ('' if no arguments)
-               this is useful for map commands, as this will be the key.
-    }
+def multisetting_commands():
+    """
+    Get the commands which send a multisetting to the device.
 
-    A CommandError is raised if the command is in a bad format.
+    Return a list of (name, multisetting) tuples, where name is the full name
+    of a command with a single multisetting argument, and multisetting is the
+    arsdkparser multisetting. The features events are not included.
+    """
+    ret = []
+    for name, cmd in iter_commands():
+        if len(cmd.args) != 1 or \
+                not isinstance(cmd.args[0].argType,
+                               arsdkparser.ArMultiSetting):
+            continue
+        pr = name.split('.')[0]
+        if pr in _ctx.featuresByName and \
+                cmd in _ctx.featuresByName[pr].evts:
+            continue
+        ret.append((name, cmd.args[0].argType))
+    return ret
+
+
+def _pack_multisetting(multisetting, value):
+    """
+    Pack a multisetting argument.
+
+    The value is a dictionnary of the member commands to send, indexed by
+    their full names, with either a tuple or a dictionnary of arguments as
+    values.
+    """
+    if not isinstance(value, dict):
+        raise CommandError('Bad type for multisetting ' + multisetting.name)
+    members = dict(multisetting_members(multisetting))
+    body = b''
+    for name, args in value.items():
+        if name not in members:
+            raise CommandError('Command ' + name + ' is not a member of ' +
+                               'multisetting ' + multisetting.name)
+        if isinstance(args, dict):
+            try:
+                args = [args[a.name] for a in members[name].args]
+            except KeyError as e:
+                raise CommandError('Missing argument ' + str(e) + ' for ' +
+                                   name)
+        pr, cl, cm = name.split('.')
+        data, _, _ = pack_command(pr, cl, cm, *args)
+        body += _multisetting_size.pack(len(data)) + data
+    return _multisetting_size.pack(len(body)) + body
+
+
+def _unpack_multisetting(buf):
+    """
+    Unpack a multisetting argument.
+
+    Return the dictionnary of the member commands arguments dictionnaries,
+    indexed by the commands full names, and the size of the argument.
     """
-    # Skip empty commands
-    if not buf:
-        return {}, False
-    # Read the project/cls/cmd from the buffer
     try:
-        (i_proj, i_cls, i_cmd) = struct.unpack('<BBH', buf[:4])
+        (size,) = _multisetting_size.unpack_from(buf)
     except struct.error:
-        raise CommandError('Bad input buffer (not an ARCommand)')
+        raise CommandError('Bad input buffers (truncated multisetting)')
+    end = _multisetting_size.size + size
+    if end > len(buf):
+        raise CommandError('Bad input buffers (truncated multisetting)')
+    ret = {}
+    off = _multisetting_size.size
+    while off < end:
+        if off + _multisetting_size.size > end:
+            raise CommandError('Bad input buffers (truncated multisetting)')
+        (msize,) = _multisetting_size.unpack_from(buf, off)
+        off += _multisetting_size.size
+        if off + msize > end:
+            raise CommandError('Bad input buffers (truncated multisetting)')
+        dico, ok = unpack_command(buf[off:off + msize])
+        if ok:
+            ret[dico['name']] = dico['args']
+        off += msize
+    return ret, end
+
+
+def _pack_with_multisettings(cmd, argsfmt, args):
+    """ Slow path of pack_command, for commands with multisettings """
+    ret = b''
+    fmt = argsfmt[1:]
+    if len(args) < len(fmt):
+        raise IndexError
+    for c, arg, value in zip(fmt, cmd.args, args):
+        if c == 'M':
+            ret += _pack_multisetting(arg.argType, value)
+        else:
+            ret += _struct_pack('<' + c, value)
+    return ret
+
+
+def _unpack_with_multisettings(cmd, argsfmt, buf):
+    """ Slow path of unpack_command, for commands with multisettings """
+    ret = []
+    off = 0
+    for c in argsfmt[1:]:
+        if c == 'M':
+            value, size = _unpack_multisetting(buf[off:])
+        elif c == 'z':
+            size = buf[off:].find(b'\0') + 1
+            if size <= 0:
+                raise CommandError('No null char in string')
+            value = str(buf[off:off + size - 1], 'utf-8')
+        else:
+            size = struct.calcsize('<' + c)
+            (value,) = struct.unpack_from('<' + c, buf, off)
+        ret.append(value)
+        off += size
+    if off != len(buf):
+        raise struct.error('unpack requires a buffer of %d bytes' % off)
+    return tuple(ret)
+
+
+def _find_cmd(i_proj, i_cls, i_cmd):
+    """
+    Find a command from its ids.
+
+    Return a (project, feature, class, command) tuple, where either project
+    and class, or feature are None, or None if the command is unknown.
+    """
     proj = None
     feat = None
     cls = None
     cmd = None
-    # Let an exception be raised if we do not know the command
-    # or if the format is bad
 
     # Find the project
     if i_proj in _ctx.projectsById:
@@ -245,12 +435,12 @@ def unpack_command(buf):
         if i_cls in proj.classesById:
             cls = proj.classesById[i_cls]
         else:
-            return {}, False
+            return None
 
         if i_cmd in cls.cmdsById:
             cmd = cls.cmdsById[i_cmd]
         else:
-            return {}, False
+            return None
     # If feature, find directly the command
     elif feat:
         if i_cmd in feat.cmdsById:
@@ -258,18 +448,244 @@ def unpack_command(buf):
         elif i_cmd in feat.evtsById:
             cmd = feat.evtsById[i_cmd]
         else:
-            return {}, False
+            return None
     else:
+        return None
+    return proj, feat, cls, cmd
+
+
+def find_command(i_proj, i_cls, i_cmd):
+    """
+    Find a command from its ids.
+
+    Return a (name, command) tuple, where name is the full name of the command
+    (project.class.command) and command is the arsdkparser command, or
+    (None, None) if the command is unknown.
+
+    Arguments:
+    - i_proj : Id of the project (or feature)
+    - i_cls : Id of the class (ignored for features)
+    - i_cmd : Id of the command
+    """
+    found = _find_cmd(i_proj, i_cls, i_cmd)
+    if found is None:
+        return None, None
+    proj, feat, cls, cmd = found
+    name = '%s.%s.%s' % (proj.name if proj else feat.name,
+                         cls.name if cls else '',
+                         cmd.name)
+    return name, cmd
+
+
+def iter_commands():
+    """
+    Iterate over all the known commands.
+
+    Yield (name, command) tuples, where name is the full name of the command
+    (project.class.command) and command is the arsdkparser command. The
+    events of the features are included.
+    """
+    for proj in _ctx.projects:
+        for cls in proj.classes:
+            for cmd in cls.cmds:
+                yield '%s.%s.%s' % (proj.name, cls.name, cmd.name), cmd
+    for feat in _ctx.features:
+        for cmd in list(feat.cmds) + list(feat.evts):
+            yield '%s..%s' % (feat.name, cmd.name), cmd
+
+
+_enum_types = {}
+_bitfield_types = {}
+_decoders = {}
+_encoders = {}
+
+
+def enum_type(arenum):
+    """
+    Get the IntEnum class of an arsdkparser enum (created once).
+
+    Arguments:
+    - arenum : The arsdkparser enum
+    """
+    ret = _enum_types.get(arenum)
+    if ret is None:
+        ret = enum.IntEnum(arenum.name,
+                           [(v.name, v.value) for v in arenum.values])
+        _enum_types[arenum] = ret
+    return ret
+
+
+def bitfield_type(arenum):
+    """
+    Get the IntFlag class of a bitfield of an arsdkparser enum (created
+    once). Each enum value is a bit of the bitfield.
+
+    Arguments:
+    - arenum : The arsdkparser enum of the bitfield
+    """
+    ret = _bitfield_types.get(arenum)
+    if ret is None:
+        ret = enum.IntFlag(arenum.name,
+                           [(v.name, 1 << v.value) for v in arenum.values])
+        _bitfield_types[arenum] = ret
+    return ret
+
+
+def _bitfield_names(arenum):
+    bits = [(1 << v.value, sys.intern(v.name)) for v in arenum.values]
+    cache = {}
+
+    def decode(value):
+        ret = cache.get(value)
+        if ret is None:
+            ret = cache[value] = tuple(n for b, n in bits if value & b)
+        return ret
+    return decode
+
+
+def _decoders_for(cmd, decoding):
+    """
+    Get the (argument index, decoding function) list of the enum and
+    bitfield arguments of a command (built once per command).
+    """
+    key = (cmd, decoding)
+    ret = _decoders.get(key)
+    if ret is not None:
+        return ret
+    ret = []
+    for idx, arg in enumerate(cmd.args):
+        typ = arg.argType
+        if isinstance(typ, arsdkparser.ArBitfield):
+            if decoding == Decoding.NAMES:
+                ret.append((idx, _bitfield_names(typ.enum)))
+            else:
+                ret.append((idx, bitfield_type(typ.enum)))
+        elif isinstance(typ, arsdkparser.ArEnum):
+            if decoding == Decoding.NAMES:
+                table = dict((v.value, sys.intern(v.name))
+                             for v in typ.values)
+            else:
+                cls = enum_type(typ)
+                table = dict((m.value, m) for m in cls)
+            ret.append((idx, _table_lookup(table)))
+    _decoders[key] = ret
+    return ret
+
+
+def _table_lookup(table):
+    get = table.get
+    # Unknown values are kept as integers
+    return lambda value: get(value, value)
+
+
+def _encoders_for(cmd):
+    """
+    Get the argument index -> (enum values by name, is bitfield) dictionnary
+    of the enum and bitfield arguments of a command (built once per command).
+    """
+    ret = _encoders.get(cmd)
+    if ret is None:
+        ret = {}
+        for idx, arg in enumerate(cmd.args):
+            typ = arg.argType
+            if isinstance(typ, arsdkparser.ArBitfield):
+                ret[idx] = (dict((v.name, v.value)
+                                 for v in typ.enum.values), True)
+            elif isinstance(typ, arsdkparser.ArEnum):
+                ret[idx] = (dict((v.name, v.value) for v in typ.values),
+                            False)
+        _encoders[cmd] = ret
+    return ret
+
+
+def _encode_symbolic(cmd, args):
+    """
+    Convert the enum names (and bitfields names iterables) of the arguments
+    to integers. IntEnum and IntFlag values are already integers.
+    """
+    encoders = _encoders_for(cmd)
+    ret = list(args)
+    for idx, (values, bitfield) in encoders.items():
+        if idx >= len(ret) or isinstance(ret[idx], int):
+            continue
+        value = ret[idx]
+        try:
+            if not bitfield:
+                ret[idx] = values[value]
+            elif isinstance(value, str):
+                ret[idx] = 1 << values[value]
+            else:
+                ret[idx] = sum(1 << values[v] for v in set(value))
+        except (KeyError, TypeError):
+            raise CommandError('Bad value %r for argument %s' %
+                               (value, cmd.args[idx].name))
+    return ret
+
+
+def unpack_command(buf, decoding=Decoding.RAW):
+    """
+    Unpack a command string into a dictionnary of arguments
+
+    Arguments:
+    - buf : The packed command
+
+    Keyword arguments:
+    - decoding : The decoding of the enum and bitfield arguments (default
+                 Decoding.RAW, integers). With Decoding.NAMES, enums are
+                 decoded as their (interned) names and bitfields as tuples
+                 of names. With Decoding.ENUMS, enums are decoded as IntEnum
+                 members and bitfields as IntFlag values (see enum_type and
+                 bitfield_type). Unknown enum values are kept as integers.
+
+    Return a dictionnary describing the command, and a boolean indicating
+    whether the command is known.
+    If the boolean is False, then the dictionnary is {}
+
+    Return dictionnary format:
+    {
+      'name' : full name of the command (project.class.command)
+      'project' : project of the command
+      'class' : class of the command
+      'cmd' : command name
+      'listtype' : list type (none/list/map) of the command
+      'args' : arguments in the commands, in the form { 'name':value, ... }
+      'arg0' : value of the first argument ('' if no arguments)
+               this is useful for map commands, as this will be the key.
+    }
+
+    A CommandError is raised if the command is in a bad format.
+    """
+    # Skip empty commands
+    if not buf:
+        return {}, False
+    # Read the project/cls/cmd from the buffer
+    try:
+        (i_proj, i_cls, i_cmd) = struct.unpack('<BBH', buf[:4])
+    except struct.error:
+        raise CommandError('Bad input buffer (not an ARCommand)')
+
+    found = _find_cmd(i_proj, i_cls, i_cmd)
+    if found is None:
         return {}, False
+    proj, feat, cls, cmd = found
 
     args = ()
     argsfmt, needed = _format_string_for_cmd(cmd)
     if needed:
         try:
-            args = _struct_unpack(argsfmt, buf[4:])
+            if 'M' in argsfmt:
+                args = _unpack_with_multisettings(cmd, argsfmt, buf[4:])
+            else:
+                args = _struct_unpack(argsfmt, buf[4:])
         except struct.error:
             raise CommandError(
                 'Bad input buffers (arguments do not match the command)')
+        if decoding != Decoding.RAW:
+            decoders = _decoders_for(cmd, decoding)
+            if decoders:
+                args = list(args)
+                for idx, decode in decoders:
+                    args[idx] = decode(args[idx])
 
     ret = {
         'name': '%s.%s.%s' % (proj.name if proj else feat.name,
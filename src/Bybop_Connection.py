@@ -1,5 +1,7 @@
 import json
 import socket
+import threading
+import time
 
 
 class Connection(object):
@@ -23,7 +25,8 @@ class Connection(object):
         self._port = int(port)
 
     def connect(self, d2c_port, controller_type, controller_name,
-                device_id=None):
+                device_id=None, connect_timeout=5.0, read_timeout=5.0,
+                stream_port=55004, control_port=55005):
         """
         Connect to a device.
 
@@ -35,9 +38,10 @@ class Connection(object):
         Calling this method while a connection is still alive leads to
         undefined behavior.
 
-        This method blocks until an answer is available from the device. If
-        the device could not be contacted, None is returned, else a dictionnary
-        made from the device json answer is returned.
+        This method blocks until an answer is available from the device, or
+        until one of the timeouts expires. If the device could not be
+        contacted, None is returned, else a dictionnary made from the device
+        json answer is returned.
         Application software must check that return_dict['status'] is 0 before
         using the parameters to start an ARNetwork/ARNetworkAL implementation,
         as a non-zero value means that the connection was refused.
@@ -58,6 +62,14 @@ class Connection(object):
                       serial number. This is typically useful for reconnection
                       after a loss of wifi, when you can not guarantee that the
                       controller is connected to the good network.
+        - connect_timeout : Timeout, in floating point seconds, for the TCP
+                            connection (None to block, default 5.0)
+        - read_timeout : Timeout, in floating point seconds, for the whole
+                         answer to be read (None to block, default 5.0)
+        - stream_port : The local port of the video stream (RTP, default
+                        55004, see Bybop_Stream.StreamReceiver)
+        - control_port : The local port of the video stream control (RTCP,
+                         default 55005)
         """
         dico = {}
         dico['d2c_port'] = d2c_port
@@ -65,23 +77,125 @@ class Connection(object):
         dico['controller_name'] = controller_name
         if device_id is not None:
             dico['device_id'] = device_id
-        dico['arstream2_client_stream_port'] = 55004
-        dico['arstream2_client_control_port'] = 55005
+        dico['arstream2_client_stream_port'] = int(stream_port)
+        dico['arstream2_client_control_port'] = int(control_port)
         jsonReq = json.dumps(dico, separators=(',', ':'))
 
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((self._ip, self._port))
-            sock.send(bytes(jsonReq, 'utf-8'))
-            jsonRaw = sock.recv(4096)
-            # Skip last null char if present
-            if jsonRaw[-1] == 0:
-                jsonRet = jsonRaw[:-1].decode('utf-8')
-            else:
-                jsonRet = jsonRaw.decode('utf-8')
-            sock.close()
-        except socket.error:
+            sock = socket.create_connection((self._ip, self._port),
+                                            timeout=connect_timeout)
+        except (socket.error, socket.timeout):
             return None
 
-        retDic = json.loads(jsonRet)
+        try:
+            sock.settimeout(read_timeout)
+            sock.sendall(bytes(jsonReq, 'utf-8'))
+            jsonRaw = _read_answer(sock, read_timeout)
+        except (socket.error, socket.timeout):
+            return None
+        finally:
+            sock.close()
+
+        if jsonRaw is None:
+            return None
+        try:
+            retDic = json.loads(jsonRaw.decode('utf-8'))
+        except ValueError:
+            return None
         return retDic
+
+
+def _read_answer(sock, timeout=None):
+    """
+    Read a json answer from the socket.
+
+    The device answer is terminated by a null char, but some devices close
+    the connection (or just stop sending) without it, so we also stop as soon
+    as the received data is a complete json document.
+
+    Return the raw answer (without the null char), or None if the connection
+    was closed before any complete answer was received. A socket.timeout is
+    raised if the whole answer was not read before the timeout, even if the
+    device keeps sending data.
+
+    Arguments:
+    - sock : The connected socket
+
+    Keyword arguments:
+    - timeout : Timeout, in floating point seconds, for the whole answer
+                (default None, to block)
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    data = b''
+    while True:
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout('Answer not read before the timeout')
+            sock.settimeout(remaining)
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+        null_idx = data.find(b'\0')
+        if null_idx >= 0:
+            return data[:null_idx]
+        try:
+            json.loads(data.decode('utf-8'))
+            return data
+        except ValueError:
+            # Incomplete json (or partial utf-8 sequence), read more
+            pass
+    return data if data else None
+
+
+def connect_all(devices, controller_type, controller_name,
+                connect_timeout=5.0, read_timeout=5.0, max_workers=None):
+    """
+    Connect to many devices in parallel.
+
+    Each handshake is done in its own thread, so the total time is bounded
+    by the slowest device instead of the sum of all the handshakes.
+
+    Return a list of answers (dictionnaries made from the devices json answer,
+    or None if a device could not be contacted), in the same order as the
+    devices list.
+
+    Arguments:
+    - devices : List of (ip, port, d2c_port) or (ip, port, d2c_port,
+                device_id) tuples. Each device needs its own d2c_port.
+    - controller_type : The type of the controller (phone/tablet/pc ...)
+    - controllar_name : The name of the controller (app package ...)
+
+    Keyword arguments:
+    - connect_timeout : Timeout for each TCP connection (default 5.0)
+    - read_timeout : Timeout for each answer (default 5.0)
+    - max_workers : Maximum number of simultaneous handshakes (default None,
+                    meaning one per device)
+    """
+    devices = list(devices)
+    answers = [None] * len(devices)
+    if max_workers is None or max_workers <= 0:
+        max_workers = max(len(devices), 1)
+    sem = threading.Semaphore(max_workers)
+
+    def _handshake(idx, dev):
+        with sem:
+            ip, port, d2c_port = dev[0], dev[1], dev[2]
+            device_id = dev[3] if len(dev) > 3 else None
+            connection = Connection(ip, port)
+            answers[idx] = connection.connect(d2c_port, controller_type,
+                                              controller_name,
+                                              device_id=device_id,
+                                              connect_timeout=connect_timeout,
+                                              read_timeout=read_timeout)
+
+    threads = []
+    for idx, dev in enumerate(devices):
+        th = threading.Thread(target=_handshake, args=(idx, dev))
+        th.daemon = True
+        th.start()
+        threads.append(th)
+    for th in threads:
+        th.join()
+    return answers
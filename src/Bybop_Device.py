@@ -4,12 +4,22 @@ import time
 import threading
 import pprint
 import copy
+import functools
+import collections
+import json
+import math
+import os
+import zlib
 
 import Bybop_NetworkAL
 import Bybop_Network
 import Bybop_Commands
 import Bybop_Discovery
 import Bybop_Connection
+import Bybop_Metrics
+import Bybop_CodeGen
+import Bybop_Stream
+import Bybop_Piloting
 import arsdkparser
 from Bybop_Discovery import DeviceID
 
@@ -34,6 +44,16 @@ class State(object):
     This class also implements a wait_for function to do non-busy wait for
     commands reception (i.e. wait for an answer from the device), with an
     optionnal timeout.
+
+    Observers can be added to be notified of each update (see add_observer).
+
+    Each update increments the state version, and the version of each command
+    is kept, so a mirror of the state can be synchronized incrementally (see
+    changes_since and apply_changes).
+
+    A state can be saved to a file, and loaded at the start of a later
+    session. Loaded values are marked as stale until they are updated by the
+    device (see is_stale).
     """
 
     def __init__(self):
@@ -47,6 +67,45 @@ class State(object):
         self._waitlist = {}
         self._lock = threading.Lock()
         self._waitid = 0
+        self._observers = ()
+        self._version = 0
+        # Commands names, ordered by version
+        self._versions = collections.OrderedDict()
+        self._stale = set()
+
+    def add_observer(self, observer):
+        """
+        Add an observer of the state updates.
+
+        The observer is called after each update, with the command name (in
+        'project.class.command' notation) and the arguments dictionnary of
+        the update (for map commands, the key is the first argument).
+
+        Observers are called outside of the state lock, from the thread which
+        updated the state (usually the network thread), so they should return
+        quickly, and must not modify the arguments dictionnary.
+
+        Arguments:
+        - observer : The function to call
+        """
+        with self._lock:
+            self._observers = self._observers + (observer,)
+
+    def remove_observer(self, observer):
+        """
+        Remove an observer added by add_observer.
+
+        Arguments:
+        - observer : The function to remove
+        """
+        with self._lock:
+            self._observers = tuple(o for o in self._observers
+                                    if o != observer)
+
+    def _notify(self, pr, cl, cmd, args):
+        name = '%s.%s.%s' % (pr, cl, cmd)
+        for observer in self._observers:
+            observer(name, args)
 
     def _getcldic(self, pr, cl, create=True):
         if pr not in self._dict:
@@ -62,7 +121,28 @@ class State(object):
                 return None
         return pr_d[cl]
 
-    def wait_for(self, name, timeout=None):
+    def watch(self, name):
+        """
+        Start watching a key, before a call to wait_for.
+
+        A change of the key between this call and the wait_for call will not
+        be missed, which is needed when the change is triggered by a request
+        sent before waiting.
+
+        Return a watch id, to give to wait_for.
+
+        Arguments:
+        - name : The command to watch, in 'project.class.command' notation
+        """
+        with self._lock:
+            wid = self._waitid
+            self._waitid += 1
+            if name not in self._waitlist:
+                self._waitlist[name] = {}
+            self._waitlist[name][wid] = threading.Event()
+        return wid
+
+    def wait_for(self, name, timeout=None, watch_id=None):
         """
         Wait for a change on the given key.
 
@@ -73,20 +153,16 @@ class State(object):
 
         Keyword arguments:
         - timeout : Timeout, in floating point seconds, for the wait
+        - watch_id : A watch id returned by watch(name). If None, the wait
+                     starts with this call (default None)
         """
+        wid = watch_id if watch_id is not None else self.watch(name)
         with self._lock:
-            event = threading.Event()
-            wid = self._waitid
-            self._waitid += 1
-            if name not in self._waitlist:
-                self._waitlist[name] = {}
-            self._waitlist[name][wid] = event
+            event = self._waitlist[name][wid]
 
         res = event.wait(timeout)
 
         with self._lock:
-            if res:
-                event.clear()
             del self._waitlist[name][wid]
             if not self._waitlist[name]:
                 del self._waitlist[name]
@@ -94,6 +170,10 @@ class State(object):
 
     def _signal_waiting(self, pr, cl, cmd):
         waitname = '%s.%s.%s' % (pr, cl, cmd)
+        self._version += 1
+        self._versions[waitname] = self._version
+        self._versions.move_to_end(waitname)
+        self._stale.discard(waitname)
         if waitname in self._waitlist:
             for _, v in self._waitlist[waitname].items():
                 v.set()
@@ -111,12 +191,19 @@ class State(object):
         - cmd : Name of the commands
         - args : Arguments dictionnary of the command
         """
+        timed = Bybop_Metrics.enabled
+        if timed:
+            start = time.perf_counter_ns()
         with self._lock:
             pr_cl = self._getcldic(pr, cl)
             if cmd in pr_cl:
                 del pr_cl[cmd]
             pr_cl[cmd] = copy.deepcopy(args)
             self._signal_waiting(pr, cl, cmd)
+        if timed:
+            Bybop_Metrics.observe_since('state_put', start)
+        if self._observers:
+            self._notify(pr, cl, cmd, args)
 
     def put_list(self, pr, cl, cmd, args):
         """
@@ -131,12 +218,19 @@ class State(object):
         - cmd : Name of the commands
         - args : Arguments dictionnary of the command
         """
+        timed = Bybop_Metrics.enabled
+        if timed:
+            start = time.perf_counter_ns()
         with self._lock:
             pr_cl = self._getcldic(pr, cl)
             if cmd not in pr_cl:
                 pr_cl[cmd] = []
             pr_cl[cmd].append(copy.deepcopy(args))
             self._signal_waiting(pr, cl, cmd)
+        if timed:
+            Bybop_Metrics.observe_since('state_put', start)
+        if self._observers:
+            self._notify(pr, cl, cmd, args)
 
     def put_map(self, pr, cl, cmd, args, key):
         """
@@ -152,12 +246,19 @@ class State(object):
         - args : Arguments dictionnary of the command
         - key : Value of the first argument of the command
         """
+        timed = Bybop_Metrics.enabled
+        if timed:
+            start = time.perf_counter_ns()
         with self._lock:
             pr_cl = self._getcldic(pr, cl)
             if cmd not in pr_cl:
                 pr_cl[cmd] = {}
             pr_cl[cmd][key] = copy.deepcopy(args)
             self._signal_waiting(pr, cl, cmd)
+        if timed:
+            Bybop_Metrics.observe_since('state_put', start)
+        if self._observers:
+            self._notify(pr, cl, cmd, args)
 
     def get_value(self, name):
         """
@@ -195,6 +296,140 @@ class State(object):
             ret = copy.deepcopy(self._dict)
         return ret
 
+    def get_version(self, name=None):
+        """
+        Get the current version of the state.
+
+        The version is incremented by each update of the state, and starts
+        at 0 for an empty state.
+
+        Keyword arguments:
+        - name : A command, in 'project.class.command' notation. If given,
+                 the version of its last update is returned instead (0 if
+                 it was never updated) (default None)
+        """
+        with self._lock:
+            if name is not None:
+                return self._versions.get(name, 0)
+            return self._version
+
+    def changes_since(self, version):
+        """
+        Get the commands updated since a version of the state.
+
+        Return a (current version, changes) tuple, where changes is a
+        dictionnary of the current value of each updated command, indexed by
+        the 'project.class.command' names. The current version should be
+        given to the next call to get the next changes.
+
+        Only the changed commands are read, so the cost of a call does not
+        depend on the size of the state.
+
+        Arguments:
+        - version : A version returned by get_version or changes_since (0 to
+                    get the whole state)
+        """
+        changes = {}
+        with self._lock:
+            for name in reversed(self._versions):
+                if self._versions[name] <= version:
+                    break
+                pr, cl, cmd = name.split('.')
+                changes[name] = copy.deepcopy(self._dict[pr][cl][cmd])
+            return self._version, changes
+
+    def apply_changes(self, changes):
+        """
+        Apply changes returned by the changes_since function of another
+        state.
+
+        The values of the changed commands are replaced, and the waiting
+        threads are woken up. The observers are not called.
+
+        Arguments:
+        - changes : The changes dictionnary
+        """
+        with self._lock:
+            self._apply(changes)
+
+    def _apply(self, changes):
+        # Called with the lock held
+        for name, value in changes.items():
+            pr, cl, cmd = name.split('.')
+            self._getcldic(pr, cl)[cmd] = copy.deepcopy(value)
+            self._signal_waiting(pr, cl, cmd)
+
+    def is_stale(self, name):
+        """
+        Check whether a value was loaded from a saved state, and not yet
+        updated by the device.
+
+        Arguments:
+        - name : The command, in 'project.class.command' notation
+        """
+        with self._lock:
+            return name in self._stale
+
+    def get_stale(self):
+        """ Get the set of the commands with stale values """
+        with self._lock:
+            return set(self._stale)
+
+    def save(self, path):
+        """
+        Save the state to a file (see pack_changes for the format).
+
+        Return True if the state was saved, False otherwise (e.g. if a value
+        can not be serialized, see pack_changes).
+
+        Arguments:
+        - path : The path of the file
+        """
+        try:
+            data = pack_changes(*self.changes_since(0))
+        except ValueError as e:
+            print('Can not save the state : ' + str(e))
+            return False
+        tmp_path = path + '.tmp'
+        try:
+            dirname = os.path.dirname(path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def load(self, path):
+        """
+        Load a state saved by save().
+
+        The loaded values are marked as stale. Commands which were already
+        received from the device are not overwritten.
+
+        Return the number of loaded commands. A missing or corrupted file is
+        treated as an empty state.
+
+        Arguments:
+        - path : The path of the file
+        """
+        try:
+            with open(path, 'rb') as f:
+                _, changes = unpack_changes(f.read())
+        except (IOError, OSError):
+            return 0
+        except ValueError as e:
+            print('Ignoring the saved state ' + path + ' : ' + str(e))
+            return 0
+        with self._lock:
+            changes = dict((k, v) for k, v in changes.items()
+                           if k.count('.') == 2 and k not in self._versions)
+            self._apply(changes)
+            self._stale.update(changes)
+        return len(changes)
+
     def dump(self):
         """
         Dump the current state using a pretty printer.
@@ -205,6 +440,253 @@ class State(object):
             pprint.pprint(self._dict)
 
 
+# Version of the pack_changes format
+_CHANGES_FORMAT = 1
+
+
+def _encode_value(value):
+    """
+    Convert a state value to a JSON compatible value.
+
+    JSON has no non finite floats, and only string keys, so they are tagged:
+    {"__float__": "nan"} and {"__map__": [[key, value], ...]}.
+
+    A ValueError is raised for the values which can not be read back
+    identically (anything but None, booleans, numbers, strings, lists and
+    dictionnaries).
+    """
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, int):
+        # Also converts the IntEnum/IntFlag of the symbolic decoding
+        return int(value)
+    if isinstance(value, float):
+        if math.isfinite(value):
+            return float(value)
+        return {'__float__': repr(float(value))}
+    if isinstance(value, (list, tuple)):
+        return [_encode_value(v) for v in value]
+    if isinstance(value, dict):
+        if all(isinstance(k, str) for k in value) and \
+                '__float__' not in value and '__map__' not in value:
+            return dict((k, _encode_value(v)) for k, v in value.items())
+        return {'__map__': [[_encode_value(k), _encode_value(v)]
+                            for k, v in value.items()]}
+    raise ValueError('Unsupported state value %r' % (value,))
+
+
+def _decode_value(value):
+    """ Convert a value encoded by _encode_value back """
+    if isinstance(value, list):
+        return [_decode_value(v) for v in value]
+    if isinstance(value, dict):
+        if len(value) == 1 and '__float__' in value:
+            return float(value['__float__'])
+        if len(value) == 1 and '__map__' in value:
+            return dict((_hashable(_decode_value(k)), _decode_value(v))
+                        for k, v in value['__map__'])
+        return dict((k, _decode_value(v)) for k, v in value.items())
+    return value
+
+
+def _hashable(key):
+    if isinstance(key, (list, dict)):
+        raise ValueError('Bad map key %r' % (key,))
+    return key
+
+
+def pack_changes(version, changes, level=6):
+    """
+    Serialize the changes of a state into a compact string.
+
+    The changes are written as zlib compressed JSON (see _encode_value for
+    the non finite floats and the non string keys).
+
+    Return the packed changes, as bytes. A ValueError is raised if a value
+    can not be serialized (e.g. an object put in the state by the
+    application).
+
+    Arguments:
+    - version : The version returned by State.changes_since
+    - changes : The changes returned by State.changes_since
+
+    Keyword arguments:
+    - level : The zlib compression level (default 6)
+    """
+    content = {
+        'format': _CHANGES_FORMAT,
+        'version': version,
+        'changes': dict((name, _encode_value(value))
+                        for name, value in changes.items()),
+    }
+    return zlib.compress(bytes(json.dumps(content, allow_nan=False,
+                                          separators=(',', ':')),
+                               'utf-8'), level)
+
+
+def unpack_changes(data):
+    """
+    Read changes serialized by pack_changes.
+
+    Return a (version, changes) tuple.
+
+    A ValueError is raised if the data is not valid packed changes.
+
+    Arguments:
+    - data : The packed changes
+    """
+    try:
+        content = json.loads(str(zlib.decompress(data), 'utf-8'))
+        if content['format'] != _CHANGES_FORMAT or \
+                not isinstance(content['changes'], dict):
+            raise ValueError('unsupported format')
+        return content['version'], dict(
+            (name, _decode_value(value))
+            for name, value in content['changes'].items())
+    except (zlib.error, UnicodeDecodeError, KeyError, TypeError,
+            ValueError) as e:
+        raise ValueError('Bad packed changes : ' + str(e))
+
+
+class StateStore(object):
+    """
+    Directory of saved device states, indexed by the devices serial numbers.
+
+    Giving a store to a Device preloads the last saved state of the device
+    (with stale values, see State.is_stale), so the application can use the
+    cached settings before the end of the initialization.
+    """
+
+    def __init__(self, directory=None):
+        """
+        Create a new store.
+
+        Keyword arguments:
+        - directory : The directory of the saved states
+                      (default ~/.cache/bybop/states)
+        """
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.cache',
+                                     'bybop', 'states')
+        self._directory = directory
+
+    def get_path(self, serial):
+        """
+        Get the path of the saved state of a device.
+
+        Arguments:
+        - serial : The device serial number
+        """
+        safe = ''.join(c if c.isalnum() or c in '-_' else '_'
+                       for c in serial)
+        return os.path.join(self._directory, safe + '.state')
+
+    def save(self, serial, state):
+        """
+        Save the state of a device.
+
+        Return True if the state was saved, False otherwise.
+
+        Arguments:
+        - serial : The device serial number
+        - state : The State to save
+        """
+        return state.save(self.get_path(serial))
+
+    def load(self, serial, state):
+        """
+        Load the saved state of a device into a State.
+
+        Return the number of loaded commands.
+
+        Arguments:
+        - serial : The device serial number
+        - state : The State to fill
+        """
+        return state.load(self.get_path(serial))
+
+
+class _CommandSender(object):
+    """
+    Namespace of the generated commands (see Bybop_CodeGen), sending the
+    commands to a device.
+
+    Without generated commands (namespace None), the commands are packed by
+    Bybop_Commands.pack_command.
+    """
+
+    def __init__(self, device, namespace, prefix):
+        self._device = device
+        self._namespace = namespace
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._namespace is None:
+            ret = self._pack_command_attr(self._prefix + name)
+            setattr(self, name, ret)
+            return ret
+        attr = getattr(self._namespace, name)
+        fullname = self._prefix + name
+        if isinstance(attr, type):
+            ret = _CommandSender(self._device, attr, fullname + '.')
+        else:
+            if fullname.count('.') == 1:
+                # Feature command, without class
+                fullname = fullname.replace('.', '..')
+            ret = self._sender(fullname, attr)
+        # Cache the result, __getattr__ will not be called again
+        setattr(self, name, ret)
+        return ret
+
+    def _pack_command_attr(self, fullname):
+        parts = fullname.split('.')
+        if len(parts) == 2:
+            # Feature command, or class of a project
+            name = parts[0] + '..' + parts[1]
+        elif len(parts) == 3:
+            name = fullname
+        else:
+            name = None
+        if name is not None:
+            try:
+                Bybop_Commands.command_ids(name)
+            except Bybop_Commands.CommandError:
+                if len(parts) == 3:
+                    raise AttributeError(fullname)
+                name = None
+        if name is None:
+            return _CommandSender(self._device, None, fullname + '.')
+        pr, cl, cm = name.split('.')
+        return self._sender(name, functools.partial(
+            Bybop_Commands.pack_command, pr, cl, cm))
+
+    def _sender(self, name, packer):
+        device = self._device
+
+        def send(*args, **kwargs):
+            timed = Bybop_Metrics.enabled
+            if timed:
+                start = time.perf_counter_ns()
+            else:
+                start = 0
+            retries = kwargs.pop('retries', 5)
+            timeout = kwargs.pop('timeout', 0.15)
+            try:
+                cmd, buf, _ = packer(*args, **kwargs)
+            except Bybop_Commands.CommandError as e:
+                print('Bad command !' + str(e))
+                return Bybop_Network.NetworkStatus.ERROR
+            if timed:
+                Bybop_Metrics.observe_since('device_pack', start)
+            return device._send_packed(name, args, cmd, buf, start,
+                                       retries=retries, timeout=timeout)
+        send.__name__ = name.split('.')[-1]
+        send.__doc__ = 'Send %s to the device' % name
+        return send
+
+
 class Device(object):
     """
     Simple wrapper around ARNetwork + ARCommands.
@@ -213,9 +695,15 @@ class Device(object):
     proper initialization. It should not be used directly.
     """
 
+    # Whether the product supports the multisetting commands (e.g.
+    # 'generic..SetDroneSettings'), see send_settings
+    multisettings = False
+
     def __init__(self, ip, c2d_port, d2c_port,
                  ackBuffer=-1, nackBuffer=-1, urgBuffer=-1,
-                 cmdBuffers=[], skipCommonInit=False, verbose=False):
+                 cmdBuffers=[], skipCommonInit=False, verbose=False,
+                 recorder=None, netal=None, state_store=None, serial=None,
+                 socket_options=None):
         """
         Create and start a new Device.
 
@@ -231,20 +719,45 @@ class Device(object):
         - cmdBuffers : The buffers from the device which contains ARCommands
         - skipCommonInit : Skip the common init phase (only for SkyController)
         - verbose : Set verbose mode (prints sent/received commands)
+        - recorder : Frames recorder for all the network traffic of the device
+                     (see Bybop_Recorder.FrameRecorder)
+        - netal : An already created ARNetworkAL backend (see Network)
+        - state_store : A StateStore to preload the last state of the device,
+                        and save it after the initialization and on stop
+                        (default None)
+        - serial : The device serial number. If None, the state can not be
+                   preloaded, and the serial number sent by the device is used
+                   to save the state (default None)
+        - socket_options : Kernel buffers sizes and traffic marking of the
+                           network sockets (see
+                           Bybop_NetworkAL.SocketOptions, default None)
         """
         self._verbose = verbose
         inb = [i for i in (ackBuffer, nackBuffer, urgBuffer) if i > 0]
         outb = cmdBuffers
         self._network = Bybop_Network.Network(ip, c2d_port, d2c_port,
-                                              inb, outb, self)
+                                              inb, outb, self,
+                                              recorder=recorder,
+                                              netal=netal,
+                                              socket_options=socket_options)
         self._ackBuffer = ackBuffer
         self._nackBuffer = nackBuffer
         self._urgBuffer = urgBuffer
         self._cmdBuffers = cmdBuffers
         self._state = State()
+        self._cmd = None
+        self._piloting = None
+        self._command_limits = {}
+        self._throttled = {}
+        self._throttled_lock = threading.Lock()
+        self._state_store = state_store
+        self._serial = serial
+        if state_store is not None and serial is not None:
+            state_store.load(serial, self._state)
         if not skipCommonInit:
             self._common_init_product()
         self._init_product()
+        self.save_state()
 
     def data_received(self, buf, data):
         """
@@ -254,6 +767,9 @@ class Device(object):
         called directly by the application.
         """
         if buf in self._cmdBuffers:
+            timed = Bybop_Metrics.enabled
+            if timed:
+                start = time.perf_counter_ns()
             try:
                 dico, ok = Bybop_Commands.unpack_command(data)
                 if not ok:
@@ -261,6 +777,8 @@ class Device(object):
             except Bybop_Commands.CommandError as e:
                 print('Bad command !' + str(e))
                 return
+            if timed:
+                Bybop_Metrics.observe_since('commands_unpack', start)
 
             pr, cl, cmd = dico['proj'], dico['class'], dico['cmd']
 
@@ -310,6 +828,13 @@ class Device(object):
         else:
             return self._state
 
+    def get_network(self):
+        """
+        Get the Network of the device (e.g. for an
+        Bybop_Stream.ARStreamReceiver).
+        """
+        return self._network
+
     def get_battery(self):
         """
         Get the current battery percentage.
@@ -334,12 +859,27 @@ class Device(object):
         - retries : number of retries (default 5)
         - timeout : timeout (seconds) per try for acknowledgment (default 0.15)
         """
+        timed = Bybop_Metrics.enabled
+        if timed:
+            start = time.perf_counter_ns()
         try:
             pr, cl, cm = name.split('.')
             cmd, buf, _ = Bybop_Commands.pack_command(pr, cl, cm, *args)
         except Bybop_Commands.CommandError as e:
             print('Bad command !' + str(e))
             return Bybop_Network.NetworkStatus.ERROR
+        if timed:
+            Bybop_Metrics.observe_since('device_pack', start)
+        else:
+            start = 0
+        return self._send_packed(name, args, cmd, buf, start, **kwargs)
+
+    def _send_packed(self, name, args, cmd, buf, start, **kwargs):
+        """
+        Send a packed command, on the buffer matching its buffer type.
+
+        Return a NetworkStatus value.
+        """
         bufno = -1
         if buf == arsdkparser.ArCmdBufferType.NON_ACK:
             bufno = self._nackBuffer
@@ -359,14 +899,147 @@ class Device(object):
         timeout = kwargs['timeout'] if 'timeout' in kwargs else 0.15
 
         status = self._network.send_data(
-            bufno, cmd, datatype, timeout=timeout, tries=retries+1)
+            bufno, cmd, datatype, timeout=timeout, tries=retries+1,
+            limit=self._command_limits.get(name))
+        if status == Bybop_Network.NetworkStatus.THROTTLED:
+            with self._throttled_lock:
+                self._throttled[name] = self._throttled.get(name, 0) + 1
+        if start:
+            Bybop_Metrics.observe_since('device_send', start)
 
         if status == 0 and self._verbose:
-            print('Sent command %s.%s.%s with args %s' %
-                  (pr, cl, cm, str(args)))
+            print('Sent command %s with args %s' % (name, str(args)))
 
         return status
 
+    @property
+    def cmd(self):
+        """
+        Typed commands API.
+
+        The commands are attributes of this object, by project and class,
+        and are called with their arguments to be sent, e.g.
+        drone.cmd.ardrone3.Piloting.PCMD(1, 0, 10, 0, 0, 0). The retries and
+        timeout keyword arguments of send_data are supported, and the call
+        returns a NetworkStatus value.
+
+        The commands are packed by the module generated by Bybop_CodeGen
+        (generated on first use), without any name lookup. If the module can
+        not be generated (e.g. no writable cache directory), the commands are
+        packed by Bybop_Commands.pack_command.
+        """
+        if self._cmd is None:
+            try:
+                module = Bybop_CodeGen.load()
+            except (OSError, ImportError, SyntaxError) as e:
+                print('Can not load the generated commands (' + str(e) +
+                      '), using pack_command')
+                module = None
+            self._cmd = _CommandSender(self, module, '')
+        return self._cmd
+
+    def set_rate_limit(self, limit, command=None, buf=None):
+        """
+        Set (or remove, with None) a limit of the commands sent.
+
+        High priority commands (e.g. Emergency), acks and pongs are never
+        limited. Commands exceeding a limit are not sent, and send_data
+        returns NetworkStatus.THROTTLED.
+
+        Arguments:
+        - limit : A Bybop_Network.RateLimit, or None
+
+        Keyword arguments:
+        - command : The command to limit, in 'project.class.command'
+                    notation (default None)
+        - buf : The buffer to limit, if no command is given (default None,
+                meaning all the commands of the device)
+        """
+        if command is None:
+            self._network.set_rate_limit(limit, buf=buf)
+        elif limit is None:
+            self._command_limits.pop(command, None)
+        else:
+            self._command_limits[command] = limit
+
+    def get_throttled(self):
+        """
+        Get the number of throttled sends.
+
+        Return a dictionnary with the 'buffers' and 'commands' keys, each
+        one being a dictionnary of the throttled sends by buffer/command.
+        """
+        with self._throttled_lock:
+            commands = dict(self._throttled)
+        return {
+            'buffers': self._network.get_throttled(),
+            'commands': commands,
+        }
+
+    def get_socket_stats(self):
+        """
+        Get the network sockets statistics : actual kernel buffers sizes,
+        traffic marking, and datagrams dropped by the kernel (see
+        Bybop_NetworkAL.NetworkAL.get_socket_stats).
+
+        Return None if the network has no sockets (e.g. replays).
+        """
+        return self._network.get_socket_stats()
+
+    def send_settings(self, settings, batch=None, **kwargs):
+        """
+        Send many settings to the product, in as few messages as possible.
+
+        If the product supports the multisetting commands, the settings which
+        are members of a multisetting command (e.g.
+        'generic..SetDroneSettings') are sent together in one acknowledged
+        message. The other ones are sent one by one. Products without
+        multisetting support ignore these commands, so all the settings are
+        sent one by one to them.
+
+        Return the NetworkStatus of the first message which failed (all the
+        messages are sent anyway), or NetworkStatus.OK.
+
+        Arguments:
+        - settings : Dictionnary of the settings commands (in
+                     'project.class.command' notation), with a tuple or a
+                     dictionnary of arguments as values
+
+        Keyword arguments:
+        - batch : Send the multisetting members in multisetting commands
+                  (default None, if the product supports them, see the
+                  multisettings class attribute)
+
+        Other keyword arguments are given to send_data (retries, timeout)
+        """
+        OK = Bybop_Network.NetworkStatus.OK
+        if batch is None:
+            batch = self.multisettings
+        remaining = dict(settings)
+        statuses = []
+        multisettings = Bybop_Commands.multisetting_commands() if batch \
+            else ()
+        for name, multisetting in multisettings:
+            members = [n for n, _ in
+                       Bybop_Commands.multisetting_members(multisetting)]
+            batch = dict((n, remaining.pop(n)) for n in members
+                         if n in remaining)
+            if batch:
+                statuses.append(self.send_data(name, batch, **kwargs))
+        for name, args in remaining.items():
+            if isinstance(args, dict):
+                try:
+                    cmd = Bybop_Commands.find_command(
+                        *Bybop_Commands.command_ids(name))[1]
+                    args = [args[a.name] for a in cmd.args]
+                except (Bybop_Commands.CommandError, KeyError) as e:
+                    print('Bad command !' + str(e))
+                    statuses.append(Bybop_Network.NetworkStatus.ERROR)
+                    continue
+            statuses.append(self.send_data(name, *args, **kwargs))
+        # The NetworkStatus values are codes, not a severity scale
+        return next((st for st in statuses if st != OK), OK)
+
     def wait_answer(self, name, timeout=5.0):
         """
         Wait for an answer from the product.
@@ -394,24 +1067,101 @@ class Device(object):
         timeStr = time.strftime('T%H%M%S+0000', now)
         self.send_data('common.Common.CurrentDate', dateStr)
         self.send_data('common.Common.CurrentTime', timeStr)
-        self.send_data('common.Settings.AllSettings')
-        self.wait_answer('common.SettingsState.AllSettingsChanged')
-        self.send_data('common.Common.AllStates')
-        self.wait_answer('common.CommonState.AllStatesChanged')
+        self._request('common.Settings.AllSettings',
+                      'common.SettingsState.AllSettingsChanged')
+        self._request('common.Common.AllStates',
+                      'common.CommonState.AllStatesChanged')
+
+    def _request(self, name, answer, *args, **kwargs):
+        """
+        Send a command, and wait for its answer.
+
+        The answer is watched before sending the command, so a fast answer
+        can not be missed.
+
+        Return True if the answer was received, False otherwise.
+        """
+        timeout = kwargs.pop('answer_timeout', 5.0)
+        wid = self._state.watch(answer)
+        self.send_data(name, *args, **kwargs)
+        return self._state.wait_for(answer, timeout=timeout, watch_id=wid)
 
     def dump_state(self):
         print('Internal state :')
         self._state.dump()
 
     def stop(self):
+        self.stop_piloting()
+        self.save_state()
         self._network.stop()
 
+    def _start_piloting(self, send, neutral, **kwargs):
+        if self._piloting is None:
+            self._piloting = Bybop_Piloting.PilotingLoop(send, neutral,
+                                                         **kwargs)
+        return self._piloting
+
+    def get_piloting(self):
+        """
+        Get the running piloting loop (see start_piloting), or None.
+        """
+        return self._piloting
+
+    def stop_piloting(self):
+        """
+        Stop the piloting loop, if it is running.
+        """
+        piloting = self._piloting
+        self._piloting = None
+        if piloting is not None:
+            piloting.stop()
+
+    def get_serial(self):
+        """
+        Get the serial number of the device.
+
+        Return the serial number given to the constructor, or the one sent
+        by the device, or None if it is unknown.
+        """
+        if self._serial is not None:
+            return self._serial
+        high = self._state.get_value(
+            'common.SettingsState.ProductSerialHighChanged')
+        low = self._state.get_value(
+            'common.SettingsState.ProductSerialLowChanged')
+        if high is None or low is None:
+            return None
+        return high['high'] + low['low']
+
+    def save_state(self):
+        """
+        Save the device state in its StateStore.
+
+        Return True if the state was saved, False otherwise (no store, unknown
+        serial number or write error).
+        """
+        if self._state_store is None:
+            return False
+        serial = self.get_serial()
+        if serial is None:
+            return False
+        return self._state_store.save(serial, self._state)
+
     def set_verbose(self, verbose):
         self._verbose = verbose
 
+    def set_recorder(self, recorder):
+        """
+        Set (or remove, with None) the frames recorder of the device.
+
+        Arguments:
+        - recorder : The new recorder (see Bybop_Recorder.FrameRecorder)
+        """
+        self._network.set_recorder(recorder)
+
 
 class BebopDrone(Device):
-    def __init__(self, ip, c2d_port, d2c_port):
+    def __init__(self, ip, c2d_port, d2c_port, **kwargs):
         """
         Create and start a new BebopDrone device.
 
@@ -421,10 +1171,14 @@ class BebopDrone(Device):
         - ip : The product ip address
         - c2d_port : The remote port (on which we will send data)
         - d2c_port : The local port (on which we will read data)
+
+        Keyword arguments are given to the Device constructor (e.g. verbose,
+        recorder).
         """
         super(BebopDrone, self).__init__(ip, c2d_port, d2c_port,
                                          ackBuffer=11, nackBuffer=10,
-                                         urgBuffer=12, cmdBuffers=[127, 126])
+                                         urgBuffer=12, cmdBuffers=[127, 126],
+                                         **kwargs)
 
     def _init_product(self):
         # Deactivate video streaming
@@ -450,10 +1204,41 @@ class BebopDrone(Device):
         """
         self.send_data('ardrone3.Piloting.Emergency')
 
+    def start_piloting(self, **kwargs):
+        """
+        Start a loop sending the piloting setpoint (PCMD) at a fixed rate.
+
+        The setpoint is changed with the pilot function. This function has
+        no effect if the loop is already running.
+
+        Return the PilotingLoop.
+
+        Keyword arguments are given to the Bybop_Piloting.PilotingLoop
+        constructor (rate, policy, stale_timeout).
+        """
+        return self._start_piloting(_ardrone3_pcmd_sender(self), (0, 0, 0, 0),
+                                    **kwargs)
+
+    def pilot(self, roll, pitch, yaw, gaz):
+        """
+        Set the setpoint of the piloting loop (see start_piloting).
+
+        Arguments:
+        - roll : Roll angle [-100; 100], in percentage of the max tilt
+        - pitch : Pitch angle [-100; 100], in percentage of the max tilt
+        - yaw : Yaw rotation speed [-100; 100], in percentage of the max
+                rotation speed
+        - gaz : Vertical speed [-100; 100], in percentage of the max vertical
+                speed
+        """
+        if self._piloting is not None:
+            self._piloting.set(roll, pitch, yaw, gaz)
+
     def start_streaming(self):
         """
-        Starts the video streaming (it can be recieved by an external RTP
-        client on port 55004(rtp)/55005(rtcp).
+        Starts the video streaming (it can be recieved by a
+        Bybop_Stream.StreamReceiver, or an external RTP client, on the ports
+        given to the connection, 55004(rtp)/55005(rtcp) by default).
         """
         self.send_data('ardrone3.MediaStreaming.VideoEnable', 1)
 
@@ -465,7 +1250,9 @@ class BebopDrone(Device):
 
 
 class Anafi(Device):
-    def __init__(self, ip, c2d_port, d2c_port):
+    multisettings = True
+
+    def __init__(self, ip, c2d_port, d2c_port, **kwargs):
         """
         Create and start a new Anafi device.
 
@@ -475,10 +1262,14 @@ class Anafi(Device):
         - ip : The product ip address
         - c2d_port : The remote port (on which we will send data)
         - d2c_port : The local port (on which we will read data)
+
+        Keyword arguments are given to the Device constructor (e.g. verbose,
+        recorder).
         """
         super(Anafi, self).__init__(ip, c2d_port, d2c_port,
                                     ackBuffer=11, nackBuffer=10,
-                                    urgBuffer=12, cmdBuffers=[127, 126])
+                                    urgBuffer=12, cmdBuffers=[127, 126],
+                                    **kwargs)
 
     def _init_product(self):
         pass
@@ -503,9 +1294,39 @@ class Anafi(Device):
         """
         self.send_data('ardrone3.Piloting.Emergency')
 
+    def start_piloting(self, **kwargs):
+        """
+        Start a loop sending the piloting setpoint (PCMD) at a fixed rate.
+
+        The setpoint is changed with the pilot function. This function has
+        no effect if the loop is already running.
+
+        Return the PilotingLoop.
+
+        Keyword arguments are given to the Bybop_Piloting.PilotingLoop
+        constructor (rate, policy, stale_timeout).
+        """
+        return self._start_piloting(_ardrone3_pcmd_sender(self), (0, 0, 0, 0),
+                                    **kwargs)
+
+    def pilot(self, roll, pitch, yaw, gaz):
+        """
+        Set the setpoint of the piloting loop (see start_piloting).
+
+        Arguments:
+        - roll : Roll angle [-100; 100], in percentage of the max tilt
+        - pitch : Pitch angle [-100; 100], in percentage of the max tilt
+        - yaw : Yaw rotation speed [-100; 100], in percentage of the max
+                rotation speed
+        - gaz : Vertical speed [-100; 100], in percentage of the max vertical
+                speed
+        """
+        if self._piloting is not None:
+            self._piloting.set(roll, pitch, yaw, gaz)
+
 
 class JumpingSumo(Device):
-    def __init__(self, ip, c2d_port, d2c_port):
+    def __init__(self, ip, c2d_port, d2c_port, **kwargs):
         """
         Create and start a new JumpingSumo device.
 
@@ -515,14 +1336,83 @@ class JumpingSumo(Device):
         - ip : The product ip address
         - c2d_port : The remote port (on which we will send data)
         - d2c_port : The local port (on which we will read data)
+
+        Keyword arguments are given to the Device constructor (e.g. verbose,
+        recorder).
         """
         super(JumpingSumo, self).__init__(ip, c2d_port, d2c_port,
                                           ackBuffer=11, nackBuffer=10,
-                                          cmdBuffers=[127, 126])
+                                          cmdBuffers=[127, 126],
+                                          **kwargs)
 
     def _init_product(self):
         # Deactivate video streaming
         self.send_data('jpsumo.MediaStreaming.VideoEnable', 0)
+        self._stream = None
+
+    def start_streaming(self, listener, **kwargs):
+        """
+        Starts the video streaming, received by an ARStreamReceiver (see
+        Bybop_Stream).
+
+        Return the receiver.
+
+        Arguments:
+        - listener : A listener which will have its frame_received function
+                     called for each (JPEG) frame
+
+        Keyword arguments are given to the ARStreamReceiver constructor (e.g.
+        fragment_size).
+        """
+        if self._stream is None:
+            self._stream = Bybop_Stream.ARStreamReceiver(self._network,
+                                                         listener, **kwargs)
+        self.send_data('jpsumo.MediaStreaming.VideoEnable', 1)
+        return self._stream
+
+    def stop_streaming(self):
+        """
+        Stops the video streaming.
+        """
+        self.send_data('jpsumo.MediaStreaming.VideoEnable', 0)
+        if self._stream is not None:
+            self._stream.stop()
+            self._stream = None
+
+    def stop(self):
+        if self._stream is not None:
+            self.stop_streaming()
+        super(JumpingSumo, self).stop()
+
+    def start_piloting(self, **kwargs):
+        """
+        Start a loop sending the piloting setpoint (PCMD) at a fixed rate.
+
+        The setpoint is changed with the pilot function. This function has
+        no effect if the loop is already running.
+
+        Return the PilotingLoop.
+
+        Keyword arguments are given to the Bybop_Piloting.PilotingLoop
+        constructor (rate, policy, stale_timeout).
+        """
+        pcmd = self.cmd.jpsumo.Piloting.PCMD
+
+        def send(setpoint, tick):
+            speed, turn = setpoint
+            pcmd(1 if speed or turn else 0, speed, turn)
+        return self._start_piloting(send, (0, 0), **kwargs)
+
+    def pilot(self, speed, turn):
+        """
+        Set the setpoint of the piloting loop (see start_piloting).
+
+        Arguments:
+        - speed : Speed [-100; 100], in percentage of the max speed
+        - turn : Turn speed [-100; 100], in percentage of the max turn speed
+        """
+        if self._piloting is not None:
+            self._piloting.set(speed, turn)
 
     def change_posture(self, posture):
         """
@@ -564,7 +1454,7 @@ class JumpingSumo(Device):
 
 
 class SkyController(Device):
-    def __init__(self, ip, c2d_port, d2c_port):
+    def __init__(self, ip, c2d_port, d2c_port, **kwargs):
         """
         Create and start a new SkyController device.
 
@@ -574,12 +1464,16 @@ class SkyController(Device):
         - ip : The product ip address
         - c2d_port : The remote port (on which we will send data)
         - d2c_port : The local port (on which we will read data)
+
+        Keyword arguments are given to the Device constructor (e.g. verbose,
+        recorder).
         """
         super(SkyController, self).__init__(ip, c2d_port, d2c_port,
                                             ackBuffer=11, nackBuffer=10,
                                             urgBuffer=12,
                                             cmdBuffers=[127, 126],
-                                            skipCommonInit=True)
+                                            skipCommonInit=True,
+                                            **kwargs)
 
     def _init_product(self):
         self.send_data('skyctrl.Settings.AllSettings')
@@ -589,7 +1483,7 @@ class SkyController(Device):
 
 
 class Mambo(Device):
-    def __init__(self, ip, c2d_port, d2c_port):
+    def __init__(self, ip, c2d_port, d2c_port, **kwargs):
         """
         Create and start a new Mambo device.
 
@@ -599,16 +1493,54 @@ class Mambo(Device):
         - ip : The product ip address
         - c2d_port : The remote port (on which we will send data)
         - d2c_port : The local port (on which we will read data)
+
+        Keyword arguments are given to the Device constructor (e.g. verbose,
+        recorder).
         """
         super(Mambo, self).__init__(ip, c2d_port, d2c_port,
                                     ackBuffer=11, nackBuffer=10,
-                                    cmdBuffers=[127, 126])
+                                    cmdBuffers=[127, 126],
+                                    **kwargs)
 
     def _init_product(self):
         pass
 
 
-def create_and_connect(device, d2c_port, controller_type, controller_name):
+def _ardrone3_pcmd_sender(device):
+    pcmd = device.cmd.ardrone3.Piloting.PCMD
+
+    def send(setpoint, tick):
+        roll, pitch, yaw, gaz = setpoint
+        # Sequence number in the high 8 bits, timestamp (ms) in the low 24
+        stamp = ((tick & 0xff) << 24) | \
+            (int(time.monotonic() * 1000) & 0xffffff)
+        pcmd(1 if roll or pitch else 0, roll, pitch, yaw, gaz, stamp)
+    return send
+
+
+def create_and_connect(device, d2c_port, controller_type, controller_name,
+                       **kwargs):
+    """
+    Connect to a device found by a Discovery, and create the matching Device.
+
+    Return None if the connection failed, or the device is unknown.
+
+    Arguments:
+    - device : The device (as returned by Discovery.get_devices)
+    - d2c_port : The local port (on which we will read data)
+    - controller_type : The type of the controller (phone/tablet/pc ...)
+    - controllar_name : The name of the controller (app package ...)
+
+    Keyword arguments:
+    - stream_port : The local port of the video stream (RTP, default 55004)
+    - control_port : The local port of the video stream control (RTCP,
+                     default 55005)
+
+    Other keyword arguments are given to the Device constructor (e.g.
+    verbose, recorder).
+    """
+    stream_port = kwargs.pop('stream_port', 55004)
+    control_port = kwargs.pop('control_port', 55005)
     device_id = Bybop_Discovery.get_device_id(device)
     ip = Bybop_Discovery.get_ip(device)
     port = Bybop_Discovery.get_port(device)
@@ -617,7 +1549,9 @@ def create_and_connect(device, d2c_port, controller_type, controller_name):
         return None
 
     connection = Bybop_Connection.Connection(ip, port)
-    answer = connection.connect(d2c_port, controller_type, controller_name)
+    answer = connection.connect(d2c_port, controller_type, controller_name,
+                                stream_port=stream_port,
+                                control_port=control_port)
     if not answer:
         print('Unable to connect')
         return None
@@ -628,13 +1562,13 @@ def create_and_connect(device, d2c_port, controller_type, controller_name):
     c2d_port = answer['c2d_port']
 
     if device_id in DeviceID.BEBOP_FAMILY:
-        return BebopDrone(ip, c2d_port, d2c_port)
+        return BebopDrone(ip, c2d_port, d2c_port, **kwargs)
     elif device_id in DeviceID.JUMPING_FAMILY:
-        return JumpingSumo(ip, c2d_port, d2c_port)
+        return JumpingSumo(ip, c2d_port, d2c_port, **kwargs)
     elif device_id in DeviceID.REMOTES:
-        return SkyController(ip, c2d_port, d2c_port)
+        return SkyController(ip, c2d_port, d2c_port, **kwargs)
     elif device_id in DeviceID.MAMBO_FAMILY:
-        return Mambo(ip, c2d_port, d2c_port)
+        return Mambo(ip, c2d_port, d2c_port, **kwargs)
     elif device_id in DeviceID.ANAFI_FAMILY:
-        return Anafi(ip, c2d_port, d2c_port)
+        return Anafi(ip, c2d_port, d2c_port, **kwargs)
     return None
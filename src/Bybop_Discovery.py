@@ -2,8 +2,12 @@
 # as its MDNS implementation
 
 from zeroconf import ServiceBrowser, Zeroconf
+import concurrent.futures
+import json
+import os
 import socket
 import threading
+import time
 
 
 class DeviceID(object):
@@ -63,18 +67,47 @@ class Discovery(object):
     here to provide a fully working sample code.
     """
 
-    def __init__(self, deviceId):
+    def __init__(self, deviceId, cache=None, max_workers=8,
+                 resolve_timeout=3.0, resolve_tries=3):
         """
         Create and start a researcher for devices on network.
 
+        If a cache is given, the non-expired devices of the cache are
+        immediately available through get_devices, and are replaced by the
+        live MDNS answers as soon as they arrive.
+
+        The services found are resolved by a pool of worker threads, so a
+        slow (or dead) device does not delay the resolution of the others.
+
         Arguments:
         - deviceId : List of deviceIds (strings) to search.
+
+        Keyword arguments:
+        - cache : A DiscoveryCache instance (default None)
+        - max_workers : Maximum number of services resolved at the same time
+                        (default 8)
+        - resolve_timeout : Timeout, in floating point seconds, of each
+                            resolution try (default 3.0)
+        - resolve_tries : Total number of tries before giving up on a service
+                          (default 3)
         """
-        self._zeroconf = Zeroconf()
-        self._browser = []
         self._services = {}
+        self._cached = set()
+        self._cache = cache
+        self._pending = {}
+        self._generation = 0
+        self._stopped = False
+        self._resolve_timeout = resolve_timeout
+        self._resolve_tries = max(int(resolve_tries), 1)
         self._lock = threading.RLock()
         self._cond = threading.Condition(self._lock)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers)
+        if self._cache is not None:
+            self._services.update(self._cache.get_devices(deviceId))
+            self._cached.update(self._services)
+        self._zeroconf = Zeroconf()
+        self._browser = []
         for did in deviceId:
             self._browser.append(ServiceBrowser(self._zeroconf, '_arsdk-' +
                                                 str(did) + '._udp.local.',
@@ -87,12 +120,33 @@ class Discovery(object):
         When stopped, this object can not be restarted
         """
         with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._pending.clear()
             self._cond.notify_all()
+        self._executor.shutdown(wait=False)
         self._zeroconf.close()
+        if self._cache is not None:
+            self._cache.save()
 
     def get_devices(self):
         """ Get the current list of devices """
-        return dict(self._services)
+        with self._lock:
+            return dict(self._services)
+
+    def is_cached(self, name):
+        """
+        Check whether a device only comes from the cache.
+
+        Return True if the device was loaded from the cache and was not (yet)
+        revalidated by a MDNS answer.
+
+        Arguments:
+        - name : The name of the device (key of the get_devices dictionnary)
+        """
+        with self._lock:
+            return name in self._cached
 
     def wait_for_change(self, timeout=None):
         """
@@ -110,19 +164,289 @@ class Discovery(object):
 
     def remove_service(self, zeroconf, type, name):
         """ Internal function for zeroconf.ServiceBrowser. """
-        if name in self._services:
-            del self._services[name]
-            self._signal_change()
+        with self._lock:
+            # Forget any pending resolution of this service
+            self._pending.pop(name, None)
+            if name in self._services:
+                del self._services[name]
+                self._cached.discard(name)
+                # The cache entry is kept (until its ttl), as devices often
+                # briefly disappear from MDNS
+                self._signal_change()
 
     def add_service(self, zeroconf, type, name):
         """ Internal function for zeroconf.ServiceBrowser. """
-        info = zeroconf.get_service_info(type, name)
-        if info is not None:
+        with self._lock:
+            if self._stopped:
+                return
+            self._generation += 1
+            generation = self._generation
+            self._pending[name] = generation
+        try:
+            self._executor.submit(self._resolve, zeroconf, type, name,
+                                  generation)
+        except RuntimeError:
+            # Executor shut down by a concurrent stop()
+            pass
+
+    def update_service(self, zeroconf, type, name):
+        """ Internal function for zeroconf.ServiceBrowser. """
+        self.add_service(zeroconf, type, name)
+
+    def _is_current(self, name, generation):
+        return not self._stopped and self._pending.get(name) == generation
+
+    def _resolve(self, zeroconf, type, name, generation):
+        timeout_ms = int(self._resolve_timeout * 1000)
+        info = None
+        for _ in range(self._resolve_tries):
+            with self._lock:
+                if not self._is_current(name, generation):
+                    return
+            try:
+                info = zeroconf.get_service_info(type, name,
+                                                 timeout=timeout_ms)
+            except Exception as e:
+                print('Error while resolving ' + name + ' : ' + str(e))
+                info = None
+            if info is not None:
+                break
+
+        with self._lock:
+            if not self._is_current(name, generation):
+                return
+            del self._pending[name]
+            if info is None:
+                print('Found a service without info : ' + name +
+                      '. Ignoring it !')
+                return
             self._services[name] = info
+            self._cached.discard(name)
+            if self._cache is not None:
+                self._cache.update(info)
             self._signal_change()
-        else:
-            print('Found a service witout info : ' + name + '. Stopping !')
-            self.stop()
+
+
+class CachedDevice(object):
+    """
+    A device loaded from a DiscoveryCache.
+
+    This object provides the same attributes as the zeroconf ServiceInfo
+    used by the module functions (get_name, get_ip ...), so it can be used
+    anywhere a device returned by a Discovery is expected.
+    """
+
+    def __init__(self, name, type, ip, port, last_seen):
+        self.name = name
+        self.type = type
+        self.address = socket.inet_aton(ip)
+        self.port = int(port)
+        self.last_seen = last_seen
+
+
+class DiscoveryCache(object):
+    """
+    Persistent cache of discovered ARSDK devices.
+
+    Each entry saves the name, device id, ip, port and last time a device was
+    seen on the network. Entries older than the cache ttl are ignored.
+
+    The cache is saved on disk as a json file. This class use an internal lock
+    to allow concurrent access from the Discovery threads.
+    """
+
+    def __init__(self, path=None, ttl=24 * 3600.0):
+        """
+        Create a new cache, and load its content from the disk.
+
+        Keyword arguments:
+        - path : Path of the cache file
+                 (default ~/.cache/bybop/discovery.json)
+        - ttl : Time to live of the entries, in floating point seconds
+                (default 24 hours)
+        """
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.cache', 'bybop',
+                                'discovery.json')
+        self._path = path
+        self._ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'revalidated': 0,
+        }
+        self.load()
+
+    def load(self):
+        """
+        Load the cache from the disk.
+
+        A missing or corrupted cache file is treated as an empty cache.
+        """
+        try:
+            with open(self._path, 'r') as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            entries = {}
+        if not isinstance(entries, dict):
+            entries = {}
+        entries = dict((name, entry) for name, entry in entries.items()
+                       if _valid_entry(name, entry))
+        with self._lock:
+            self._entries = entries
+
+    def save(self):
+        """
+        Save the cache to the disk.
+
+        Return True if the cache was saved, False otherwise.
+        """
+        with self._lock:
+            content = json.dumps(self._entries, indent=1, sort_keys=True)
+        tmp_path = self._path + '.tmp'
+        try:
+            dirname = os.path.dirname(self._path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(tmp_path, 'w') as f:
+                f.write(content)
+            os.replace(tmp_path, self._path)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def update(self, device):
+        """
+        Add or refresh the entry of a device.
+
+        Arguments:
+        - device : The device (as returned by Discovery.get_devices)
+        """
+        name = device.name
+        with self._lock:
+            if name in self._entries:
+                self._stats['revalidated'] += 1
+            self._entries[name] = {
+                'name': name,
+                'type': device.type,
+                'device_id': get_device_id(device),
+                'ip': get_ip(device),
+                'port': device.port,
+                'last_seen': time.time(),
+            }
+
+    def remove(self, name):
+        """
+        Remove the entry of a device, if present.
+
+        Arguments:
+        - name : The name of the device
+        """
+        with self._lock:
+            self._entries.pop(name, None)
+
+    def _get_entry(self, name, now):
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+        try:
+            if now - entry['last_seen'] > self._ttl:
+                self._stats['expired'] += 1
+                del self._entries[name]
+                return None
+            return CachedDevice(entry['name'], entry['type'], entry['ip'],
+                                entry['port'], entry['last_seen'])
+        except (KeyError, TypeError, ValueError, OSError):
+            # Malformed entry, forget it
+            del self._entries[name]
+            return None
+
+    def get(self, name):
+        """
+        Get a device from the cache.
+
+        Return a CachedDevice, or None if the device is not in the cache, or
+        if its entry is expired.
+
+        Arguments:
+        - name : The name of the device
+        """
+        with self._lock:
+            device = self._get_entry(name, time.time())
+            if device is None:
+                self._stats['misses'] += 1
+            else:
+                self._stats['hits'] += 1
+        return device
+
+    def get_devices(self, deviceId=None):
+        """
+        Get the non-expired devices of the cache.
+
+        Return a dictionnary of CachedDevice, indexed by their name (same
+        format as Discovery.get_devices).
+
+        Keyword arguments:
+        - deviceId : List of deviceIds (strings) to return (default None,
+                     meaning all devices)
+        """
+        ret = {}
+        now = time.time()
+        with self._lock:
+            for name in list(self._entries):
+                entry = self._entries[name]
+                if deviceId is not None and \
+                        entry.get('device_id') not in deviceId:
+                    continue
+                device = self._get_entry(name, now)
+                if device is not None:
+                    ret[name] = device
+            if ret:
+                self._stats['hits'] += 1
+            else:
+                self._stats['misses'] += 1
+        return ret
+
+    def get_stats(self):
+        """
+        Get the cache statistics.
+
+        Return a dictionnary with the following keys:
+        - hits : Number of lookups (get/get_devices) which found at least
+                 one valid device
+        - misses : Number of lookups which found no valid device
+        - expired : Number of entries dropped because of their age
+        - revalidated : Number of entries refreshed by a MDNS answer
+        - entries : Current number of entries
+        """
+        with self._lock:
+            ret = dict(self._stats)
+            ret['entries'] = len(self._entries)
+        return ret
+
+
+def _valid_entry(name, entry):
+    """
+    Check a cache entry loaded from the disk (the file may have been edited
+    or corrupted).
+
+    Arguments:
+    - name : The entry key
+    - entry : The entry
+    """
+    if not isinstance(entry, dict) or entry.get('name') != name:
+        return False
+    try:
+        socket.inet_aton(entry['ip'])
+        return (isinstance(entry['type'], str) and
+                isinstance(entry.get('device_id'), (str, type(None))) and
+                isinstance(entry['port'], int) and
+                isinstance(entry['last_seen'], (int, float)))
+    except (KeyError, TypeError, OSError):
+        return False
 
 
 def get_name(device):
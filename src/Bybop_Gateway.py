@@ -0,0 +1,524 @@
+import collections
+import fnmatch
+import os
+import socket
+import struct
+import threading
+
+import Bybop_Commands
+import Bybop_Device
+import Bybop_Network
+import arsdkparser
+
+
+# Gateway protocol : each message is a header (payload size, message type)
+# followed by the payload.
+_header = struct.Struct('<IB')
+_request = struct.Struct('<I')
+_result = struct.Struct('<IB')
+
+# Maximum accepted payload size
+_MAX_PAYLOAD = 64 * 1024
+
+
+class MessageType:
+    # Client to gateway
+    SUBSCRIBE = 1      # payload : pattern (utf-8)
+    UNSUBSCRIBE = 2    # payload : pattern (utf-8)
+    COMMAND = 3        # payload : request id (u32) + packed ARCommand
+    # Gateway to client
+    RESULT = 4         # payload : request id (u32) + NetworkStatus (u8)
+    UPDATE = 5         # payload : packed ARCommand
+    OVERFLOW = 6       # payload : number of dropped updates (u32)
+
+
+class QueuePolicy:
+    # Keep only the last update of each command (the last one of each key for
+    # map commands). List commands updates are never coalesced.
+    COALESCE = 0
+    # Keep all updates, drop the oldest ones when the queue is full
+    DROP = 1
+
+
+def _send_message(sock, type, payload=b''):
+    sock.sendall(_header.pack(len(payload), type) + payload)
+
+
+def _recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _recv_message(sock):
+    """ Return a (type, payload) tuple, or None if the peer disconnected """
+    header = _recv_exact(sock, _header.size)
+    if header is None:
+        return None
+    size, type = _header.unpack(header)
+    if size > _MAX_PAYLOAD:
+        return None
+    payload = _recv_exact(sock, size) if size else b''
+    if payload is None:
+        return None
+    return type, payload
+
+
+def _pack_update(name, args):
+    pr, cl, cmd = name.split('.')
+    return Bybop_Commands.pack_command(pr, cl, cmd, *args.values())[0]
+
+
+class _Client(object):
+    """ A client connected to the gateway """
+
+    def __init__(self, gateway, sock, queue_size, policy):
+        self._gateway = gateway
+        self._sock = sock
+        self._queue_size = queue_size
+        self._policy = policy
+        self._patterns = set()
+        self._matches = {}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._queue = collections.OrderedDict()
+        self._results = []
+        self._seq = 0
+        self._dropped = 0
+        self._alive = True
+        self._reader = threading.Thread(target=self._read_loop)
+        self._reader.daemon = True
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.daemon = True
+        self._reader.start()
+        self._writer.start()
+
+    def close(self):
+        with self._lock:
+            self._alive = False
+            self._cond.notify()
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+            pass
+
+    def matches(self, name):
+        # Called with the client lock held
+        ret = self._matches.get(name)
+        if ret is None:
+            ret = any(fnmatch.fnmatchcase(name, p) for p in self._patterns)
+            self._matches[name] = ret
+        return ret
+
+    def push(self, name, args, listtype, key):
+        """ Queue an update, never blocks on the client socket """
+        with self._lock:
+            if not self._alive or not self.matches(name):
+                return
+            if self._policy == QueuePolicy.COALESCE and listtype != 'LIST':
+                qkey = (name, key) if listtype == 'MAP' else (name,)
+                self._queue.pop(qkey, None)
+            else:
+                qkey = (name, self._seq)
+                self._seq += 1
+            self._queue[qkey] = (name, args)
+            if len(self._queue) > self._queue_size:
+                self._queue.popitem(last=False)
+                self._dropped += 1
+            self._cond.notify()
+
+    def _send_current(self, pattern):
+        """ Queue the current value of the commands matching a pattern """
+        state = self._gateway.get_device().get_state(copy=True)
+        for pr, pr_d in state.items():
+            for cl, cl_d in pr_d.items():
+                for cmd, value in cl_d.items():
+                    name = '%s.%s.%s' % (pr, cl, cmd)
+                    if not fnmatch.fnmatchcase(name, pattern):
+                        continue
+                    listtype = self._gateway.get_listtype(name)
+                    if listtype == 'LIST':
+                        for args in value:
+                            self.push(name, args, listtype, None)
+                    elif listtype == 'MAP':
+                        for key, args in value.items():
+                            self.push(name, args, listtype, key)
+                    else:
+                        self.push(name, value, listtype, None)
+
+    def _read_loop(self):
+        while self._alive:
+            try:
+                msg = _recv_message(self._sock)
+            except (socket.error, OSError):
+                msg = None
+            if msg is None:
+                break
+            type, payload = msg
+            if type == MessageType.SUBSCRIBE:
+                pattern = str(payload, 'utf-8')
+                with self._lock:
+                    self._patterns.add(pattern)
+                    self._matches = {}
+                self._send_current(pattern)
+            elif type == MessageType.UNSUBSCRIBE:
+                with self._lock:
+                    self._patterns.discard(str(payload, 'utf-8'))
+                    self._matches = {}
+            elif type == MessageType.COMMAND and \
+                    len(payload) >= _request.size:
+                reqid = _request.unpack_from(payload)[0]
+                status = self._gateway.send_command(payload[_request.size:])
+                self._send_result(reqid, status)
+        self._gateway.remove_client(self)
+        self.close()
+
+    def _send_result(self, reqid, status):
+        # Results are never dropped, and bypass the updates queue
+        with self._lock:
+            self._results.append(_result.pack(reqid, status))
+            self._cond.notify()
+
+    def _write_loop(self):
+        while True:
+            with self._lock:
+                while self._alive and not self._queue and \
+                        not self._results and not self._dropped:
+                    self._cond.wait()
+                if not self._alive:
+                    break
+                dropped = self._dropped
+                self._dropped = 0
+                results = self._results
+                self._results = []
+                items = list(self._queue.values())
+                self._queue.clear()
+            try:
+                for result in results:
+                    _send_message(self._sock, MessageType.RESULT, result)
+                if dropped:
+                    _send_message(self._sock, MessageType.OVERFLOW,
+                                  _request.pack(dropped))
+                for name, args in items:
+                    try:
+                        payload = _pack_update(name, args)
+                    except (Bybop_Commands.CommandError, ValueError):
+                        continue
+                    _send_message(self._sock, MessageType.UPDATE, payload)
+            except (socket.error, OSError):
+                break
+        self._sock.close()
+
+
+class Gateway(object):
+    """
+    Local gateway sharing one device connection between many processes.
+
+    The gateway owns the Device, and serves local clients (see
+    GatewayClient) over a Unix socket. Clients subscribe to state updates
+    with fnmatch patterns on the command names ('ardrone3.PilotingState.*',
+    '*.BatteryStateChanged' ...), and receive the matching updates as packed
+    ARCommands. Their commands are sent to the device with Device.send_data.
+
+    Each client has its own bounded queue, filled by the device network
+    thread without ever blocking, and emptied by a writer thread. A slow
+    client will see its backlog coalesced (only the last value of each
+    command is kept) or dropped, without slowing down the device connection
+    or the other clients.
+    """
+
+    def __init__(self, device, path, queue_size=1024,
+                 policy=QueuePolicy.COALESCE):
+        """
+        Create and start a new gateway.
+
+        Arguments:
+        - device : The connected Device
+        - path : The path of the Unix socket
+
+        Keyword arguments:
+        - queue_size : Maximum number of queued updates per client (default
+                       1024)
+        - policy : The QueuePolicy of the clients queues (default COALESCE)
+        """
+        self._device = device
+        self._path = path
+        self._queue_size = queue_size
+        self._policy = policy
+        self._clients = []
+        self._lock = threading.Lock()
+        self._listtypes = {}
+        self._alive = True
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen(16)
+        self._server.settimeout(0.5)
+
+        device.get_state(copy=False).add_observer(self._state_updated)
+        self._thread = threading.Thread(target=self._accept_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def get_device(self):
+        """ Get the device of the gateway """
+        return self._device
+
+    def get_clients_count(self):
+        """ Get the number of connected clients """
+        with self._lock:
+            return len(self._clients)
+
+    def stop(self):
+        """
+        Stop the gateway, and disconnect all the clients.
+
+        The device is not stopped.
+        """
+        self._device.get_state(copy=False).remove_observer(
+            self._state_updated)
+        self._alive = False
+        self._thread.join()
+        with self._lock:
+            clients = list(self._clients)
+            self._clients = []
+        for client in clients:
+            client.close()
+        self._server.close()
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+    def remove_client(self, client):
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+
+    def send_command(self, packed):
+        """
+        Send a packed command from a client to the device.
+
+        Return a NetworkStatus value.
+        """
+        try:
+            dico, ok = Bybop_Commands.unpack_command(packed)
+        except Bybop_Commands.CommandError:
+            ok = False
+        if not ok:
+            return Bybop_Network.NetworkStatus.ERROR
+        return self._device.send_data(dico['name'], *dico['args'].values())
+
+    def get_listtype(self, name):
+        """ Get the list type ('NONE', 'LIST' or 'MAP') of a command """
+        ret = self._listtypes.get(name)
+        if ret is None:
+            try:
+                ids = Bybop_Commands.command_ids(name)
+                cmd = Bybop_Commands.find_command(*ids)[1]
+                ret = arsdkparser.ArCmdListType.TO_STRING[cmd.listType]
+            except Bybop_Commands.CommandError:
+                ret = 'NONE'
+            self._listtypes[name] = ret
+        return ret
+
+    def _state_updated(self, name, args):
+        listtype = self.get_listtype(name)
+        key = next(iter(args.values()), None) if listtype == 'MAP' else None
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            client.push(name, args, listtype, key)
+
+    def _accept_loop(self):
+        while self._alive:
+            try:
+                sock, _ = self._server.accept()
+            except socket.timeout:
+                continue
+            except (socket.error, OSError):
+                break
+            sock.settimeout(None)
+            client = _Client(self, sock, self._queue_size, self._policy)
+            with self._lock:
+                self._clients.append(client)
+
+
+class GatewayClient(object):
+    """
+    Client of a Gateway.
+
+    The client receives the state updates of its subscriptions, and keeps
+    them in its own State, so it can be used like a Device : get_state,
+    wait_answer, send_data ...
+    """
+
+    def __init__(self, path, listener=None):
+        """
+        Connect to a gateway.
+
+        Arguments:
+        - path : The path of the gateway Unix socket
+
+        Keyword arguments:
+        - listener : A function called, from the client thread, with the
+                     dictionnary of each update (see
+                     Bybop_Commands.unpack_command) (default None)
+        """
+        self._state = Bybop_Device.State()
+        self._listener = listener
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._results = {}
+        self._reqid = 0
+        self._dropped = 0
+        self._alive = True
+        self._thread = threading.Thread(target=self._read_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """ Disconnect from the gateway """
+        self._alive = False
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+            pass
+        self._thread.join()
+        self._sock.close()
+
+    def _send(self, type, payload):
+        with self._send_lock:
+            _send_message(self._sock, type, payload)
+
+    def subscribe(self, pattern):
+        """
+        Subscribe to the updates of the commands matching a pattern.
+
+        The current values of the matching commands are sent first.
+
+        Arguments:
+        - pattern : A fnmatch pattern on the 'project.class.command' names
+        """
+        self._send(MessageType.SUBSCRIBE, bytes(pattern, 'utf-8'))
+
+    def unsubscribe(self, pattern):
+        """
+        Remove a subscription.
+
+        Arguments:
+        - pattern : The pattern given to subscribe
+        """
+        self._send(MessageType.UNSUBSCRIBE, bytes(pattern, 'utf-8'))
+
+    def send_data(self, name, *args, **kwargs):
+        """
+        Send a command to the device, through the gateway.
+
+        Return a NetworkStatus value.
+
+        Arguments:
+        - name : The command to send, in 'project.class.command' notation
+        - *args : arguments to the command
+
+        Keyword arguments:
+        - timeout : Maximum time, in floating point seconds, to wait for the
+                    gateway answer (default 5.0)
+        """
+        timeout = kwargs.get('timeout', 5.0)
+        try:
+            pr, cl, cm = name.split('.')
+            cmd, _, _ = Bybop_Commands.pack_command(pr, cl, cm, *args)
+        except (Bybop_Commands.CommandError, ValueError) as e:
+            print('Bad command !' + str(e))
+            return Bybop_Network.NetworkStatus.ERROR
+        event = threading.Event()
+        with self._lock:
+            reqid = self._reqid
+            self._reqid = (self._reqid + 1) % (1 << 32)
+            self._results[reqid] = [event, None]
+        try:
+            self._send(MessageType.COMMAND, _request.pack(reqid) + cmd)
+        except (socket.error, OSError):
+            with self._lock:
+                del self._results[reqid]
+            return Bybop_Network.NetworkStatus.ERROR
+        event.wait(timeout)
+        with self._lock:
+            status = self._results.pop(reqid)[1]
+        if status is None:
+            return Bybop_Network.NetworkStatus.TIMEOUT
+        return status
+
+    def get_state(self, copy=True):
+        """
+        Get the mirrored state (see Device.get_state).
+
+        Keyword arguments:
+        - copy : Return a copy of the state (default True)
+        """
+        if copy:
+            return self._state.duplicate()
+        return self._state
+
+    def wait_answer(self, name, timeout=5.0):
+        """
+        Wait for an update of a command (see Device.wait_answer).
+
+        Arguments:
+        - name : The command to wait, in 'project.class.command' notation
+
+        Keyword arguments:
+        - timeout : Maximum time (floating point seconds) to wait (default 5.0)
+        """
+        return self._state.wait_for(name, timeout=timeout)
+
+    def get_dropped(self):
+        """ Get the number of updates dropped by the gateway for this client """
+        return self._dropped
+
+    def _read_loop(self):
+        while self._alive:
+            try:
+                msg = _recv_message(self._sock)
+            except (socket.error, OSError):
+                msg = None
+            if msg is None:
+                break
+            type, payload = msg
+            if type == MessageType.UPDATE:
+                self._update(payload)
+            elif type == MessageType.RESULT and \
+                    len(payload) == _result.size:
+                reqid, status = _result.unpack(payload)
+                with self._lock:
+                    if reqid in self._results:
+                        self._results[reqid][1] = status
+                        self._results[reqid][0].set()
+            elif type == MessageType.OVERFLOW and \
+                    len(payload) == _request.size:
+                self._dropped += _request.unpack(payload)[0]
+        self._alive = False
+
+    def _update(self, payload):
+        try:
+            dico, ok = Bybop_Commands.unpack_command(payload)
+        except Bybop_Commands.CommandError:
+            return
+        if not ok:
+            return
+        pr, cl, cmd = dico['proj'], dico['class'], dico['cmd']
+        if dico['listtype_str'] == 'LIST':
+            self._state.put_list(pr, cl, cmd, dico['args'])
+        elif dico['listtype_str'] == 'MAP':
+            self._state.put_map(pr, cl, cmd, dico['args'], dico['arg0'])
+        else:
+            self._state.put(pr, cl, cmd, dico['args'])
+        if self._listener is not None:
+            self._listener(dico)
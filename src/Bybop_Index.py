@@ -0,0 +1,371 @@
+# This module uses http://www.numpy.org/ for its arrays
+
+import mmap
+import os
+import struct
+
+import numpy
+
+import Bybop_Commands
+import Bybop_NetworkAL
+from Bybop_Recorder import (Direction, FrameLogWriter, is_log_source,
+                            iter_records, log_files, read_header,
+                            read_record_at)
+
+
+# Index file : header (magic, version), followed by one entry per indexed
+# record : timestamp (monotonic ns), offset of the record in the log file,
+# project/feature id, class id, command id and direction.
+_INDEX_MAGIC = b'BYBOPIDX'
+_INDEX_VERSION = 1
+_INDEX_HEADER = struct.Struct('<8sH')
+_INDEX_ENTRY = struct.Struct('<QQBBHB3x')
+_INDEX_DTYPE = numpy.dtype([('ts', '<u8'), ('offset', '<u8'), ('proj', 'u1'),
+                            ('cls', 'u1'), ('cmd', '<u2'), ('dir', 'u1'),
+                            ('pad', 'V3')])
+
+_INDEX_SUFFIX = '.idx'
+
+_cmd_header = struct.Struct('<BBH')
+
+
+def index_path(log_path):
+    """
+    Get the path of the index of a log file.
+
+    Arguments:
+    - log_path : The path of the log file
+    """
+    return log_path + _INDEX_SUFFIX
+
+
+def _record_key(type, buf, data):
+    # Only ARCommands are indexed : no acks, no pings/pongs
+    if type == Bybop_NetworkAL.DataType.ACK or buf in (0, 1) or \
+            len(data) < _cmd_header.size:
+        return None
+    return _cmd_header.unpack_from(data)
+
+
+def _pack_key(proj, cls, cmd):
+    return (proj << 24) | (cls << 16) | cmd
+
+
+class _IndexFileWriter(object):
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(_INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION))
+
+    def add(self, offset, ts, direction, type, buf, data):
+        key = _record_key(type, buf, data)
+        if key is not None:
+            self._file.write(_INDEX_ENTRY.pack(ts, offset, key[0], key[1],
+                                               key[2], direction))
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class IndexedFrameLogWriter(FrameLogWriter):
+    """
+    FrameLogWriter which also writes the index of each log file.
+
+    To index a live recording, give this class to the FrameRecorder:
+    FrameRecorder(basename, writer_class=IndexedFrameLogWriter)
+    """
+
+    def __init__(self, basename, max_size=64 * 1024 * 1024,
+                 wall_clock=False):
+        self._index_file = None
+        super(IndexedFrameLogWriter, self).__init__(basename,
+                                                    max_size=max_size,
+                                                    wall_clock=wall_clock)
+
+    def _on_open(self, path):
+        if self._index_file is not None:
+            self._index_file.close()
+        self._index_file = _IndexFileWriter(index_path(path))
+
+    def _on_record(self, offset, ts, direction, type, buf, seq, data):
+        self._index_file.add(offset, ts, direction, type, buf, data)
+
+    def flush(self):
+        super(IndexedFrameLogWriter, self).flush()
+        if self._index_file is not None:
+            self._index_file.flush()
+
+    def close(self):
+        super(IndexedFrameLogWriter, self).close()
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
+
+
+def build_index(log_path):
+    """
+    Build the index of an existing log file, in one pass.
+
+    Return the path of the index file.
+
+    Arguments:
+    - log_path : The path of the log file
+    """
+    path = index_path(log_path)
+    writer = _IndexFileWriter(path + '.tmp')
+    try:
+        with open(log_path, 'rb') as f:
+            read_header(f)
+            for offset, frame in iter_records(f):
+                writer.add(offset, frame.timestamp, frame.direction,
+                           frame.type, frame.buf, frame.data)
+    finally:
+        writer.close()
+    os.replace(path + '.tmp', path)
+    return path
+
+
+class _FileIndex(object):
+    """
+    Index of one log file.
+
+    The index file is memory mapped, and viewed as a numpy structured array,
+    so loading an index does not depend on its size (unless its entries are
+    not sorted by time, in which case a sorted copy is made).
+    """
+
+    def __init__(self, log_path):
+        self.log_path = log_path
+        with open(log_path, 'rb') as f:
+            wall_ns, mono_ns = read_header(f)
+        self.wall_offset = wall_ns - mono_ns
+        self.log_size = os.path.getsize(log_path)
+        self._by_key = {}
+        self._sorted_keys = None
+        self._mmap = None
+        self._file = None
+        self._index_mmap = None
+        self._index_file = None
+        self._load(index_path(log_path))
+
+    def _load(self, path):
+        self._index_file = open(path, 'rb')
+        header = self._index_file.read(_INDEX_HEADER.size)
+        if len(header) != _INDEX_HEADER.size or \
+                _INDEX_HEADER.unpack(header) != (_INDEX_MAGIC,
+                                                 _INDEX_VERSION):
+            self._index_file.close()
+            raise ValueError('Bad index file ' + path)
+        hsize = _INDEX_HEADER.size
+        # Ignore a truncated last entry
+        count = (os.fstat(self._index_file.fileno()).st_size - hsize) // \
+            _INDEX_DTYPE.itemsize
+        if count > 0:
+            self._index_mmap = mmap.mmap(self._index_file.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+            entries = numpy.frombuffer(self._index_mmap, dtype=_INDEX_DTYPE,
+                                       count=count, offset=hsize)
+        else:
+            entries = numpy.zeros(0, dtype=_INDEX_DTYPE)
+        # Ignore entries past the end of the log (crash), the records are
+        # indexed in the file order
+        count = numpy.searchsorted(entries['offset'], self.log_size)
+        entries = entries[:count]
+        ts = entries['ts']
+        if count > 1 and (ts[1:] < ts[:-1]).any():
+            # Frames recorded from different threads
+            entries = entries[numpy.argsort(ts, kind='stable')]
+        self.entries = entries
+        self.ts = entries['ts']
+        self.offsets = entries['offset']
+        self.dirs = entries['dir']
+
+    def _key_index(self, key):
+        ret = self._by_key.get(key)
+        if ret is not None:
+            return ret
+        if self._sorted_keys is None:
+            e = self.entries
+            keys = (e['proj'].astype(numpy.uint32) << 24) | \
+                (e['cls'].astype(numpy.uint32) << 16) | e['cmd']
+            # Stable, so the positions of each key stay sorted by time
+            self._key_order = numpy.argsort(keys, kind='stable')
+            self._sorted_keys = keys[self._key_order]
+        lo = numpy.searchsorted(self._sorted_keys, key, 'left')
+        hi = numpy.searchsorted(self._sorted_keys, key, 'right')
+        positions = self._key_order[lo:hi]
+        ret = (positions, self.ts[positions])
+        self._by_key[key] = ret
+        return ret
+
+    def positions(self, start, end, keys):
+        """ Positions of the entries in [start; end], sorted by time """
+        # The timestamps are unsigned
+        if end is not None and end < 0:
+            return range(0)
+        if start is not None and start < 0:
+            start = None
+        if keys is None:
+            lo = 0 if start is None else \
+                int(numpy.searchsorted(self.ts, start, 'left'))
+            hi = len(self.ts) if end is None else \
+                int(numpy.searchsorted(self.ts, end, 'right'))
+            return range(lo, hi)
+        ret = []
+        for key in keys:
+            positions, kts = self._key_index(key)
+            lo = 0 if start is None else numpy.searchsorted(kts, start,
+                                                            'left')
+            hi = len(kts) if end is None else numpy.searchsorted(kts, end,
+                                                                 'right')
+            ret.append(positions[lo:hi])
+        if not ret:
+            return ret
+        return numpy.sort(numpy.concatenate(ret))
+
+    def get_buffer(self):
+        if self._mmap is None:
+            self._file = open(self.log_path, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+            self._file = None
+        if self._index_file is not None:
+            # The views must be released before the memory map
+            self.entries = self.ts = self.offsets = self.dirs = None
+            self._by_key = {}
+            self._sorted_keys = self._key_order = None
+            if self._index_mmap is not None:
+                self._index_mmap.close()
+                self._index_mmap = None
+            self._index_file.close()
+            self._index_file = None
+
+
+class SessionIndex(object):
+    """
+    Random access to the messages of a recorded session.
+
+    The session logs are read through their index files (see build_index
+    and IndexedFrameLogWriter), so a query only reads the matching records,
+    through a memory map of the log files.
+    """
+
+    def __init__(self, source, build=True):
+        """
+        Load the index of a recorded session.
+
+        Arguments:
+        - source : A log file path, a list of log file paths, or a log
+                   basename (see Bybop_Recorder)
+
+        Keyword arguments:
+        - build : Build the missing (or outdated) index files (default True).
+                  If False, a missing index raises an IOError.
+        """
+        if not is_log_source(source):
+            raise ValueError('Source must be a log path or basename')
+        if isinstance(source, str):
+            paths = [source] if os.path.isfile(source) else \
+                log_files(source)
+        else:
+            paths = list(source)
+        self._files = []
+        for path in paths:
+            idx = index_path(path)
+            if build and (not os.path.exists(idx) or
+                          os.path.getmtime(idx) < os.path.getmtime(path)):
+                build_index(path)
+            self._files.append(_FileIndex(path))
+
+    def close(self):
+        """ Release the memory maps of the log files """
+        for f in self._files:
+            f.close()
+
+    def get_time_range(self, wall_clock=False):
+        """
+        Get the (first, last) timestamps of the indexed messages.
+
+        Return (None, None) for an empty session.
+
+        Keyword arguments:
+        - wall_clock : Return wall clock timestamps (floating point seconds
+                       since the epoch) instead of monotonic nanoseconds
+                       (default False)
+        """
+        first = None
+        last = None
+        for f in self._files:
+            if not len(f.ts):
+                continue
+            off = f.wall_offset if wall_clock else 0
+            lo, hi = int(f.ts[0]) + off, int(f.ts[-1]) + off
+            first = lo if first is None else min(first, lo)
+            last = hi if last is None else max(last, hi)
+        if wall_clock and first is not None:
+            return first / 1e9, last / 1e9
+        return first, last
+
+    def query(self, start=None, end=None, names=None,
+              directions=(Direction.IN,), wall_clock=False, decode=True):
+        """
+        Get the messages matching a time range and/or a list of commands.
+
+        Yield (timestamp, message) tuples, sorted by time. The message is the
+        dictionnary returned by Bybop_Commands.unpack_command, or the raw
+        Bybop_Recorder.Frame if decode is False.
+
+        Keyword arguments:
+        - start : First timestamp of the range, included (default None, from
+                  the start of the session)
+        - end : Last timestamp of the range, included (default None, up to the
+                end of the session)
+        - names : List of commands to get, in 'project.class.command' notation
+                  (default None, all commands)
+        - directions : The directions of the messages to get (default incoming
+                       messages only)
+        - wall_clock : The start/end arguments and the returned timestamps are
+                       wall clock floating point seconds since the epoch,
+                       instead of monotonic nanoseconds (default False)
+        - decode : Decode the messages (default True)
+        """
+        keys = None
+        if names is not None:
+            keys = [_pack_key(*Bybop_Commands.command_ids(n)) for n in names]
+        for f in self._files:
+            if wall_clock:
+                f_start = None if start is None else \
+                    int(start * 1e9) - f.wall_offset
+                f_end = None if end is None else \
+                    int(end * 1e9) - f.wall_offset
+            else:
+                f_start, f_end = start, end
+            positions = f.positions(f_start, f_end, keys)
+            if not len(positions):
+                continue
+            buf = f.get_buffer()
+            for pos in positions:
+                if f.dirs[pos] not in directions:
+                    continue
+                frame = read_record_at(buf, int(f.offsets[pos]))
+                ts = frame.timestamp
+                if wall_clock:
+                    ts = (ts + f.wall_offset) / 1e9
+                if not decode:
+                    yield ts, frame
+                    continue
+                try:
+                    dico, ok = Bybop_Commands.unpack_command(frame.data)
+                except Bybop_Commands.CommandError:
+                    continue
+                if ok:
+                    yield ts, dico
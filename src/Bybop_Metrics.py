@@ -0,0 +1,273 @@
+import bisect
+import http.server
+import threading
+import time
+
+# Global switch of the instrumentation. The instrumented code checks this
+# flag at each stage, so when it is False the instrumentation costs one
+# attribute lookup per stage. Use enable()/disable() to change it.
+enabled = False
+
+# Histograms buckets upper bounds, in nanoseconds (1us to 10s)
+_BOUNDS = [m * 10 ** e for e in range(3, 10) for m in (1, 2, 5)] + \
+    [10 ** 10]
+
+# Description of the metrics of the library, for the exporter
+_HELP = {
+    'device_pack': 'Device.send_data commands packing time',
+    'device_send': 'Device.send_data total time',
+    'network_lock_wait': 'Network.send_data buffer lock wait time',
+    'network_ack_wait': 'Network.send_data wait time for one ack',
+    'network_send': 'Network.send_data total time',
+    'netal_send': 'NetworkAL.send_data socket write time',
+    'netal_dispatch': 'NetworkAL processing time of a received datagram',
+    'commands_unpack': 'unpack_command decoding time',
+    'state_put': 'State update time, lock wait included',
+    'piloting_jitter': 'Piloting loop delay between deadlines and sends',
+    'stream_frame_latency': 'Video frames reception to delivery time',
+    'netal_frames_sent': 'Frames sent',
+    'netal_bytes_sent': 'Bytes sent, headers included',
+    'netal_send_errors': 'Failed socket writes',
+    'netal_datagrams_received': 'Datagrams received',
+    'netal_frames_received': 'Frames received',
+    'netal_bytes_received': 'Bytes received, headers included',
+    'network_retransmits': 'Retransmitted acknowledged data',
+    'network_ack_timeouts': 'Acknowledged data lost after all the tries',
+    'network_acks_received': 'Acks received for pending data',
+    'network_acks_sent': 'Acks sent',
+    'network_duplicates_dropped': 'Received data dropped as duplicates',
+    'network_late_dropped': 'Received data without ack older than the last',
+    'network_pings': 'Pings answered',
+    'network_throttled': 'Data not sent because of a rate limit',
+}
+
+
+class Histogram(object):
+    """
+    Latency histogram, with fixed exponential buckets (1us to 10s).
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(_BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        """
+        Add a value to the histogram.
+
+        Arguments:
+        - value : The value, in nanoseconds
+        """
+        self.counts[bisect.bisect_left(_BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        Get an upper bound of a quantile (the bucket bound), in nanoseconds.
+
+        Return None for an empty histogram.
+
+        Arguments:
+        - q : The quantile [0; 1]
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for idx, nb in enumerate(self.counts):
+            total += nb
+            if total >= rank and nb:
+                return min(_BOUNDS[idx], self.max) \
+                    if idx < len(_BOUNDS) else self.max
+        return self.max
+
+    def to_dict(self):
+        buckets = []
+        total = 0
+        for bound, nb in zip(_BOUNDS, self.counts):
+            total += nb
+            buckets.append((bound, total))
+        return {
+            'count': self.count,
+            'sum_ns': self.sum,
+            'min_ns': self.min,
+            'max_ns': self.max,
+            'p50_ns': self.quantile(0.5),
+            'p99_ns': self.quantile(0.99),
+            'buckets': buckets,
+        }
+
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+
+def enable():
+    """ Enable the instrumentation of the library """
+    global enabled
+    enabled = True
+
+
+def disable():
+    """ Disable the instrumentation (the collected metrics are kept) """
+    global enabled
+    enabled = False
+
+
+def reset():
+    """ Clear all the collected metrics """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def inc(name, value=1):
+    """
+    Increment a counter.
+
+    Arguments:
+    - name : The counter name
+
+    Keyword arguments:
+    - value : The increment (default 1)
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, value):
+    """
+    Add a duration to a histogram.
+
+    Arguments:
+    - name : The histogram name
+    - value : The duration, in nanoseconds (see time.perf_counter_ns)
+    """
+    with _lock:
+        hist = _histograms.get(name)
+        if hist is None:
+            hist = _histograms[name] = Histogram()
+        hist.observe(value)
+
+
+def observe_since(name, start):
+    """
+    Add the duration since a time.perf_counter_ns value to a histogram.
+
+    Arguments:
+    - name : The histogram name
+    - start : The time.perf_counter_ns value at the start of the stage
+    """
+    observe(name, time.perf_counter_ns() - start)
+
+
+def snapshot():
+    """
+    Get a copy of the collected metrics.
+
+    Return a dictionnary with the following keys:
+    - enabled : Whether the instrumentation is enabled
+    - counters : Dictionnary of the counters values
+    - histograms : Dictionnary of the histograms, each one being a
+                   dictionnary with the count, sum_ns, min_ns, max_ns, p50_ns,
+                   p99_ns (upper bounds) and buckets ((upper bound,
+                   cumulative count) list) keys
+    """
+    with _lock:
+        return {
+            'enabled': enabled,
+            'counters': dict(_counters),
+            'histograms': dict((k, v.to_dict())
+                               for k, v in _histograms.items()),
+        }
+
+
+def prometheus_text(prefix='bybop_'):
+    """
+    Format the collected metrics in the Prometheus text exposition format.
+
+    Durations are exported in seconds.
+
+    Keyword arguments:
+    - prefix : Prefix of all the metrics names (default 'bybop_')
+    """
+    snap = snapshot()
+    lines = []
+    for name in sorted(snap['counters']):
+        full = prefix + name + '_total'
+        if name in _HELP:
+            lines.append('# HELP %s %s' % (full, _HELP[name]))
+        lines.append('# TYPE %s counter' % full)
+        lines.append('%s %d' % (full, snap['counters'][name]))
+    for name in sorted(snap['histograms']):
+        hist = snap['histograms'][name]
+        full = prefix + name + '_seconds'
+        if name in _HELP:
+            lines.append('# HELP %s %s' % (full, _HELP[name]))
+        lines.append('# TYPE %s histogram' % full)
+        for bound, total in hist['buckets']:
+            lines.append('%s_bucket{le="%g"} %d' % (full, bound / 1e9, total))
+        lines.append('%s_bucket{le="+Inf"} %d' % (full, hist['count']))
+        lines.append('%s_sum %.9f' % (full, hist['sum_ns'] / 1e9))
+        lines.append('%s_count %d' % (full, hist['count']))
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(object):
+    """
+    HTTP server exporting the metrics in the Prometheus text format, on the
+    /metrics path.
+
+    The server runs in a background thread.
+    """
+
+    def __init__(self, port=9464, address='127.0.0.1'):
+        """
+        Create and start a new metrics server.
+
+        Keyword arguments:
+        - port : The HTTP port (default 9464, 0 for an ephemeral port)
+        - address : The listening address (default '127.0.0.1', local scrapes
+                    only)
+        """
+        self._server = http.server.ThreadingHTTPServer((address, port),
+                                                       _Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def get_port(self):
+        """ Get the HTTP port of the server """
+        return self._server.server_address[1]
+
+    def stop(self):
+        """ Stop the server """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
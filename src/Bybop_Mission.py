@@ -0,0 +1,321 @@
+import threading
+import time
+
+import Bybop_Network
+
+
+class StepStatus:
+    PENDING = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+    TIMEOUT = 4
+    CANCELLED = 5
+
+    TO_STRING = {
+        PENDING: 'PENDING',
+        RUNNING: 'RUNNING',
+        DONE: 'DONE',
+        FAILED: 'FAILED',
+        TIMEOUT: 'TIMEOUT',
+        CANCELLED: 'CANCELLED',
+    }
+
+
+# Maximum time between two checks of the cancellation of a waiting step
+_WAIT_SLICE = 0.1
+
+
+class Step(object):
+    """
+    A step of a Mission : a command to send (or a function to call), and an
+    optional completion condition on a state key.
+    """
+
+    def __init__(self, name, command=None, args=(), wait=None,
+                 condition=None, after=(), timeout=5.0, action=None):
+        """
+        Create a new step.
+
+        Arguments:
+        - name : The step name, unique in its mission
+
+        Keyword arguments:
+        - command : The command to send, in 'project.class.command' notation
+                    (default None)
+        - args : The arguments of the command (default ())
+        - wait : The state key, in 'project.class.command' notation, which
+                 completes the step when it is updated (default None, the
+                 step is complete once the command is sent)
+        - condition : A function called with the value of the wait key, the
+                      step is complete when it returns True. The current
+                      value is checked first, so a step whose condition is
+                      already met does not wait (default None, any update
+                      of the key after the command is sent completes the
+                      step)
+        - after : Names of the steps which must be complete before this one
+                  starts (default ())
+        - timeout : Timeout of the step, in floating point seconds
+                    (default 5.0, None for no timeout)
+        - action : A function called with the device instead of sending a
+                   command. It returns True if it succeeded (default None)
+        """
+        self.name = name
+        self.command = command
+        self.args = tuple(args)
+        self.wait = wait
+        self.condition = condition
+        self.after = tuple(after)
+        self.timeout = timeout
+        self.action = action
+
+
+class Mission(object):
+    """
+    Executor of a set of steps with dependencies.
+
+    Each step starts, in its own thread, as soon as all the steps it depends
+    on are complete, so independent steps run concurrently. When a step
+    fails, times out or is cancelled, the steps depending on it are
+    cancelled.
+
+    The report gives the timing of each step, and the critical path : the
+    chain of dependent steps which determined the mission duration.
+    """
+
+    def __init__(self, device, steps):
+        """
+        Create a new mission.
+
+        A ValueError is raised if the step names are not unique, or if the
+        dependencies are unknown or cyclic.
+
+        Arguments:
+        - device : The Device
+        - steps : List of Step
+        """
+        self._device = device
+        self._steps = _check_steps(steps)
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._cancel = threading.Event()
+        self._status = dict((name, StepStatus.PENDING)
+                            for name in self._steps)
+        self._times = {}
+        self._start = None
+        self._end = None
+
+    def cancel(self):
+        """
+        Cancel the mission : the running steps stop waiting, and the pending
+        steps are not started.
+        """
+        self._cancel.set()
+        with self._lock:
+            self._cond.notify_all()
+
+    def run(self, timeout=None):
+        """
+        Run the mission, and wait for its end.
+
+        Return True if all the steps are complete.
+
+        Keyword arguments:
+        - timeout : Timeout of the whole mission, in floating point seconds
+                    (default None). The mission is cancelled when it
+                    expires.
+        """
+        self._start = time.monotonic()
+        deadline = self._start + timeout if timeout is not None else None
+        threads = []
+        with self._lock:
+            while True:
+                self._start_ready(threads)
+                if all(s != StepStatus.PENDING and s != StepStatus.RUNNING
+                       for s in self._status.values()):
+                    break
+                wait = None
+                if deadline is not None:
+                    wait = deadline - time.monotonic()
+                    if wait <= 0:
+                        self._cancel.set()
+                        wait = None
+                self._cond.wait(wait)
+        for th in threads:
+            th.join()
+        self._end = time.monotonic()
+        return all(s == StepStatus.DONE for s in self._status.values())
+
+    def _start_ready(self, threads):
+        # Called with the lock held
+        for name, step in self._steps.items():
+            if self._status[name] != StepStatus.PENDING:
+                continue
+            deps = [self._status[d] for d in step.after]
+            if self._cancel.is_set() or any(
+                    s not in (StepStatus.PENDING, StepStatus.RUNNING,
+                              StepStatus.DONE) for s in deps):
+                self._status[name] = StepStatus.CANCELLED
+                continue
+            if all(s == StepStatus.DONE for s in deps):
+                self._status[name] = StepStatus.RUNNING
+                self._times[name] = [time.monotonic(), None]
+                th = threading.Thread(target=self._run_step, args=(step,))
+                th.daemon = True
+                th.start()
+                threads.append(th)
+
+    def _run_step(self, step):
+        try:
+            status = self._execute(step)
+        except Exception as e:
+            print('Mission step ' + step.name + ' failed : ' + str(e))
+            status = StepStatus.FAILED
+        with self._lock:
+            self._status[step.name] = status
+            self._times[step.name][1] = time.monotonic()
+            self._cond.notify_all()
+
+    def _execute(self, step):
+        device = self._device
+        state = device.get_state(copy=False)
+        start = time.monotonic()
+        deadline = start + step.timeout if step.timeout is not None \
+            else None
+        wid = state.watch(step.wait) if step.wait is not None else None
+        version = state.get_version()
+
+        if step.action is not None:
+            ok = step.action(device)
+        elif step.command is not None:
+            ok = device.send_data(step.command, *step.args) == \
+                Bybop_Network.NetworkStatus.OK
+        else:
+            ok = True
+        if not ok or step.wait is None:
+            if wid is not None:
+                state.wait_for(step.wait, 0, wid)
+            return StepStatus.DONE if ok else StepStatus.FAILED
+
+        while True:
+            if step.condition is None:
+                done = state.get_version(step.wait) > version
+            else:
+                value = state.get_value(step.wait)
+                done = value is not None and step.condition(value)
+            if done:
+                state.wait_for(step.wait, 0, wid)
+                return StepStatus.DONE
+            wait = _WAIT_SLICE
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    state.wait_for(step.wait, 0, wid)
+                    return StepStatus.TIMEOUT
+                wait = min(wait, left)
+            if self._cancel.is_set():
+                state.wait_for(step.wait, 0, wid)
+                return StepStatus.CANCELLED
+            # Only used to wake up on updates, the watch is renewed before
+            # the next check, so no update is missed
+            state.wait_for(step.wait, wait, wid)
+            wid = state.watch(step.wait)
+
+    def get_status(self, name):
+        """
+        Get the StepStatus of a step.
+
+        Arguments:
+        - name : The step name
+        """
+        with self._lock:
+            return self._status[name]
+
+    def get_report(self):
+        """
+        Get the timing report of the mission.
+
+        Return a dictionnary with the following keys:
+        - steps : Dictionnary, by step name, of dictionnaries with the status
+                  (string), start and end (floating point seconds since the
+                  mission start, None if the step did not run/end) and
+                  duration keys
+        - critical_path : The names of the chain of steps which ended last,
+                          each step being the dependency which ended last of
+                          the next one
+        - critical_path_latency : The end time of the last step of the
+                                  critical path (floating point seconds
+                                  since the mission start)
+        - duration : The mission duration (None if it did not end)
+        """
+        with self._lock:
+            status = dict(self._status)
+            times = dict((k, list(v)) for k, v in self._times.items())
+        origin = self._start
+        steps = {}
+        for name in self._steps:
+            start, end = times.get(name, (None, None))
+            steps[name] = {
+                'status': StepStatus.TO_STRING[status[name]],
+                'start': start - origin if start is not None else None,
+                'end': end - origin if end is not None else None,
+                'duration': end - start if end is not None else None,
+            }
+
+        path = []
+        ended = [n for n in self._steps if steps[n]['end'] is not None]
+        current = max(ended, key=lambda n: steps[n]['end']) \
+            if ended else None
+        while current is not None:
+            path.append(current)
+            deps = [d for d in self._steps[current].after
+                    if steps[d]['end'] is not None]
+            current = max(deps, key=lambda n: steps[n]['end']) \
+                if deps else None
+        path.reverse()
+        return {
+            'steps': steps,
+            'critical_path': path,
+            'critical_path_latency': steps[path[-1]]['end'] if path else 0.0,
+            'duration': self._end - origin
+            if self._end is not None and origin is not None else None,
+        }
+
+
+def _check_steps(steps):
+    """
+    Check the steps of a mission, and return them in a dictionnary by name
+    (in their original order).
+
+    A ValueError is raised if the step names are not unique, or if the
+    dependencies are unknown or cyclic.
+
+    Arguments:
+    - steps : List of Step
+    """
+    ret = {}
+    for step in steps:
+        if step.name in ret:
+            raise ValueError('Duplicate step ' + step.name)
+        ret[step.name] = step
+    for step in ret.values():
+        for dep in step.after:
+            if dep not in ret:
+                raise ValueError('Unknown dependency %s of step %s' %
+                                 (dep, step.name))
+    # Depth first search for cycles
+    visiting, visited = set(), set()
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError('Dependency cycle on step ' + name)
+        visiting.add(name)
+        for dep in ret[name].after:
+            visit(dep)
+        visiting.discard(name)
+        visited.add(name)
+    for name in ret:
+        visit(name)
+    return ret
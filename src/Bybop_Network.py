@@ -1,12 +1,191 @@
+import Bybop_Metrics
 import Bybop_NetworkAL
 import struct
 import threading
+import time
 
 
 class NetworkStatus:
     OK = 0
     ERROR = 1
     TIMEOUT = 2
+    THROTTLED = 3
+
+
+_limits_lock = threading.Lock()
+
+# Minimum bytes burst of the bandwidth limits : one Wi-Fi MTU sized frame
+MIN_BURST_BYTES = 1500
+
+# Number of sequence numbers remembered by the receive windows. It must be
+# less than half of the 8 bits sequence numbers space.
+RECV_WINDOW = 64
+
+
+class _ReceiveWindow(object):
+    """
+    Receive window of a buffer : the highest sequence number received, and
+    the bitmap of the RECV_WINDOW sequence numbers before it (bit n is set
+    when highest - n was received).
+    """
+    __slots__ = ('highest', 'bitmap', 'duplicates', 'late')
+
+    def __init__(self):
+        self.highest = None
+        self.bitmap = 0
+        self.duplicates = 0
+        self.late = 0
+
+    def accept(self, seq, allow_late):
+        """
+        Check if a sequence number was not already received, and mark it as
+        received.
+
+        Arguments:
+        - seq : The sequence number
+        - allow_late : Whether a sequence number older than the highest one,
+                       but not received yet, is accepted. Otherwise, only
+                       newer data is accepted (e.g. for telemetry, where an
+                       old value must not overwrite a newer one).
+        """
+        if self.highest is None:
+            self.highest = seq
+            self.bitmap = 1
+            return True
+        diff = (seq - self.highest) & 0xff
+        if diff == 0:
+            self.duplicates += 1
+            return False
+        if diff < 128:
+            # Newer, slide the window
+            self.highest = seq
+            self.bitmap = ((self.bitmap << diff) | 1) & \
+                ((1 << RECV_WINDOW) - 1)
+            return True
+        back = 256 - diff
+        if back >= RECV_WINDOW:
+            # Too old to be a retry : the device restarted its sequence
+            self.highest = seq
+            self.bitmap = 1
+            return True
+        bit = 1 << back
+        if self.bitmap & bit:
+            self.duplicates += 1
+            return False
+        if not allow_late:
+            self.late += 1
+            return False
+        # Reordered, but not received yet
+        self.bitmap |= bit
+        return True
+
+
+class TokenBucket(object):
+    """
+    Token bucket : tokens are added at a fixed rate, up to the bucket
+    capacity (burst), and each sent unit takes one token.
+
+    A full bucket always allows a send, even of more tokens than its
+    capacity : the missing tokens are taken in advance (the bucket goes
+    negative), so the average rate is kept.
+    """
+
+    def __init__(self, rate, burst=None, min_burst=1.0):
+        """
+        Create a new (full) token bucket.
+
+        Arguments:
+        - rate : The tokens added per second
+
+        Keyword arguments:
+        - burst : The bucket capacity (default None, 1/10th of a second of
+                  tokens, and at least min_burst)
+        - min_burst : The minimum default capacity (default 1.0)
+        """
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else \
+            max(self.rate / 10, float(min_burst))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+
+    def refill(self, now):
+        """ Add the tokens since the last refill, and return the tokens """
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        return self._tokens
+
+    def can_take(self, count):
+        """ Check if tokens can be taken (see refill) """
+        return self._tokens >= min(count, self.burst)
+
+    def take(self, count):
+        """ Take tokens (refill must have been called before) """
+        self._tokens -= count
+
+
+class RateLimit(object):
+    """
+    Limit of the messages rate and/or bandwidth of some outgoing traffic.
+    """
+
+    def __init__(self, rate=None, bandwidth=None, burst=None,
+                 burst_bytes=None):
+        """
+        Create a new limit.
+
+        Keyword arguments:
+        - rate : Maximum messages per second (default None, no limit)
+        - bandwidth : Maximum bytes per second, ARNetworkAL headers included
+                      (default None, no limit)
+        - burst : Messages burst (default None, see TokenBucket)
+        - burst_bytes : Bytes burst (default None, 1/10th of a second of
+                        bandwidth, and at least MIN_BURST_BYTES). A
+                        ValueError is raised if it is less than
+                        MIN_BURST_BYTES.
+        """
+        if burst_bytes is not None and burst_bytes < MIN_BURST_BYTES:
+            raise ValueError('The bytes burst must be at least %d bytes' %
+                             MIN_BURST_BYTES)
+        self._buckets = []
+        if rate is not None:
+            self._buckets.append((TokenBucket(rate, burst), False))
+        if bandwidth is not None:
+            self._buckets.append((TokenBucket(bandwidth, burst_bytes,
+                                              MIN_BURST_BYTES), True))
+
+    def allow(self, size):
+        """
+        Check if a message can be sent, and take its tokens if it can.
+
+        Arguments:
+        - size : The message size, in bytes
+        """
+        return allow_all((self,), size)
+
+
+def allow_all(limits, size):
+    """
+    Check if a message can be sent under all the given limits, and take its
+    tokens from all of them if it can (none are taken if one limit is
+    exceeded).
+
+    Arguments:
+    - limits : List of RateLimit (None items are ignored)
+    - size : The message size, in bytes
+    """
+    buckets = [b for lim in limits if lim is not None for b in lim._buckets]
+    now = time.monotonic()
+    # One lock for all the limits, so that limits shared between buffers
+    # or devices can not deadlock
+    with _limits_lock:
+        for bucket, in_bytes in buckets:
+            bucket.refill(now)
+            if not bucket.can_take(size if in_bytes else 1):
+                return False
+        for bucket, in_bytes in buckets:
+            bucket.take(size if in_bytes else 1)
+    return True
 
 
 class Network(object):
@@ -33,7 +212,8 @@ class Network(object):
     """
 
     def __init__(self, ip, c2d_port, d2c_port,
-                 send_buffers, recv_buffers, listener):
+                 send_buffers, recv_buffers, listener, recorder=None,
+                 netal=None, socket_options=None):
         """
         Create a new instance of ARNetwork.
 
@@ -47,8 +227,21 @@ class Network(object):
                          application (i.e. which will be given to the send_data
                          function)
         - recv_buffers : List of buffers which should accept incoming data
+
+        Keyword arguments:
+        - recorder : A frames recorder given to the ARNetworkAL backend
+                     (default None)
+        - netal : An already created ARNetworkAL backend, mostly useful for
+                  offline uses (e.g. replays). If None, a new NetworkAL is
+                  created (default None)
+        - socket_options : The Bybop_NetworkAL.SocketOptions of the created
+                           NetworkAL (default None)
         """
-        self._netal = Bybop_NetworkAL.NetworkAL(ip, c2d_port, d2c_port, self)
+        if netal is None:
+            netal = Bybop_NetworkAL.NetworkAL(
+                ip, c2d_port, d2c_port, self, recorder=recorder,
+                socket_options=socket_options)
+        self._netal = netal
         self._listener = listener
         # The application writed to these (send to network)
         self._send_buffers = list(send_buffers)
@@ -67,7 +260,11 @@ class Network(object):
             self._ack_events[sndb] = threading.Event()
             self._ack_seq[sndb] = 0
         for rcvb in self._recv_buffers:
-            self._recv_seq[rcvb] = 255
+            self._recv_seq[rcvb] = _ReceiveWindow()
+        self._buffer_listeners = {}
+        self._device_limit = None
+        self._buffer_limits = {}
+        self._throttled = {}
 
     def stop(self):
         """
@@ -89,6 +286,100 @@ class Network(object):
         """
         self._netal.start()
 
+    def set_recorder(self, recorder):
+        """
+        Set (or remove, with None) the frames recorder of the ARNetworkAL
+        backend.
+
+        Arguments:
+        - recorder : The new recorder
+        """
+        self._netal.set_recorder(recorder)
+
+    def add_buffers(self, send_buffers, recv_buffers, listener=None):
+        """
+        Add buffers to a running instance.
+
+        Arguments:
+        - send_buffers : List of buffers which should accept data from the
+                         application
+        - recv_buffers : List of buffers which should accept incoming data
+
+        Keyword arguments:
+        - listener : A listener which will have its data_received function
+                     called for the data received on the recv_buffers,
+                     instead of the main listener (default None)
+        """
+        for sndb in send_buffers:
+            if sndb in self._send_buffers:
+                continue
+            self._buf_locks[sndb] = threading.Lock()
+            self._ack_events[sndb] = threading.Event()
+            self._ack_seq[sndb] = 0
+            self._send_seq.setdefault(sndb, 0)
+            self._send_buffers.append(sndb)
+        for rcvb in recv_buffers:
+            if listener is not None:
+                self._buffer_listeners[rcvb] = listener
+            if rcvb not in self._recv_buffers:
+                self._recv_seq[rcvb] = _ReceiveWindow()
+                self._recv_buffers.append(rcvb)
+
+    def remove_buffers(self, send_buffers, recv_buffers):
+        """
+        Remove buffers added by add_buffers.
+
+        Arguments:
+        - send_buffers : List of buffers to remove from the send buffers
+        - recv_buffers : List of buffers to remove from the receive buffers
+        """
+        for sndb in send_buffers:
+            if sndb in self._send_buffers:
+                self._send_buffers.remove(sndb)
+        for rcvb in recv_buffers:
+            self._buffer_listeners.pop(rcvb, None)
+            self._recv_seq.pop(rcvb, None)
+            if rcvb in self._recv_buffers:
+                self._recv_buffers.remove(rcvb)
+
+    def set_rate_limit(self, limit, buf=None):
+        """
+        Set (or remove, with None) a limit of the outgoing traffic.
+
+        High priority (low latency) data, acks and pongs are never limited.
+        Data exceeding a limit is not sent, and send_data returns
+        NetworkStatus.THROTTLED.
+
+        Arguments:
+        - limit : A RateLimit, or None
+
+        Keyword arguments:
+        - buf : The buffer to limit (default None, meaning all the traffic of
+                this instance)
+        """
+        if buf is None:
+            self._device_limit = limit
+        elif limit is None:
+            self._buffer_limits.pop(buf, None)
+        else:
+            self._buffer_limits[buf] = limit
+
+    def get_throttled(self):
+        """
+        Get the number of throttled sends, as a dictionnary by buffer.
+        """
+        with _limits_lock:
+            return dict(self._throttled)
+
+    def get_socket_stats(self):
+        """
+        Get the sockets statistics of the ARNetworkAL backend (see
+        Bybop_NetworkAL.NetworkAL.get_socket_stats), or None if the backend
+        has no sockets (e.g. replays).
+        """
+        get = getattr(self._netal, 'get_socket_stats', None)
+        return get() if get is not None else None
+
     def _get_seq(self, buf):
         if buf not in self._send_seq:
             self._send_seq[buf] = 0
@@ -97,7 +388,7 @@ class Network(object):
         self._send_seq[buf] %= 256
         return ret
 
-    def send_data(self, buf, data, type, timeout=0.15, tries=5):
+    def send_data(self, buf, data, type, timeout=0.15, tries=5, limit=None):
         """
         Send some data over the network, and return an ARNetworkStatus.
 
@@ -120,15 +411,34 @@ class Network(object):
                     timeout (default 0.15)
         - tries : Total number of tries before considering a data as lost
                   (default 5)
+        - limit : An additional RateLimit for this data, e.g. a per command
+                  limit (default None)
         """
         if buf not in self._send_buffers:
             return NetworkStatus.ERROR
 
+        if type != Bybop_NetworkAL.DataType.DATA_LOW_LATENCY and (
+                limit is not None or self._device_limit is not None or
+                buf in self._buffer_limits) and not allow_all(
+                    (limit, self._buffer_limits.get(buf), self._device_limit),
+                    len(data) + 7):
+            with _limits_lock:
+                self._throttled[buf] = self._throttled.get(buf, 0) + 1
+            if Bybop_Metrics.enabled:
+                Bybop_Metrics.inc('network_throttled')
+            return NetworkStatus.THROTTLED
+
+        timed = Bybop_Metrics.enabled
+        if timed:
+            start = time.perf_counter_ns()
         seqnum = self._get_seq(buf)
         needack = type == Bybop_NetworkAL.DataType.DATA_WITH_ACK
         status = NetworkStatus.TIMEOUT
+        first = True
 
         with self._buf_locks[buf]:
+            if timed:
+                Bybop_Metrics.observe_since('network_lock_wait', start)
 
             # If we need an ack, clear any pending ack event,
             # and set the requested seqnum
@@ -140,38 +450,74 @@ class Network(object):
             # Try 'retries' times in case of timeouts
             while tries > 0 and status == NetworkStatus.TIMEOUT:
                 tries -= 1
+                if timed and not first:
+                    Bybop_Metrics.inc('network_retransmits')
+                first = False
 
                 status = NetworkStatus.OK if self._netal.send_data(
                     type, buf, seqnum, data) else NetworkStatus.ERROR
                 # We only set TIMEOUT status for acknowledged data
                 if needack and status == NetworkStatus.OK:
                     # Data with ack properly sent
+                    if timed:
+                        ack_start = time.perf_counter_ns()
                     status = NetworkStatus.OK if self._ack_events[buf].wait(
                         timeout) else NetworkStatus.TIMEOUT
+                    if timed:
+                        Bybop_Metrics.observe_since('network_ack_wait',
+                                                    ack_start)
+        if timed:
+            if status == NetworkStatus.TIMEOUT:
+                Bybop_Metrics.inc('network_ack_timeouts')
+            Bybop_Metrics.observe_since('network_send', start)
         return status
 
     def _send_ack(self, buf, seq):
+        if Bybop_Metrics.enabled:
+            Bybop_Metrics.inc('network_acks_sent')
         answer = struct.pack('<B', seq)
         abuf = buf + 128
         self._netal.send_data(Bybop_NetworkAL.DataType.ACK,
                               abuf, self._get_seq(abuf), answer)
 
     def _send_pong(self, data):
+        if Bybop_Metrics.enabled:
+            Bybop_Metrics.inc('network_pings')
         self._netal.send_data(Bybop_NetworkAL.DataType.DATA,
                               1, self._get_seq(1), data)
 
-    def _should_accept(self, buf, seq):
-        if buf not in self._recv_seq:
+    def _should_accept(self, buf, seq, allow_late=False):
+        window = self._recv_seq.get(buf)
+        if window is None:
             return False
 
-        prev = self._recv_seq[buf]
-        diff = seq - prev
-        ok = diff >= 0 or diff <= -10
-
-        if ok:
-            self._recv_seq[buf] = seq
+        late = window.late
+        ok = window.accept(seq, allow_late)
+        if not ok and Bybop_Metrics.enabled:
+            if window.late != late:
+                Bybop_Metrics.inc('network_late_dropped')
+            else:
+                Bybop_Metrics.inc('network_duplicates_dropped')
         return ok
 
+    def get_duplicates(self):
+        """
+        Get the number of received duplicates (e.g. retries of acknowledged
+        data whose ack was lost), as a dictionnary by buffer. Duplicates are
+        acknowledged again, but not given to the listener.
+        """
+        return dict((buf, window.duplicates)
+                    for buf, window in self._recv_seq.items())
+
+    def get_late(self):
+        """
+        Get the number of received data dropped because newer data was
+        already received (only for data without ack), as a dictionnary by
+        buffer.
+        """
+        return dict((buf, window.late)
+                    for buf, window in self._recv_seq.items())
+
     def data_received(self, type, buf, seq, recv_data):
         """
         Implementation of the NetworkAL listener.
@@ -188,18 +534,22 @@ class Network(object):
                 with self._ack_events_lock:
                     if seq == self._ack_seq[ackbuf]:
                         self._ack_events[ackbuf].set()
+                        if Bybop_Metrics.enabled:
+                            Bybop_Metrics.inc('network_acks_received')
         elif type == Bybop_NetworkAL.DataType.DATA:
             self._process_data(buf, seq, recv_data)
         elif type == Bybop_NetworkAL.DataType.DATA_LOW_LATENCY:
             self._process_data(buf, seq, recv_data)
         elif type == Bybop_NetworkAL.DataType.DATA_WITH_ACK:
-            self._process_data(buf, seq, recv_data)
+            # Duplicates are acknowledged again, as our ack may be lost
+            self._process_data(buf, seq, recv_data, allow_late=True)
             # And send ack !
             self._send_ack(buf, seq)
 
-    def _process_data(self, buf, seq, recv_data):
-        if self._should_accept(buf, seq):
-            self._listener.data_received(buf, recv_data)
+    def _process_data(self, buf, seq, recv_data, allow_late=False):
+        if self._should_accept(buf, seq, allow_late):
+            listener = self._buffer_listeners.get(buf, self._listener)
+            listener.data_received(buf, recv_data)
 
     def did_disconnect(self):
         """
@@ -1,6 +1,11 @@
+import os
 import socket
 import struct
 import threading
+import time
+
+import Bybop_Metrics
+from Bybop_Recorder import Direction
 
 
 class DataType:
@@ -10,6 +15,100 @@ class DataType:
     DATA_WITH_ACK = 4
 
 
+# DSCP values (RFC 4594)
+DSCP_CS0 = 0
+DSCP_AF41 = 34
+DSCP_EF = 46
+
+
+class SocketOptions(object):
+    """
+    Options of the ARNetworkAL sockets : kernel buffers sizes, and traffic
+    marking (IP TOS byte) per data type.
+
+    Each distinct TOS value uses its own send socket, so that the marking
+    does not depend on per message ancillary data support.
+    """
+
+    def __init__(self, rcvbuf=None, sndbuf=None, tos=None):
+        """
+        Create new socket options.
+
+        Keyword arguments:
+        - rcvbuf : The receive buffer size (SO_RCVBUF), in bytes (default
+                   None, the system default). The kernel may double or cap
+                   it (see get_socket_stats).
+        - sndbuf : The send buffer size (SO_SNDBUF), in bytes (default None)
+        - tos : Dictionnary of the IP TOS byte by DataType (default None, no
+                marking, see default_tos). The TOS byte is the DSCP shifted
+                by 2.
+        """
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.tos = dict(tos) if tos else {}
+
+
+def default_tos():
+    """
+    Get a TOS marking by data type : EF for low latency data (e.g.
+    emergency), AF41 for acknowledged data and acks, best effort for the
+    rest (e.g. piloting commands, which are resent at a fixed rate).
+    """
+    return {
+        DataType.DATA_LOW_LATENCY: DSCP_EF << 2,
+        DataType.DATA_WITH_ACK: DSCP_AF41 << 2,
+        DataType.ACK: DSCP_AF41 << 2,
+        DataType.DATA: DSCP_CS0 << 2,
+    }
+
+
+def udp_socket_drops(sock):
+    """
+    Get the number of datagrams dropped by the kernel for an UDP socket
+    (e.g. because its receive buffer was full).
+
+    Return None if the system does not expose the counter (only Linux
+    does, in /proc/net/udp).
+
+    Arguments:
+    - sock : The socket
+    """
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+    except (OSError, ValueError):
+        return None
+    for path in ('/proc/net/udp', '/proc/net/udp6'):
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            fields = line.split()
+            if len(fields) >= 13 and fields[9] == inode:
+                return int(fields[12])
+    return None
+
+
+def split_frames(sock_data):
+    """
+    Split a datagram into ARNetworkAL frames.
+
+    Yield (type, buf, seq, data) tuples. A truncated or malformed trailing
+    frame ends the iteration.
+
+    Arguments:
+    - sock_data : The datagram payload
+    """
+    the_data = sock_data
+    while len(the_data) >= 7:
+        (type, buf, seq, size) = struct.unpack('<BBBI', the_data[0:7])
+        if size < 7 or size > len(the_data):
+            break
+        yield type, buf, seq, the_data[7:size]
+        the_data = the_data[size:]
+
+
 class NetworkAL(object):
     """
     Alternate implementation of the ARNetworkAL protocol, for Wifi devices.
@@ -29,9 +128,13 @@ class NetworkAL(object):
     And a 'did_disconnect' function, without arguments, which will be called
     if the product does not send any data on the network (probably because we
     lost the network link, or because the product has run out of battery)
+
+    All the frames sent and received can be saved by a recorder (see
+    Bybop_Recorder.FrameRecorder).
     """
 
-    def __init__(self, ip, c2d_port, d2c_port, listener):
+    def __init__(self, ip, c2d_port, d2c_port, listener, recorder=None,
+                 socket_options=None):
         """
         Create and start a new instance of ARNetworkAL.
 
@@ -41,11 +144,19 @@ class NetworkAL(object):
         - d2c_port : The local reading port
         - listener : A listener which will have its data_received function
                      called when a data is received from the network.
+
+        Keyword arguments:
+        - recorder : A recorder which will have its record function called
+                     for each frame sent or received (default None)
+        - socket_options : The SocketOptions of the sockets (default None,
+                           the system defaults)
         """
         self._ip = ip
+        self._options = socket_options or SocketOptions()
         self._c2d_port = int(c2d_port)
         self._d2c_port = int(d2c_port)
         self._listener = listener
+        self._recorder = recorder
         self._alive = False
         self._running = False
         self._thread = None
@@ -59,7 +170,8 @@ class NetworkAL(object):
         """
         if self._running:
             self._alive = False
-            self._send_sock.close()
+            for sock in self._send_socks.values():
+                sock.close()
 
     def start(self):
         """
@@ -70,14 +182,64 @@ class NetworkAL(object):
         if self._running:
             return
         self._alive = True
-        self._send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        options = self._options
+        # One send socket per TOS value, the None key is the unmarked one
+        self._send_socks = {}
+        self._send_by_type = {}
+        for type, tos in [(None, None)] + list(options.tos.items()):
+            sock = self._send_socks.get(tos)
+            if sock is None:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                if options.sndbuf is not None:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                    options.sndbuf)
+                if tos is not None:
+                    sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, tos)
+                self._send_socks[tos] = sock
+            if type is not None:
+                self._send_by_type[type] = sock
+        self._send_sock = self._send_socks[None]
         self._recv_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if options.rcvbuf is not None:
+            self._recv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                       options.rcvbuf)
         self._recv_sock.settimeout(5.0)
         self._recv_sock.bind(('0.0.0.0', self._d2c_port))
         self._thread = threading.Thread(target=self._read_loop)
         self._thread.start()
         self._running = True
 
+    def set_recorder(self, recorder):
+        """
+        Set (or remove, with None) the frames recorder.
+
+        Arguments:
+        - recorder : The new recorder
+        """
+        self._recorder = recorder
+
+    def get_socket_stats(self):
+        """
+        Get the sockets statistics.
+
+        Return a dictionnary with the following keys:
+        - rcvbuf : The actual receive buffer size (as reported by the kernel)
+        - sndbuf : The actual send buffer size of the unmarked send socket
+        - drops : Datagrams dropped by the kernel on the receive socket, or
+                  None if the system does not expose this counter
+        - tos : Dictionnary of the TOS byte by data type
+        """
+        if not self._running:
+            return None
+        return {
+            'rcvbuf': self._recv_sock.getsockopt(socket.SOL_SOCKET,
+                                                 socket.SO_RCVBUF),
+            'sndbuf': self._send_sock.getsockopt(socket.SOL_SOCKET,
+                                                 socket.SO_SNDBUF),
+            'drops': udp_socket_drops(self._recv_sock),
+            'tos': dict(self._options.tos),
+        }
+
     def send_data(self, type, buf, seq, data):
         """
         Send the given data to the remote ARNetworkAL.
@@ -93,12 +255,25 @@ class NetworkAL(object):
         - data : The actual data (ususally a string packed with the struct
                  module)
         """
+        recorder = self._recorder
+        if recorder is not None:
+            recorder.record(Direction.OUT, type, buf, seq, data)
         sock_data = struct.pack('<BBBI', type, buf, seq, len(data) + 7)
         sock_data += data
+        timed = Bybop_Metrics.enabled
+        if timed:
+            start = time.perf_counter_ns()
         try:
-            self._send_sock.sendto(sock_data, (self._ip, self._c2d_port))
+            self._send_by_type.get(type, self._send_sock).sendto(
+                sock_data, (self._ip, self._c2d_port))
         except socket.error:
+            if timed:
+                Bybop_Metrics.inc('netal_send_errors')
             return False
+        if timed:
+            Bybop_Metrics.observe_since('netal_send', start)
+            Bybop_Metrics.inc('netal_frames_sent')
+            Bybop_Metrics.inc('netal_bytes_sent', len(sock_data))
         return True
 
     def _read_loop(self):
@@ -108,12 +283,22 @@ class NetworkAL(object):
             except socket.error:
                 break
 
-            the_data = sock_data
-            while the_data:
-                (type, buf, seq, size) = struct.unpack('<BBBI', the_data[0:7])
-                recv_data = the_data[7:size]
+            timed = Bybop_Metrics.enabled
+            if timed:
+                start = time.perf_counter_ns()
+                nb_frames = 0
+            for type, buf, seq, recv_data in split_frames(sock_data):
+                recorder = self._recorder
+                if recorder is not None:
+                    recorder.record(Direction.IN, type, buf, seq, recv_data)
                 self._listener.data_received(type, buf, seq, recv_data)
-                the_data = the_data[size:]
+                if timed:
+                    nb_frames += 1
+            if timed:
+                Bybop_Metrics.observe_since('netal_dispatch', start)
+                Bybop_Metrics.inc('netal_datagrams_received')
+                Bybop_Metrics.inc('netal_frames_received', nb_frames)
+                Bybop_Metrics.inc('netal_bytes_received', len(sock_data))
 
         self._recv_sock.close()
         self._listener.did_disconnect()
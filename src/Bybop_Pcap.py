@@ -0,0 +1,254 @@
+import collections
+import socket
+import struct
+
+import Bybop_Commands
+import Bybop_NetworkAL
+from Bybop_Recorder import Direction, Frame, FrameLogWriter
+
+
+class PcapError(Exception):
+    def __init__(self, msg):
+        self.value = msg
+
+    def __str__(self):
+        return repr(self.value)
+
+
+UdpPacket = collections.namedtuple(
+    'UdpPacket', ['timestamp', 'src', 'sport', 'dst', 'dport', 'payload'])
+
+
+class LinkType:
+    NULL = 0
+    ETHERNET = 1
+    RAW = 101
+    LINUX_SLL = 113
+    LINUX_SLL2 = 276
+
+
+_PCAP_MAGIC_US = 0xa1b2c3d4
+_PCAP_MAGIC_NS = 0xa1b23c4d
+_PCAPNG_MAGIC = 0x0a0d0d0a
+
+_ETH_IPV4 = 0x0800
+_ETH_IPV6 = 0x86dd
+_ETH_VLAN = (0x8100, 0x88a8)
+_IPPROTO_UDP = 17
+
+
+def _open_pcap(f):
+    """
+    Read the global header of a pcap file.
+
+    Return the (byte order, timestamp divisor, link type) of the capture.
+    """
+    raw = f.read(24)
+    if len(raw) != 24:
+        raise PcapError('Truncated pcap header')
+    magic_le = struct.unpack('<I', raw[:4])[0]
+    magic_be = struct.unpack('>I', raw[:4])[0]
+    if magic_le in (_PCAP_MAGIC_US, _PCAP_MAGIC_NS):
+        endian, magic = '<', magic_le
+    elif magic_be in (_PCAP_MAGIC_US, _PCAP_MAGIC_NS):
+        endian, magic = '>', magic_be
+    elif magic_le == _PCAPNG_MAGIC:
+        raise PcapError('pcapng files are not supported, convert them with '
+                        '"editcap -F pcap"')
+    else:
+        raise PcapError('Not a pcap file')
+    linktype = struct.unpack(endian + 'I', raw[20:24])[0] & 0x0fffffff
+    divisor = 1000000000 if magic == _PCAP_MAGIC_NS else 1000000
+    return endian, divisor, linktype
+
+
+def _network_layer(linktype, data):
+    """ Return the (ethertype, network layer packet) of a link layer frame """
+    if linktype == LinkType.ETHERNET:
+        if len(data) < 14:
+            return None, None
+        ethertype = struct.unpack('>H', data[12:14])[0]
+        offset = 14
+        while ethertype in _ETH_VLAN and len(data) >= offset + 4:
+            ethertype = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+            offset += 4
+        return ethertype, data[offset:]
+    elif linktype == LinkType.LINUX_SLL:
+        if len(data) < 16:
+            return None, None
+        return struct.unpack('>H', data[14:16])[0], data[16:]
+    elif linktype == LinkType.LINUX_SLL2:
+        if len(data) < 20:
+            return None, None
+        return struct.unpack('>H', data[0:2])[0], data[20:]
+    elif linktype == LinkType.NULL:
+        if len(data) < 4:
+            return None, None
+        # Address family, in the capturing host byte order
+        family = struct.unpack('<I', data[:4])[0]
+        if family > 0xffff:
+            family = struct.unpack('>I', data[:4])[0]
+        ethertype = _ETH_IPV4 if family == 2 else _ETH_IPV6
+        return ethertype, data[4:]
+    elif linktype == LinkType.RAW:
+        if not data:
+            return None, None
+        version = data[0] >> 4
+        return (_ETH_IPV4 if version == 4 else _ETH_IPV6), data
+    raise PcapError('Unsupported link type %d' % linktype)
+
+
+def _udp_datagram(ethertype, packet):
+    """ Return the (src, dst, udp datagram) of an IP packet, or None """
+    if ethertype == _ETH_IPV4:
+        if len(packet) < 20:
+            return None
+        ihl = (packet[0] & 0x0f) * 4
+        proto = packet[9]
+        frag = struct.unpack('>H', packet[6:8])[0]
+        # Ignore non UDP packets, and IP fragments (no reassembly)
+        if proto != _IPPROTO_UDP or frag & 0x3fff:
+            return None
+        total = struct.unpack('>H', packet[2:4])[0]
+        src = socket.inet_ntoa(packet[12:16])
+        dst = socket.inet_ntoa(packet[16:20])
+        return src, dst, packet[ihl:total]
+    elif ethertype == _ETH_IPV6:
+        if len(packet) < 40 or packet[6] != _IPPROTO_UDP:
+            return None
+        src = socket.inet_ntop(socket.AF_INET6, packet[8:24])
+        dst = socket.inet_ntop(socket.AF_INET6, packet[24:40])
+        return src, dst, packet[40:]
+    return None
+
+
+def read_udp(path, ports=None):
+    """
+    Read the UDP datagrams of a pcap file.
+
+    The file is read packet by packet, so any capture size can be processed
+    in constant memory.
+
+    Yield UdpPacket tuples. The timestamp is the capture time, in nanoseconds
+    since the epoch.
+
+    A PcapError is raised if the file is not a supported pcap capture.
+
+    Arguments:
+    - path : The path of the pcap file
+
+    Keyword arguments:
+    - ports : Only return the datagrams from or to one of these ports
+              (default None, all datagrams)
+    """
+    if ports is not None:
+        ports = set(ports)
+    with open(path, 'rb') as f:
+        endian, divisor, linktype = _open_pcap(f)
+        rec_header = struct.Struct(endian + 'IIII')
+        while True:
+            raw = f.read(rec_header.size)
+            if len(raw) != rec_header.size:
+                return
+            ts_sec, ts_frac, incl_len, _ = rec_header.unpack(raw)
+            data = f.read(incl_len)
+            if len(data) != incl_len:
+                return
+            ethertype, packet = _network_layer(linktype, data)
+            if packet is None:
+                continue
+            udp = _udp_datagram(ethertype, packet)
+            if udp is None or len(udp[2]) < 8:
+                continue
+            src, dst, datagram = udp
+            sport, dport, length = struct.unpack('>HHH', datagram[:6])
+            if ports is not None and sport not in ports and \
+                    dport not in ports:
+                continue
+            ts = ts_sec * 1000000000 + ts_frac * (1000000000 // divisor)
+            yield UdpPacket(ts, src, sport, dst, dport, datagram[8:length])
+
+
+def read_frames(path, d2c_ports, c2d_ports):
+    """
+    Read the ARNetworkAL frames of a pcap file.
+
+    The datagrams are split into frames like NetworkAL does, and the frames
+    direction is found from the datagram destination port.
+
+    Yield Bybop_Recorder.Frame tuples. The timestamp is the capture time, in
+    nanoseconds since the epoch.
+
+    Arguments:
+    - path : The path of the pcap file
+    - d2c_ports : The controller ports (device to controller traffic)
+    - c2d_ports : The device ports (controller to device traffic)
+    """
+    d2c_ports = set(d2c_ports)
+    c2d_ports = set(c2d_ports)
+    for pkt in read_udp(path, ports=d2c_ports | c2d_ports):
+        if pkt.dport in d2c_ports:
+            direction = Direction.IN
+        elif pkt.dport in c2d_ports:
+            direction = Direction.OUT
+        else:
+            continue
+        for type, buf, seq, data in \
+                Bybop_NetworkAL.split_frames(pkt.payload):
+            yield Frame(pkt.timestamp, direction, type, buf, seq, data)
+
+
+def read_commands(path, d2c_ports, c2d_ports):
+    """
+    Read and decode the ARCommands of a pcap file.
+
+    Acks, pings and pongs are skipped, as well as unknown commands and data
+    which are not ARCommands.
+
+    Yield (timestamp, direction, command) tuples, where command is the
+    dictionnary returned by Bybop_Commands.unpack_command.
+
+    Arguments:
+    - path : The path of the pcap file
+    - d2c_ports : The controller ports (device to controller traffic)
+    - c2d_ports : The device ports (controller to device traffic)
+    """
+    ack = Bybop_NetworkAL.DataType.ACK
+    for frame in read_frames(path, d2c_ports, c2d_ports):
+        if frame.type == ack or frame.buf in (0, 1):
+            continue
+        try:
+            dico, ok = Bybop_Commands.unpack_command(frame.data)
+        except Bybop_Commands.CommandError:
+            continue
+        if ok:
+            yield frame.timestamp, frame.direction, dico
+
+
+def pcap_to_log(path, basename, d2c_ports, c2d_ports,
+                max_size=64 * 1024 * 1024, writer_class=FrameLogWriter):
+    """
+    Convert a pcap file to the library log format (see Bybop_Recorder).
+
+    The log timestamps are the capture times (wall clock nanoseconds).
+
+    Return the list of log files written.
+
+    Arguments:
+    - path : The path of the pcap file
+    - basename : Path prefix of the log files
+    - d2c_ports : The controller ports (device to controller traffic)
+    - c2d_ports : The device ports (controller to device traffic)
+
+    Keyword arguments:
+    - max_size : Maximum size, in bytes, of each log file (default 64MiB)
+    - writer_class : The FrameLogWriter (sub)class used to write the files
+                     (e.g. Bybop_Index.IndexedFrameLogWriter)
+    """
+    writer = writer_class(basename, max_size=max_size, wall_clock=True)
+    try:
+        for frame in read_frames(path, d2c_ports, c2d_ports):
+            writer.write(*frame)
+    finally:
+        writer.close()
+    return writer.files
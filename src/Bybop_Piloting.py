@@ -0,0 +1,147 @@
+import threading
+import time
+
+import Bybop_Metrics
+
+
+class StalePolicy:
+    HOLD = 0
+    ZERO = 1
+
+
+class PilotingLoop(object):
+    """
+    Fixed rate piloting loop.
+
+    The loop sends the current setpoint (e.g. the PCMD arguments) from a
+    dedicated thread, at absolute deadlines (start + n * period), so that
+    the sending time does not drift, and the time spent in the send is not
+    added to the period. When the loop is late by more than a period, the
+    missed deadlines are skipped instead of being sent in a burst.
+
+    The setpoint is updated without any lock (a tuple is replaced), so set
+    can be called from any thread at any rate. When the setpoint was not
+    updated for stale_timeout seconds, it is either sent again (HOLD policy)
+    or replaced by the neutral setpoint (ZERO policy).
+    """
+
+    def __init__(self, send, neutral, rate=25.0, policy=StalePolicy.HOLD,
+                 stale_timeout=0.5):
+        """
+        Create and start a new piloting loop.
+
+        Arguments:
+        - send : Function called with the setpoint tuple and the tick number
+                 for each deadline
+        - neutral : The neutral setpoint tuple, sent before the first set,
+                    and when a setpoint is stale with the ZERO policy
+
+        Keyword arguments:
+        - rate : The sending rate, in Hz (default 25.0)
+        - policy : The StalePolicy (default HOLD)
+        - stale_timeout : Time, in floating point seconds, after which a
+                          setpoint is stale (default 0.5)
+        """
+        self._send = send
+        self._neutral = tuple(neutral)
+        self._period = 1.0 / rate
+        self._policy = policy
+        self._stale_timeout = stale_timeout
+        # (setpoint, update time), replaced as a whole by set
+        self._setpoint = (self._neutral, None)
+
+        self._hist = Bybop_Metrics.Histogram()
+        self._lock = threading.Lock()
+        self._stats = {
+            'sent': 0,
+            'skipped': 0,
+            'stale': 0,
+            'jitter_max': 0.0,
+            'jitter_sum': 0.0,
+        }
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def set(self, *setpoint):
+        """
+        Set the setpoint sent by the loop.
+
+        Arguments:
+        - *setpoint : The setpoint values
+        """
+        self._setpoint = (setpoint, time.monotonic())
+
+    def neutral(self):
+        """ Set the neutral setpoint """
+        self.set(*self._neutral)
+
+    def stop(self):
+        """
+        Stop the loop.
+
+        Once stopped, a loop can not be restarted.
+        """
+        self._stop.set()
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def get_stats(self):
+        """
+        Get the scheduling statistics.
+
+        Return a dictionnary with the following keys:
+        - sent : Number of setpoints sent
+        - skipped : Number of deadlines missed by more than a period
+        - stale : Number of sends with a stale setpoint
+        - jitter_mean/max : Delay between the deadlines and the actual sends,
+                            in floating point seconds
+        - jitter_p99 : Upper bound of the 99th percentile of the delay
+        """
+        with self._lock:
+            ret = dict(self._stats)
+            p99 = self._hist.quantile(0.99)
+        jitter = ret.pop('jitter_sum')
+        ret['jitter_mean'] = jitter / ret['sent'] if ret['sent'] else 0.0
+        ret['jitter_p99'] = p99 / 1e9 if p99 is not None else 0.0
+        return ret
+
+    def _loop(self):
+        period = self._period
+        start = time.monotonic()
+        tick = 0
+        while True:
+            deadline = start + tick * period
+            delay = deadline - time.monotonic()
+            if delay > 0 and self._stop.wait(delay):
+                break
+            if self._stop.is_set():
+                break
+            now = time.monotonic()
+            late = now - deadline
+            if late >= period:
+                # Skip the missed deadlines, instead of a burst
+                missed = int(late / period)
+                tick += missed
+                late -= missed * period
+                with self._lock:
+                    self._stats['skipped'] += missed
+
+            setpoint, stamp = self._setpoint
+            stale = stamp is None or now - stamp > self._stale_timeout
+            if stale and self._policy == StalePolicy.ZERO:
+                setpoint = self._neutral
+            self._send(setpoint, tick)
+
+            with self._lock:
+                self._stats['sent'] += 1
+                if stale and stamp is not None:
+                    self._stats['stale'] += 1
+                self._stats['jitter_sum'] += late
+                if late > self._stats['jitter_max']:
+                    self._stats['jitter_max'] = late
+                self._hist.observe(int(late * 1e9))
+            if Bybop_Metrics.enabled:
+                Bybop_Metrics.observe('piloting_jitter', int(late * 1e9))
+            tick += 1
@@ -0,0 +1,414 @@
+import atexit
+import collections
+import os
+import struct
+import threading
+import time
+
+
+class Direction:
+    IN = 0
+    OUT = 1
+
+
+# File header : magic, version, wall clock (ns) and monotonic clock (ns) at
+# the time the file was opened. Both clocks are saved so the monotonic
+# timestamps of the records can be converted back to wall clock time.
+_FILE_MAGIC = b'BYBOPREC'
+_FILE_VERSION = 1
+_FILE_HEADER = struct.Struct('<8sHQQ')
+
+# Record header : monotonic timestamp (ns), direction, ARNetworkAL data type,
+# buffer, sequence number and payload size. The payload follows the header.
+_RECORD_HEADER = struct.Struct('<QBBBBI')
+
+_FILE_SUFFIX = '.frames'
+
+
+Frame = collections.namedtuple(
+    'Frame', ['timestamp', 'direction', 'type', 'buf', 'seq', 'data'])
+
+
+def _indexed_log_files(basename):
+    dirname, prefix = os.path.split(basename)
+    prefix += '.'
+    ret = []
+    try:
+        names = os.listdir(dirname or '.')
+    except OSError:
+        return ret
+    for f in names:
+        if not f.startswith(prefix) or not f.endswith(_FILE_SUFFIX):
+            continue
+        idx = f[len(prefix):-len(_FILE_SUFFIX)]
+        if idx.isdigit():
+            ret.append((int(idx), os.path.join(dirname, f)))
+    return sorted(ret)
+
+
+def log_files(basename):
+    """
+    Get the list of the log files written for the given basename.
+
+    The files are sorted in recording order.
+
+    Arguments:
+    - basename : The basename given to the FrameLogWriter/FrameRecorder
+    """
+    return [path for _, path in _indexed_log_files(basename)]
+
+
+def read_header(f):
+    """
+    Read the header of a log file.
+
+    Return a (wall_clock_ns, monotonic_ns) tuple, taken when the file was
+    opened.
+
+    A ValueError is raised if the file is not a frames log.
+
+    Arguments:
+    - f : The file object, opened in binary mode, positioned at its start
+    """
+    raw = f.read(_FILE_HEADER.size)
+    if len(raw) != _FILE_HEADER.size:
+        raise ValueError('Truncated log header')
+    magic, version, wall_ns, mono_ns = _FILE_HEADER.unpack(raw)
+    if magic != _FILE_MAGIC:
+        raise ValueError('Not a frames log')
+    if version != _FILE_VERSION:
+        raise ValueError('Unsupported log version %d' % version)
+    return wall_ns, mono_ns
+
+
+def iter_records(f):
+    """
+    Iterate over the records of an opened log file.
+
+    Yield (offset, Frame) tuples, where offset is the position of the record
+    in the file. A truncated last record (e.g. after a crash) is ignored.
+
+    Arguments:
+    - f : The file object, opened in binary mode, positioned just after the
+          header (see read_header)
+    """
+    hsize = _RECORD_HEADER.size
+    unpack = _RECORD_HEADER.unpack
+    offset = f.tell()
+    while True:
+        raw = f.read(hsize)
+        if len(raw) != hsize:
+            return
+        ts, direction, type, buf, seq, size = unpack(raw)
+        data = f.read(size)
+        if len(data) != size:
+            return
+        yield offset, Frame(ts, direction, type, buf, seq, data)
+        offset += hsize + size
+
+
+def is_log_source(source):
+    """
+    Check whether a source is a log (a file path, a basename or a list of
+    file paths), as opposed to an iterable of frames or messages.
+
+    Arguments:
+    - source : The source to check
+    """
+    if isinstance(source, str):
+        return True
+    if isinstance(source, (list, tuple)):
+        return bool(source) and all(isinstance(p, str) for p in source)
+    return False
+
+
+def read_record_at(buf, offset):
+    """
+    Read a single record from a log content.
+
+    Return a Frame.
+
+    Arguments:
+    - buf : The log content (bytes, or any buffer, e.g. a mmap of the file)
+    - offset : The offset of the record in the log
+    """
+    ts, direction, type, rbuf, seq, size = _RECORD_HEADER.unpack_from(buf,
+                                                                      offset)
+    start = offset + _RECORD_HEADER.size
+    return Frame(ts, direction, type, rbuf, seq, bytes(buf[start:start + size]))
+
+
+def read_frames(paths):
+    """
+    Read the frames of one or many log files.
+
+    Yield Frame tuples. The timestamp of the frames is the monotonic clock
+    value, in nanoseconds, at which the frame was sent or received.
+
+    Arguments:
+    - paths : A log file path, a list of log file paths, or a basename (in
+              which case all the files of the basename are read)
+    """
+    if isinstance(paths, str):
+        if os.path.isfile(paths):
+            paths = [paths]
+        else:
+            paths = log_files(paths)
+    for path in paths:
+        with open(path, 'rb') as f:
+            read_header(f)
+            for _, frame in iter_records(f):
+                yield frame
+
+
+def frame_record_size(data):
+    """ Get the size, in the log file, of a record with the given payload """
+    return _RECORD_HEADER.size + len(data)
+
+
+class FrameLogWriter(object):
+    """
+    Synchronous writer of frames log files.
+
+    The log is split in many files, each of them limited to max_size bytes.
+    The files are named '<basename>.<index>.frames', index being a four digit
+    counter starting after the last existing file.
+
+    This class is not thread-safe. For live recording, use a FrameRecorder,
+    which owns a FrameLogWriter in its writer thread.
+    """
+
+    def __init__(self, basename, max_size=64 * 1024 * 1024,
+                 wall_clock=False):
+        """
+        Create a new writer.
+
+        Arguments:
+        - basename : Path prefix of the log files
+
+        Keyword arguments:
+        - max_size : Maximum size, in bytes, of each file (default 64MiB)
+        - wall_clock : The timestamps given to write are wall clock
+                       nanoseconds instead of monotonic clock nanoseconds
+                       (e.g. when converting captures, default False)
+        """
+        self._basename = basename
+        self._max_size = max_size
+        self._wall_clock = wall_clock
+        self._file = None
+        self._size = 0
+        self._path = None
+        dirname = os.path.dirname(basename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        existing = _indexed_log_files(basename)
+        self._index = existing[-1][0] + 1 if existing else 0
+        self.files = []
+
+    def _open(self):
+        self._path = '%s.%04d%s' % (self._basename, self._index,
+                                    _FILE_SUFFIX)
+        self._index += 1
+        self._file = open(self._path, 'wb')
+        wall_ns = time.time_ns()
+        # With wall clock timestamps, both clocks are the same
+        mono_ns = wall_ns if self._wall_clock else time.monotonic_ns()
+        self._file.write(_FILE_HEADER.pack(_FILE_MAGIC, _FILE_VERSION,
+                                           wall_ns, mono_ns))
+        self._size = _FILE_HEADER.size
+        self.files.append(self._path)
+        self._on_open(self._path)
+
+    def _on_open(self, path):
+        # Hook for subclasses, called after a new file is opened
+        pass
+
+    def _on_record(self, offset, ts, direction, type, buf, seq, data):
+        # Hook for subclasses, called after a record is written
+        pass
+
+    def _rotate(self):
+        self._close_file()
+        self._open()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def write(self, ts, direction, type, buf, seq, data):
+        """
+        Write a record.
+
+        Arguments:
+        - ts : Timestamp of the frame, in monotonic clock nanoseconds
+        - direction : Direction.IN or Direction.OUT
+        - type : The ARNetworkAL type of the frame
+        - buf : The buffer of the frame
+        - seq : The sequence number of the frame
+        - data : The payload of the frame
+        """
+        size = _RECORD_HEADER.size + len(data)
+        if self._file is None:
+            self._open()
+        elif self._size + size > self._max_size and \
+                self._size > _FILE_HEADER.size:
+            self._rotate()
+        offset = self._size
+        self._file.write(_RECORD_HEADER.pack(ts, direction, type, buf, seq,
+                                             len(data)))
+        self._file.write(data)
+        self._size += size
+        self._on_record(offset, ts, direction, type, buf, seq, data)
+
+    def flush(self):
+        """ Flush the current file """
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        """ Close the current file """
+        self._close_file()
+
+
+class FrameRecorder(object):
+    """
+    Low overhead recorder of all the ARNetworkAL frames of a device.
+
+    The record function only timestamps the frame and queues it, the actual
+    file write is done by a background writer thread. This makes it safe to
+    call from the NetworkAL read thread, or from any sending thread.
+
+    To use it, give it to a Device (or Network/NetworkAL) with the 'recorder'
+    keyword argument. Call close() when done to flush the remaining frames.
+    """
+
+    def __init__(self, basename, max_size=64 * 1024 * 1024,
+                 flush_interval=0.05, writer_class=FrameLogWriter,
+                 max_pending=65536):
+        """
+        Create and start a new recorder.
+
+        Arguments:
+        - basename : Path prefix of the log files (see FrameLogWriter)
+
+        Keyword arguments:
+        - max_size : Maximum size, in bytes, of each file (default 64MiB)
+        - flush_interval : Interval, in floating point seconds, between two
+                           writes of the queued frames (default 0.05)
+        - writer_class : The FrameLogWriter (sub)class used to write the files
+        - max_pending : Maximum number of frames waiting for the writer
+                        thread. Frames recorded when the queue is full are
+                        dropped (and counted, see get_stats)
+                        (default 65536)
+        """
+        self._writer = writer_class(basename, max_size=max_size)
+        self._queue = collections.deque()
+        self._max_pending = max_pending
+        self._flush_interval = flush_interval
+        self._stop_event = threading.Event()
+        self._nb_frames = 0
+        self._nb_bytes = 0
+        self._nb_dropped = 0
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._write_loop)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, direction, type, buf, seq, data):
+        """
+        Record a frame.
+
+        This function is called by NetworkAL for each frame, and only queues
+        it for the writer thread. The frame is dropped if the queue is full,
+        or if the writer failed. This function has no effect on a closed
+        recorder.
+
+        Arguments:
+        - direction : Direction.IN or Direction.OUT
+        - type : The ARNetworkAL type of the frame
+        - buf : The buffer of the frame
+        - seq : The sequence number of the frame
+        - data : The payload of the frame
+        """
+        if self._closed:
+            return
+        if self._error is not None or \
+                len(self._queue) >= self._max_pending:
+            self._nb_dropped += 1
+            return
+        self._queue.append((time.monotonic_ns(), direction, type, buf, seq,
+                            data))
+
+    def _drain(self):
+        queue = self._queue
+        write = self._writer.write
+        nb = 0
+        size = 0
+        try:
+            while queue:
+                rec = queue.popleft()
+                write(*rec)
+                nb += 1
+                size += frame_record_size(rec[5])
+            if nb:
+                self._writer.flush()
+        finally:
+            self._nb_frames += nb
+            self._nb_bytes += size
+
+    def _write_loop(self):
+        try:
+            while not self._stop_event.wait(self._flush_interval):
+                self._drain()
+            self._drain()
+        except (IOError, OSError, ValueError) as e:
+            print('Frames recorder write error : ' + str(e))
+            self._error = e
+            # Frames still queued will never be written
+            self._nb_dropped += len(self._queue)
+            self._queue.clear()
+        try:
+            self._writer.close()
+        except (IOError, OSError) as e:
+            print('Frames recorder close error : ' + str(e))
+            if self._error is None:
+                self._error = e
+
+    def get_stats(self):
+        """
+        Get the recorder statistics.
+
+        Return a dictionnary with the following keys:
+        - frames : Number of frames written
+        - bytes : Number of bytes written (without file headers)
+        - pending : Number of frames waiting for the writer thread
+        - dropped : Number of frames dropped because the queue was full, or
+                    because of a write error
+        - error : The write error which stopped the writer thread (None if
+                  no error occured)
+        - files : List of the files written
+        """
+        return {
+            'frames': self._nb_frames,
+            'bytes': self._nb_bytes,
+            'pending': len(self._queue),
+            'dropped': self._nb_dropped,
+            'error': self._error,
+            'files': list(self._writer.files),
+        }
+
+    def close(self):
+        """
+        Stop the recorder, after writing all the queued frames.
+
+        This function has no effect on a closed recorder.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._stop_event.set()
+        self._thread.join()
+        atexit.unregister(self.close)
@@ -0,0 +1,229 @@
+import threading
+import time
+
+import Bybop_Device
+import Bybop_NetworkAL
+from Bybop_Recorder import Direction, is_log_source, read_frames
+
+
+class NullNetworkAL(object):
+    """
+    ARNetworkAL backend which does not use the network.
+
+    All the sends are successful (and counted), nothing is ever received.
+    This is used to run a Network (and a Device) offline, with its incoming
+    data given by a Replay.
+    """
+
+    def __init__(self):
+        self.sent_frames = 0
+        self.sent_bytes = 0
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def set_recorder(self, recorder):
+        pass
+
+    def send_data(self, type, buf, seq, data):
+        self.sent_frames += 1
+        self.sent_bytes += len(data)
+        return True
+
+
+class ReplayDevice(Bybop_Device.Device):
+    def __init__(self, ackBuffer=11, nackBuffer=10, urgBuffer=12,
+                 cmdBuffers=[127, 126], verbose=False):
+        """
+        Create a new offline Device, to be fed by a Replay.
+
+        The device does not use the network (see NullNetworkAL), and skips all
+        the initialization phase. The default buffers are the ones used by all
+        the Wifi products.
+
+        Keyword arguments:
+        - ackBuffer : The buffer for acknowledged data (-1 if no buffer)
+        - nackBuffer : The buffer for non acknowledged data (-1 if no buffer)
+        - urgBuffer : The buffer for high priority data (-1 if no buffer)
+        - cmdBuffers : The buffers from the device which contains ARCommands
+        - verbose : Set verbose mode (prints sent/received commands)
+        """
+        super(ReplayDevice, self).__init__('127.0.0.1', 0, 0,
+                                           ackBuffer=ackBuffer,
+                                           nackBuffer=nackBuffer,
+                                           urgBuffer=urgBuffer,
+                                           cmdBuffers=cmdBuffers,
+                                           skipCommonInit=True,
+                                           verbose=verbose,
+                                           netal=NullNetworkAL())
+
+    def _init_product(self):
+        pass
+
+    def get_network(self):
+        """ Get the offline Network of the device """
+        return self._network
+
+
+class Replay(object):
+    """
+    Replay recorded frames as if they were received from the network.
+
+    The frames are given to a NetworkAL listener (usually a Network, which
+    will give them to its Device), from the thread calling run(), or from a
+    background thread with start().
+
+    The replay speed can be real time (speed=1.0), N times faster
+    (speed=N), or as fast as possible (speed=None). In this last case, the
+    replay doubles as a benchmark of the whole decoding pipeline.
+    """
+
+    def __init__(self, source, listener, speed=1.0,
+                 directions=(Direction.IN,)):
+        """
+        Create a new replay.
+
+        Arguments:
+        - source : The frames to replay. Either a log file path, a list of
+                   log file paths, a log basename (see Bybop_Recorder), or any
+                   iterable of Bybop_Recorder.Frame.
+        - listener : The NetworkAL listener which will receive the frames. If a
+                     ReplayDevice is given, its Network is used.
+
+        Keyword arguments:
+        - speed : Replay speed factor, or None to replay as fast as possible
+                  (default 1.0)
+        - directions : The directions of the frames to replay (default
+                       incoming frames only)
+        """
+        if isinstance(listener, ReplayDevice):
+            listener = listener.get_network()
+        self._source = source
+        self._listener = listener
+        self._speed = speed if speed else None
+        self._directions = tuple(directions)
+        self._alive = False
+        self._thread = None
+        self._stats = {}
+
+    def _frames(self):
+        if is_log_source(self._source):
+            return read_frames(self._source)
+        return iter(self._source)
+
+    def run(self):
+        """
+        Run the replay in the current thread.
+
+        Return the replay statistics (see get_stats).
+        """
+        self._alive = True
+        speed = self._speed
+        listener = self._listener
+        directions = self._directions
+        ack = Bybop_NetworkAL.DataType.ACK
+        nb_frames = 0
+        nb_msgs = 0
+        nb_bytes = 0
+        first_ts = None
+        start = time.perf_counter()
+        for frame in self._frames():
+            if not self._alive:
+                break
+            if frame.direction not in directions:
+                continue
+            if speed is not None:
+                if first_ts is None:
+                    first_ts = frame.timestamp
+                deadline = start + (frame.timestamp - first_ts) / 1e9 / speed
+                delay = deadline - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            listener.data_received(frame.type, frame.buf, frame.seq,
+                                   frame.data)
+            nb_frames += 1
+            nb_bytes += len(frame.data)
+            if frame.type != ack and frame.buf != 0:
+                nb_msgs += 1
+        elapsed = time.perf_counter() - start
+        self._alive = False
+        self._stats = {
+            'frames': nb_frames,
+            'messages': nb_msgs,
+            'bytes': nb_bytes,
+            'elapsed': elapsed,
+            'frames_per_second': nb_frames / elapsed if elapsed else 0.0,
+            'messages_per_second': nb_msgs / elapsed if elapsed else 0.0,
+        }
+        return self.get_stats()
+
+    def start(self):
+        """
+        Run the replay in a background thread.
+
+        This function has no effect if the replay is already running.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the replay after the current frame """
+        self._alive = False
+
+    def join(self, timeout=None):
+        """
+        Wait for the end of a replay started with start().
+
+        Keyword arguments:
+        - timeout : Timeout in floating point seconds (default None)
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def get_stats(self):
+        """
+        Get the statistics of the last run.
+
+        Return a dictionnary with the following keys:
+        - frames : Number of frames replayed
+        - messages : Number of data frames replayed (no acks, no pings)
+        - bytes : Number of payload bytes replayed
+        - elapsed : Duration of the replay, in floating point seconds
+        - frames_per_second : Replayed frames rate
+        - messages_per_second : Replayed messages rate
+        """
+        return dict(self._stats)
+
+
+def benchmark(source, repeat=1, **kwargs):
+    """
+    Measure the throughput of the decoding pipeline on recorded traffic.
+
+    The frames are replayed as fast as possible in a new ReplayDevice (for
+    each repetition), from the network layer to the device State.
+
+    Return a list of statistics dictionnaries (see Replay.get_stats), one for
+    each repetition.
+
+    Arguments:
+    - source : The frames to replay (see Replay)
+
+    Keyword arguments:
+    - repeat : Number of repetitions (default 1)
+    - other keyword arguments are given to the ReplayDevice constructor
+    """
+    if not is_log_source(source):
+        # Iterables can only be read once, keep them in memory
+        source = list(source)
+    ret = []
+    for _ in range(repeat):
+        device = ReplayDevice(**kwargs)
+        ret.append(Replay(source, device, speed=None).run())
+        device.stop()
+    return ret
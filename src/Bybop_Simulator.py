@@ -0,0 +1,923 @@
+import heapq
+import itertools
+import json
+import math
+import random
+import socket
+import struct
+import threading
+import time
+
+import Bybop_Commands
+import Bybop_Discovery
+import Bybop_NetworkAL
+import arsdkparser
+from Bybop_Discovery import DeviceID
+from Bybop_NetworkAL import DataType
+
+# Maximum RTP packet size of the simulated video streams
+_RTP_MAX_PACKET_SIZE = 1500
+
+
+class Impairment(object):
+    """
+    Network impairments applied to the data sent by a SimulatedDevice.
+
+    Each datagram can be lost, delayed (fixed delay plus random jitter), or
+    reordered (held back for an additional delay, so that the next datagrams
+    overtake it).
+    """
+
+    def __init__(self, loss=0.0, delay=0.0, jitter=0.0, reorder=0.0,
+                 reorder_delay=0.05, seed=None):
+        """
+        Create a new impairment.
+
+        Keyword arguments:
+        - loss : Probability [0; 1] of losing a datagram (default 0.0)
+        - delay : Fixed delay, in floating point seconds (default 0.0)
+        - jitter : Maximum random additional delay, in floating point seconds
+                   (default 0.0)
+        - reorder : Probability [0; 1] of reordering a datagram (default 0.0)
+        - reorder_delay : Additional delay of reordered datagrams, in
+                          floating point seconds (default 0.05)
+        - seed : Seed of the random generator, for reproducible runs
+                 (default None)
+        """
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self._random = random.Random(seed)
+
+    def schedule(self, now):
+        """
+        Get the send time of a datagram, or None if the datagram is lost.
+
+        Arguments:
+        - now : The current time
+        """
+        rnd = self._random
+        if self.loss and rnd.random() < self.loss:
+            return None
+        due = now + self.delay
+        if self.jitter:
+            due += rnd.uniform(0.0, self.jitter)
+        if self.reorder and rnd.random() < self.reorder:
+            due += self.reorder_delay
+        return due
+
+
+class TelemetryStream(object):
+    """
+    A command periodically sent by a SimulatedDevice once connected.
+    """
+
+    def __init__(self, name, rate, args=()):
+        """
+        Create a new telemetry stream.
+
+        Arguments:
+        - name : The command, in 'project.class.command' notation
+        - rate : The emission rate, in Hz
+
+        Keyword arguments:
+        - args : The command arguments. Either a tuple, or a function called
+                 with the time (floating point seconds) since the connection,
+                 and returning the arguments tuple (default ())
+        """
+        self.name = name
+        self.rate = float(rate)
+        self.args = args
+
+    def get_args(self, t):
+        if callable(self.args):
+            return tuple(self.args(t))
+        return tuple(self.args)
+
+
+def default_telemetry():
+    """
+    Get a list of telemetry streams similar to the ones of a flying Bebop.
+    """
+    return [
+        TelemetryStream('common.CommonState.BatteryStateChanged', 1.0,
+                        lambda t: (max(0, 100 - int(t / 12)),)),
+        TelemetryStream('ardrone3.PilotingState.SpeedChanged', 5.0,
+                        lambda t: (math.cos(t), math.sin(t), 0.0)),
+        TelemetryStream('ardrone3.PilotingState.AttitudeChanged', 5.0,
+                        lambda t: (0.0, 0.0, t % (2 * math.pi) - math.pi)),
+        TelemetryStream('ardrone3.PilotingState.AltitudeChanged', 5.0,
+                        lambda t: (10.0 + math.sin(t / 10),)),
+        TelemetryStream('ardrone3.PilotingState.PositionChanged', 1.0,
+                        lambda t: (48.879 + math.sin(t) * 1e-4,
+                                   2.367 + math.cos(t) * 1e-4, 10.0)),
+    ]
+
+
+class SimulatedDevice(object):
+    """
+    Simulated ARSDK device, running the device side of the protocols.
+
+    The simulator answers the json discovery handshake over TCP, then runs
+    the device side of ARNetworkAL/ARNetwork over UDP: it acknowledges the
+    controller acknowledged data, pings the controller on buffer 0, uses per
+    buffer sequence numbers, and retries its own acknowledged data.
+
+    It answers the AllSettings/AllStates requests with the configured
+    settings and states, and emits the configured telemetry streams once a
+    controller is connected. Network impairments can be applied to all the
+    data sent to the controller.
+
+    Each simulator uses three threads (handshake server, UDP reader and a
+    scheduler), and ephemeral ports by default, so many simulators can run in
+    the same process.
+    """
+
+    def __init__(self, device_id=DeviceID.BEBOP_2, name='bybop-sim',
+                 ip='127.0.0.1', discovery_port=0, telemetry=None,
+                 settings=(), states=(), impairment=None, ping_period=1.0,
+                 ack_timeout=0.15, ack_tries=5, cmd_buffers=(10, 11, 12),
+                 video=False, video_impairment=None):
+        """
+        Create and start a new simulated device.
+
+        Keyword arguments:
+        - device_id : The product id (see Bybop_Discovery.DeviceID)
+        - name : The product name
+        - ip : The address on which the simulator listens
+        - discovery_port : The TCP handshake port (default 0, ephemeral)
+        - telemetry : List of TelemetryStream (default None, no telemetry)
+        - settings : List of (name, args) commands sent after an AllSettings
+                     request, before AllSettingsChanged
+        - states : List of (name, args) commands sent after an AllStates
+                   request, before AllStatesChanged
+        - impairment : An Impairment for the data sent to the controller
+                       (default None, no impairment)
+        - ping_period : Period, in floating point seconds, of the pings sent
+                        to the controller (default 1.0, None to disable)
+        - ack_timeout : Timeout for the controller acks (default 0.15)
+        - ack_tries : Total number of tries for acknowledged data (default 5)
+        - cmd_buffers : The buffers on which the controller sends commands
+        - video : Start an RtpSender on each connection, to the stream ports
+                  of the controller, and advertise its ports in the
+                  handshake answer (default False, no video stream)
+        - video_impairment : An Impairment for the RTP packets (default
+                             None, no impairment)
+        """
+        self._device_id = device_id
+        self._name = name
+        self._ip = ip
+        self._telemetry = list(telemetry or [])
+        self._settings = list(settings)
+        self._states = list(states)
+        self._impairment = impairment
+        self._ping_period = ping_period
+        self._ack_timeout = ack_timeout
+        self._ack_tries = ack_tries
+        self._cmd_buffers = set(cmd_buffers)
+        self._video = video
+        self._video_impairment = video_impairment
+        self._rtp_sender = None
+        self._handlers = {}
+
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._heap = []
+        self._counter = itertools.count()
+        self._send_seq = {}
+        self._recv_seq = {}
+        self._pending_acks = {}
+        self._controller = None
+        self._stream = None
+        self._session = 0
+        self._connect_time = 0.0
+        self._alive = True
+        self._stats = {
+            'commands_received': 0,
+            'frames_sent': 0,
+            'frames_received': 0,
+            'frames_dropped': 0,
+            'retransmits': 0,
+            'acks_sent': 0,
+            'acks_received': 0,
+            'pongs': 0,
+            'last_rtt': None,
+            'stream_frames_acked': 0,
+        }
+
+        self._tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._tcp.bind((ip, discovery_port))
+        self._tcp.listen(4)
+        self._tcp.settimeout(0.5)
+        self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._udp.bind((ip, 0))
+        self._udp.settimeout(0.5)
+
+        self.on_command('common.Settings.AllSettings', _send_all_settings)
+        self.on_command('common.Common.AllStates', _send_all_states)
+
+        self._threads = [threading.Thread(target=self._tcp_loop),
+                         threading.Thread(target=self._udp_loop),
+                         threading.Thread(target=self._scheduler_loop)]
+        for th in self._threads:
+            th.daemon = True
+            th.start()
+
+    def stop(self):
+        """
+        Stop the simulator.
+
+        Once stopped, a simulator can not be restarted.
+        """
+        with self._lock:
+            self._alive = False
+            self._cond.notify_all()
+        for th in self._threads:
+            th.join()
+        self._tcp.close()
+        self._udp.close()
+        if self._rtp_sender is not None:
+            self._rtp_sender.stop()
+
+    def get_discovery_port(self):
+        """ Get the TCP port of the discovery handshake """
+        return self._tcp.getsockname()[1]
+
+    def get_c2d_port(self):
+        """ Get the UDP port on which the simulator reads """
+        return self._udp.getsockname()[1]
+
+    def get_rtp_sender(self):
+        """
+        Get the RtpSender of the current connection (None if the video is
+        disabled, or before the first connection).
+        """
+        return self._rtp_sender
+
+    def get_device(self):
+        """
+        Get a device object, as returned by Bybop_Discovery, for this
+        simulator. This object can be given to Bybop_Device.create_and_connect.
+        """
+        service_type = '_arsdk-%s._udp.local.' % self._device_id
+        return Bybop_Discovery.CachedDevice(
+            self._name + '.' + service_type, service_type, self._ip,
+            self.get_discovery_port(), time.time())
+
+    def get_stats(self):
+        """
+        Get the simulator statistics.
+
+        Return a dictionnary with the following keys:
+        - commands_received : Number of commands received
+        - frames_sent : Number of frames sent (retransmits included)
+        - frames_received : Number of frames received
+        - frames_dropped : Number of datagrams lost by the impairment
+        - retransmits : Number of retransmitted acknowledged frames
+        - acks_sent : Number of acks sent
+        - acks_received : Number of acks received
+        - pongs : Number of pongs received
+        - last_rtt : Last round trip time measured by a ping, in floating
+                     point seconds (None if no pong was received)
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def on_command(self, name, callback):
+        """
+        Set the handler of a command received from the controller.
+
+        The callback is called from the UDP reader thread, with the simulator
+        and the command dictionnary (see Bybop_Commands.unpack_command) as
+        arguments.
+
+        Arguments:
+        - name : The command, in 'project.class.command' notation
+        - callback : The handler, or None to remove the handler
+        """
+        if callback is None:
+            self._handlers.pop(name, None)
+        else:
+            self._handlers[name] = callback
+
+    def send_command(self, name, *args):
+        """
+        Send a command to the connected controller.
+
+        The command is sent on the acknowledged (126) or non acknowledged
+        (127) buffer, depending on its buffer type. Acknowledged commands are
+        retried until acknowledged, or until all the tries are used.
+
+        Return False if no controller is connected, or if the command can not
+        be packed.
+
+        Arguments:
+        - name : The command, in 'project.class.command' notation
+        - *args : The arguments of the command
+        """
+        try:
+            pr, cl, cm = name.split('.')
+            data, buftype, _ = Bybop_Commands.pack_command(pr, cl, cm, *args)
+        except (ValueError, Bybop_Commands.CommandError) as e:
+            print('Simulator : bad command ' + name + ' : ' + str(e))
+            return False
+        if buftype == arsdkparser.ArCmdBufferType.ACK:
+            return self._send_frame(DataType.DATA_WITH_ACK, 126, data)
+        return self._send_frame(DataType.DATA, 127, data)
+
+    def send_stream_frame(self, data, keyframe=False, fragment_size=1000,
+                          data_buffer=125):
+        """
+        Send a video frame with the ARStream (v1) protocol.
+
+        The frame is split in fragments, and the fragments which are not
+        acknowledged by the controller are sent again (every ack_timeout,
+        ack_tries times at most) until the next frame is sent.
+
+        Return False if no controller is connected.
+
+        Arguments:
+        - data : The frame data
+
+        Keyword arguments:
+        - keyframe : Whether the frame is a flush frame (default False)
+        - fragment_size : The fragments size (default 1000)
+        - data_buffer : The buffer of the fragments (default 125)
+        """
+        fragments = [data[i:i + fragment_size]
+                     for i in range(0, len(data), fragment_size)] or [b'']
+        if len(fragments) > 128:
+            raise ValueError('Frame too large')
+        with self._lock:
+            if self._controller is None or not self._alive:
+                return False
+            number = (self._stream[0] + 1) & 0xffff \
+                if self._stream is not None else 0
+            flags = 1 if keyframe else 0
+            frags = [struct.pack('<HBBB', number, flags, idx,
+                                 len(fragments)) + frag
+                     for idx, frag in enumerate(fragments)]
+            self._stream = [number, frags, 0, data_buffer]
+            self._send_stream(number, self._ack_tries, self._session)
+        return True
+
+    def _send_stream(self, number, tries, session):
+        # Called with the lock held
+        stream = self._stream
+        if session != self._session or stream is None or \
+                stream[0] != number or tries <= 0:
+            return
+        _, frags, mask, buf = stream
+        if mask == (1 << len(frags)) - 1:
+            return
+        if tries != self._ack_tries:
+            self._stats['retransmits'] += 1
+        for idx, frag in enumerate(frags):
+            if not mask & (1 << idx):
+                frame = struct.pack('<BBBI', DataType.DATA_LOW_LATENCY, buf,
+                                    self._next_seq(buf),
+                                    len(frag) + 7) + frag
+                self._send_datagram(frame)
+        self._schedule(time.monotonic() + self._ack_timeout, self._send_stream,
+                       number, tries - 1, session)
+
+    def _stream_ack_received(self, data):
+        # Called with the lock held
+        stream = self._stream
+        try:
+            number, high, low = struct.unpack('<HQQ', data)
+        except struct.error:
+            return
+        if stream is None or stream[0] != number:
+            return
+        full = (1 << len(stream[1])) - 1
+        was_full = stream[2] == full
+        stream[2] = (high << 64) | low
+        if stream[2] == full and not was_full:
+            self._stats['stream_frames_acked'] += 1
+
+    def _next_seq(self, buf):
+        seq = self._send_seq.get(buf, 0)
+        self._send_seq[buf] = (seq + 1) % 256
+        return seq
+
+    def _send_frame(self, type, buf, data, seq=None):
+        with self._lock:
+            if self._controller is None or not self._alive:
+                return False
+            if seq is None:
+                seq = self._next_seq(buf)
+            frame = struct.pack('<BBBI', type, buf, seq, len(data) + 7) + data
+            if type == DataType.DATA_WITH_ACK:
+                key = (buf, seq)
+                self._pending_acks[key] = self._ack_tries - 1
+                self._schedule(time.monotonic() + self._ack_timeout,
+                               self._retry, key, type, data, self._session)
+            self._send_datagram(frame)
+        return True
+
+    def _send_datagram(self, frame):
+        # Called with the lock held
+        now = time.monotonic()
+        due = now
+        if self._impairment is not None:
+            due = self._impairment.schedule(now)
+            if due is None:
+                self._stats['frames_dropped'] += 1
+                return
+        if due <= now:
+            self._sendto(frame, self._controller)
+        else:
+            self._schedule(due, self._sendto, frame, self._controller)
+
+    def _sendto(self, frame, addr):
+        try:
+            self._udp.sendto(frame, addr)
+            self._stats['frames_sent'] += 1
+        except (socket.error, OSError):
+            pass
+
+    def _retry(self, key, type, data, session):
+        # Called from the scheduler, with the lock held
+        if session != self._session or key not in self._pending_acks:
+            return
+        tries = self._pending_acks[key]
+        if tries <= 0:
+            del self._pending_acks[key]
+            return
+        self._pending_acks[key] = tries - 1
+        self._stats['retransmits'] += 1
+        buf, seq = key
+        frame = struct.pack('<BBBI', type, buf, seq, len(data) + 7) + data
+        self._send_datagram(frame)
+        self._schedule(time.monotonic() + self._ack_timeout, self._retry, key,
+                       type, data, session)
+
+    def _schedule(self, due, fn, *args):
+        # Called with the lock held
+        heapq.heappush(self._heap, (due, next(self._counter), fn, args))
+        self._cond.notify()
+
+    def _scheduler_loop(self):
+        with self._lock:
+            while self._alive:
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    _, _, fn, args = heapq.heappop(self._heap)
+                    fn(*args)
+                    continue
+                timeout = self._heap[0][0] - now if self._heap else None
+                self._cond.wait(timeout)
+
+    def _start_session(self, controller):
+        with self._lock:
+            self._session += 1
+            self._controller = controller
+            self._connect_time = time.monotonic()
+            self._send_seq = {}
+            self._recv_seq = {}
+            self._pending_acks = {}
+            session = self._session
+            now = time.monotonic()
+            for stream in self._telemetry:
+                if stream.rate > 0:
+                    self._schedule(now + 1.0 / stream.rate, self._emit,
+                                   stream, session)
+            if self._ping_period:
+                self._schedule(now + self._ping_period, self._ping, session)
+
+    def _emit(self, stream, session):
+        # Called from the scheduler, with the lock held
+        if session != self._session:
+            return
+        args = stream.get_args(time.monotonic() - self._connect_time)
+        try:
+            pr, cl, cm = stream.name.split('.')
+            data, _, _ = Bybop_Commands.pack_command(pr, cl, cm, *args)
+        except (ValueError, Bybop_Commands.CommandError) as e:
+            print('Simulator : dropping telemetry ' + stream.name + ' : ' +
+                  str(e))
+            return
+        seq = self._next_seq(127)
+        frame = struct.pack('<BBBI', DataType.DATA, 127, seq,
+                            len(data) + 7) + data
+        self._send_datagram(frame)
+        self._schedule(time.monotonic() + 1.0 / stream.rate, self._emit, stream,
+                       session)
+
+    def _ping(self, session):
+        # Called from the scheduler, with the lock held
+        if session != self._session:
+            return
+        now = time.monotonic()
+        data = struct.pack('<qq', int(now), int((now % 1) * 1e9))
+        seq = self._next_seq(0)
+        frame = struct.pack('<BBBI', DataType.DATA, 0, seq,
+                            len(data) + 7) + data
+        self._send_datagram(frame)
+        self._schedule(now + self._ping_period, self._ping, session)
+
+    def _tcp_loop(self):
+        while self._alive:
+            try:
+                conn, addr = self._tcp.accept()
+            except socket.timeout:
+                continue
+            except (socket.error, OSError):
+                break
+            try:
+                conn.settimeout(2.0)
+                self._handshake(conn, addr)
+            except (socket.error, OSError, ValueError):
+                pass
+            finally:
+                conn.close()
+
+    def _handshake(self, conn, addr):
+        data = b''
+        request = None
+        while request is None:
+            chunk = conn.recv(4096)
+            if not chunk:
+                return
+            data += chunk
+            try:
+                request = json.loads(data.rstrip(b'\0').decode('utf-8'))
+            except ValueError:
+                continue
+        answer = {
+            'status': 0,
+            'c2d_port': self.get_c2d_port(),
+            'c2d_update_port': 51,
+            'c2d_user_port': 21,
+        }
+        if self._video:
+            sender = self._start_video(addr[0], request)
+            answer.update({
+                'arstream2_server_stream_port': sender.get_stream_port(),
+                'arstream2_server_control_port': sender.get_control_port(),
+                'arstream2_max_packet_size': _RTP_MAX_PACKET_SIZE,
+                'arstream2_max_latency': 0,
+                'arstream2_max_network_latency': 200,
+                'arstream2_max_bitrate': 1500000,
+                'arstream2_parameter_sets': '',
+            })
+        conn.sendall(bytes(json.dumps(answer, separators=(',', ':')),
+                           'utf-8') + b'\0')
+        self._start_session((addr[0], int(request['d2c_port'])))
+
+    def _start_video(self, ip, request):
+        # Replace the sender of the previous connection
+        if self._rtp_sender is not None:
+            self._rtp_sender.stop()
+        self._rtp_sender = RtpSender(
+            ip=ip,
+            stream_port=request.get('arstream2_client_stream_port', 55004),
+            control_port=request.get('arstream2_client_control_port', 55005),
+            max_packet_size=_RTP_MAX_PACKET_SIZE,
+            impairment=self._video_impairment, bind_ip=self._ip)
+        return self._rtp_sender
+
+    def _udp_loop(self):
+        while self._alive:
+            try:
+                sock_data, _ = self._udp.recvfrom(66000)
+            except socket.timeout:
+                continue
+            except (socket.error, OSError):
+                break
+            for type, buf, seq, data in \
+                    Bybop_NetworkAL.split_frames(sock_data):
+                self._frame_received(type, buf, seq, data)
+
+    def _frame_received(self, type, buf, seq, data):
+        with self._lock:
+            self._stats['frames_received'] += 1
+            if type == DataType.ACK:
+                if len(data) >= 1:
+                    key = (buf - 128, data[0])
+                    if self._pending_acks.pop(key, None) is not None:
+                        self._stats['acks_received'] += 1
+                return
+            if buf == 1:
+                self._pong_received(data)
+                return
+            if buf == 13:
+                self._stream_ack_received(data)
+                return
+            if type == DataType.DATA_WITH_ACK:
+                ack = struct.pack('<B', seq)
+                abuf = buf + 128
+                frame = struct.pack('<BBBI', DataType.ACK, abuf,
+                                    self._next_seq(abuf), len(ack) + 7) + ack
+                self._send_datagram(frame)
+                self._stats['acks_sent'] += 1
+                # Retried data, already processed
+                if self._recv_seq.get(buf) == seq:
+                    return
+                self._recv_seq[buf] = seq
+        if buf in self._cmd_buffers:
+            self._command_received(data)
+
+    def _pong_received(self, data):
+        # Called with the lock held
+        self._stats['pongs'] += 1
+        try:
+            sec, nsec = struct.unpack('<qq', data)
+        except struct.error:
+            return
+        self._stats['last_rtt'] = time.monotonic() - (sec + nsec / 1e9)
+
+    def _command_received(self, data):
+        try:
+            dico, ok = Bybop_Commands.unpack_command(data)
+        except Bybop_Commands.CommandError:
+            return
+        if not ok:
+            return
+        with self._lock:
+            self._stats['commands_received'] += 1
+        handler = self._handlers.get(dico['name'])
+        if handler is not None:
+            handler(self, dico)
+
+
+def _send_all_settings(sim, dico):
+    for name, args in sim._settings:
+        sim.send_command(name, *args)
+    sim.send_command('common.SettingsState.AllSettingsChanged')
+
+
+def _send_all_states(sim, dico):
+    for name, args in sim._states:
+        sim.send_command(name, *args)
+    sim.send_command('common.CommonState.AllStatesChanged')
+
+
+def synthetic_frame(index, size=4000, gop=30):
+    """
+    Get the NAL units of a synthetic H.264 frame (the slices data is random,
+    it is only meant to test the transport).
+
+    The first frame of each group of pictures is a keyframe, preceded by the
+    SPS and PPS.
+
+    Arguments:
+    - index : The frame index
+
+    Keyword arguments:
+    - size : The slice size, in bytes (default 4000)
+    - gop : The group of pictures length (default 30)
+    """
+    rnd = random.Random(index)
+    body = bytes(rnd.getrandbits(8) for _ in range(size - 1))
+    if index % gop == 0:
+        return [b'\x67\x42\xc0\x1f\xa6\x11', b'\x68\xce\x38\x80',
+                b'\x65' + body]
+    return [b'\x41' + body]
+
+
+class RtpSender(object):
+    """
+    Stand-in for the device side of an ARStream2 video stream.
+
+    The frames are packetized as H.264 RTP payloads (single NAL units, STAP-A
+    aggregation of the small NAL units, FU-A fragmentation of the large ones)
+    and sent to the controller, with the impairments applied. RTCP sender
+    reports can be sent, and the receiver reports of the controller are
+    saved.
+
+    The sender uses two threads (a scheduler for the impaired packets, and
+    the RTCP reader).
+    """
+
+    def __init__(self, ip='127.0.0.1', stream_port=55004,
+                 control_port=55005, max_packet_size=1500, impairment=None,
+                 ssrc=0x42594250, bind_ip=None):
+        """
+        Create and start a new RTP sender.
+
+        Keyword arguments:
+        - ip : The controller address (default '127.0.0.1')
+        - stream_port : The controller RTP port (default 55004)
+        - control_port : The controller RTCP port (default 55005)
+        - max_packet_size : The maximum RTP packet size (default 1500)
+        - impairment : An Impairment for the RTP packets (default None, no
+                       impairment)
+        - ssrc : The stream synchronization source
+        - bind_ip : The local address of the sender sockets (default None,
+                    the controller address)
+        """
+        self._stream_addr = (ip, int(stream_port))
+        self._control_addr = (ip, int(control_port))
+        self._max_payload = max_packet_size - 12
+        self._impairment = impairment
+        self._ssrc = ssrc
+        self._seq = 0
+        self._packets = 0
+        self._octets = 0
+        self._last_ts = 0
+        self._reports = []
+
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._heap = []
+        self._counter = itertools.count()
+        self._alive = True
+
+        if bind_ip is None:
+            bind_ip = ip
+        self._rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._rtp.bind((bind_ip, 0))
+        self._rtcp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._rtcp.bind((bind_ip, 0))
+        self._rtcp.settimeout(0.5)
+
+        self._threads = [threading.Thread(target=self._scheduler_loop),
+                         threading.Thread(target=self._rtcp_loop)]
+        for th in self._threads:
+            th.daemon = True
+            th.start()
+
+    def stop(self):
+        """ Stop the sender """
+        with self._lock:
+            self._alive = False
+            self._cond.notify_all()
+        for th in self._threads:
+            th.join()
+        self._rtp.close()
+        self._rtcp.close()
+
+    def get_stream_port(self):
+        """
+        Get the RTP port of the sender ('arstream2_server_stream_port')
+        """
+        return self._rtp.getsockname()[1]
+
+    def get_control_port(self):
+        """
+        Get the RTCP port of the sender ('arstream2_server_control_port')
+        """
+        return self._rtcp.getsockname()[1]
+
+    def get_reports(self):
+        """
+        Get the receiver reports received, as a list of dictionnaries with
+        the fraction_lost, lost, highest_seq, jitter, lsr and dlsr keys (RFC
+        3550 report block fields).
+        """
+        with self._lock:
+            return list(self._reports)
+
+    def send_frame(self, nalus, timestamp):
+        """
+        Send a frame.
+
+        Return the number of RTP packets of the frame.
+
+        Arguments:
+        - nalus : List of NAL units, without start codes
+        - timestamp : The RTP timestamp (90kHz clock)
+        """
+        payloads = []
+        stap = []
+        stap_size = 1
+        for nalu in nalus:
+            if len(nalu) + 2 + stap_size <= self._max_payload:
+                stap.append(nalu)
+                stap_size += len(nalu) + 2
+                continue
+            payloads.extend(self._flush_stap(stap))
+            stap, stap_size = [], 1
+            if len(nalu) <= self._max_payload:
+                stap, stap_size = [nalu], len(nalu) + 3
+                continue
+            # FU-A fragments
+            indicator = bytes(((nalu[0] & 0xe0) | 28,))
+            data = nalu[1:]
+            chunk = self._max_payload - 2
+            for idx in range(0, len(data), chunk):
+                fu_header = nalu[0] & 0x1f
+                if idx == 0:
+                    fu_header |= 0x80
+                if idx + chunk >= len(data):
+                    fu_header |= 0x40
+                payloads.append(indicator + bytes((fu_header,)) +
+                                data[idx:idx + chunk])
+        payloads.extend(self._flush_stap(stap))
+
+        with self._lock:
+            for idx, payload in enumerate(payloads):
+                marker = 0x80 if idx == len(payloads) - 1 else 0
+                packet = struct.pack('>BBHII', 0x80, marker | 96, self._seq,
+                                     timestamp & 0xffffffff,
+                                     self._ssrc) + payload
+                self._seq = (self._seq + 1) & 0xffff
+                self._packets += 1
+                self._octets += len(payload)
+                self._send_packet(packet)
+            self._last_ts = timestamp
+        return len(payloads)
+
+    def send_sender_report(self):
+        """ Send an RTCP sender report to the controller """
+        now = time.time()
+        # NTP time, from 1900
+        ntp = now + 2208988800
+        msw = int(ntp)
+        lsw = int((ntp - msw) * (1 << 32)) & 0xffffffff
+        with self._lock:
+            report = struct.pack('>BBHIIIIII', 0x80, 200, 6, self._ssrc, msw,
+                                 lsw, self._last_ts & 0xffffffff,
+                                 self._packets, self._octets)
+        try:
+            self._rtcp.sendto(report, self._control_addr)
+        except (socket.error, OSError):
+            pass
+
+    @staticmethod
+    def _flush_stap(stap):
+        if not stap:
+            return []
+        if len(stap) == 1:
+            return [stap[0]]
+        nri = max(n[0] & 0x60 for n in stap)
+        return [bytes((nri | 24,)) + b''.join(
+            struct.pack('>H', len(n)) + n for n in stap)]
+
+    def _send_packet(self, packet):
+        # Called with the lock held
+        now = time.monotonic()
+        due = now
+        if self._impairment is not None:
+            due = self._impairment.schedule(now)
+            if due is None:
+                return
+        if due <= now:
+            self._sendto(packet)
+        else:
+            heapq.heappush(self._heap, (due, next(self._counter), packet))
+            self._cond.notify()
+
+    def _sendto(self, packet):
+        try:
+            self._rtp.sendto(packet, self._stream_addr)
+        except (socket.error, OSError):
+            pass
+
+    def _scheduler_loop(self):
+        with self._lock:
+            while self._alive:
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    _, _, packet = heapq.heappop(self._heap)
+                    self._sendto(packet)
+                    continue
+                timeout = self._heap[0][0] - now if self._heap else None
+                self._cond.wait(timeout)
+
+    def _rtcp_loop(self):
+        while self._alive:
+            try:
+                data = self._rtcp.recv(2048)
+            except socket.timeout:
+                continue
+            except (socket.error, OSError):
+                break
+            if len(data) < 32 or data[1] != 201:
+                continue
+            (_, _, _, _, _, lost, highest, jitter, lsr,
+             dlsr) = struct.unpack_from('>BBHIIIIIII', data)
+            cumulative = lost & 0xffffff
+            if cumulative & 0x800000:
+                cumulative -= 0x1000000
+            with self._lock:
+                self._reports.append({
+                    'fraction_lost': (lost >> 24) / 256.0,
+                    'lost': cumulative,
+                    'highest_seq': highest,
+                    'jitter': jitter,
+                    'lsr': lsr,
+                    'dlsr': dlsr,
+                })
+
+
+def start_fleet(count, **kwargs):
+    """
+    Start many simulated devices.
+
+    Return the list of SimulatedDevice. Each simulator has its own ports, and
+    is named 'bybop-sim-<index>' unless a name is given.
+
+    Arguments:
+    - count : Number of simulators
+
+    Keyword arguments are given to each SimulatedDevice constructor.
+    """
+    name = kwargs.pop('name', 'bybop-sim')
+    return [SimulatedDevice(name='%s-%d' % (name, i), **kwargs)
+            for i in range(count)]
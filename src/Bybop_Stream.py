@@ -0,0 +1,724 @@
+import random
+import socket
+import struct
+import threading
+import time
+
+import Bybop_Metrics
+import Bybop_NetworkAL
+
+# RTP fixed header : flags, marker/payload type, sequence number, timestamp,
+# ssrc
+_rtp_header = struct.Struct('>BBHII')
+# RTCP header : flags/count, packet type, length (in 32 bits words - 1)
+_rtcp_header = struct.Struct('>BBH')
+# Sender report : sender ssrc, NTP timestamp (msw, lsw)
+_rtcp_sr = struct.Struct('>III')
+# Receiver report with one report block
+_rtcp_rr = struct.Struct('>BBHIIIIIII')
+
+RTCP_SR = 200
+RTCP_RR = 201
+
+# H.264 RTP payload (RFC 6184) NAL unit types
+_STAP_A = 24
+_FU_A = 28
+
+_START_CODE = b'\0\0\0\1'
+
+
+class Frame(object):
+    """
+    An H.264 access unit, received by a StreamReceiver.
+
+    The NAL units are memoryviews on the receiver packets buffers (except
+    for the fragmented NAL units, which are reassembled), so they are only
+    valid during the frame_received call : the buffers are reused for the
+    next packets once the listener returns. Use to_annexb() (or bytes()) to
+    keep a copy.
+    """
+
+    def __init__(self, timestamp, nalus, complete, received):
+        """
+        Create a new frame.
+
+        Arguments:
+        - timestamp : The RTP timestamp of the frame (90kHz clock)
+        - nalus : List of the NAL units (without start codes)
+        - complete : Whether all the packets of the frame were received
+        - received : Reception time (time.time()) of the first packet
+        """
+        self.timestamp = timestamp
+        self.nalus = nalus
+        self.complete = complete
+        self.received = received
+
+    def is_keyframe(self):
+        """ Whether the frame contains an IDR slice """
+        return any(len(n) and n[0] & 0x1f == 5 for n in self.nalus)
+
+    def to_annexb(self):
+        """ Get a copy of the frame, in H.264 Annex B (byte stream) format """
+        return b''.join(_START_CODE + bytes(n) for n in self.nalus)
+
+
+class _Packet(object):
+    __slots__ = ('slot', 'offset', 'end', 'timestamp', 'marker', 'arrival')
+
+    def __init__(self, slot, offset, end, timestamp, marker, arrival):
+        self.slot = slot
+        self.offset = offset
+        self.end = end
+        self.timestamp = timestamp
+        self.marker = marker
+        self.arrival = arrival
+
+
+class StreamReceiver(object):
+    """
+    ARStream2 video receiver (H.264 over RTP/RTCP).
+
+    The RTP packets are read in a preallocated ring of buffers, and reordered
+    in a jitter buffer : a missing packet is waited for at most 'latency'
+    seconds before being considered as lost. The packets are then
+    depacketized (single NAL units, STAP-A and FU-A) into access units, which
+    are given to a listener. This listener must implement a
+    'frame_received' function, which will receive a Frame as argument.
+
+    RTCP receiver reports are sent periodically to the device, which uses
+    them to adapt its bitrate.
+
+    This implementation uses two threads, one for the RTP packets (the
+    listener is called from this thread) and one for RTCP.
+    """
+
+    def __init__(self, listener, stream_port=55004, control_port=55005,
+                 ip=None, server_control_port=None, latency=0.05,
+                 ring_size=512, packet_size=1500, report_period=1.0,
+                 clock_rate=90000):
+        """
+        Create and start a new stream receiver.
+
+        The ports must be the ones given to Connection.connect (see the
+        stream_port and control_port arguments).
+
+        Arguments:
+        - listener : A listener which will have its frame_received function
+                     called for each received frame
+
+        Keyword arguments:
+        - stream_port : The local RTP port (default 55004)
+        - control_port : The local RTCP port (default 55005)
+        - ip : The device address, for the RTCP reports (default None, the
+               address of the received sender reports is used)
+        - server_control_port : The device RTCP port (the
+                                'arstream2_server_control_port' value of the
+                                connection answer, default None, the port of
+                                the received sender reports is used)
+        - latency : Maximum time, in floating point seconds, a missing packet
+                    is waited for (default 0.05)
+        - ring_size : Number of packets buffers (default 512). It bounds the
+                      number of packets in the jitter buffer and in the
+                      frame being received.
+        - packet_size : Size of each packets buffer, which must be at least
+                        the 'arstream2_max_packet_size' value of the
+                        connection answer (default 1500)
+        - report_period : Period, in floating point seconds, of the RTCP
+                          receiver reports (default 1.0)
+        - clock_rate : The RTP timestamps clock rate (default 90000)
+        """
+        self._listener = listener
+        self._latency = latency
+        self._report_period = report_period
+        self._clock_rate = clock_rate
+        self._ssrc = random.getrandbits(32)
+        self._control_addr = None
+        if ip is not None and server_control_port is not None:
+            self._control_addr = (ip, int(server_control_port))
+
+        self._ring = [bytearray(packet_size) for _ in range(ring_size)]
+        self._views = [memoryview(b) for b in self._ring]
+        self._free = list(range(ring_size))
+        self._scratch = bytearray(packet_size)
+
+        # Jitter buffer, by extended sequence number
+        self._pending = {}
+        self._next = None
+        self._max_ext = None
+
+        # Access unit being received
+        self._au_ts = None
+        self._au_first = 0.0
+        self._au_slots = []
+        self._au_nalus = []
+        self._au_damaged = False
+        self._fu = None
+        # Timestamp of the access unit delivered early for lack of buffers
+        self._truncated_ts = None
+
+        self._lock = threading.Lock()
+        self._source = None
+        self._base_ext = None
+        self._received = 0
+        self._transit = None
+        self._jitter = 0.0
+        self._expected_prior = 0
+        self._received_prior = 0
+        self._lsr = 0
+        self._lsr_time = 0.0
+        self._stats = {
+            'packets_received': 0,
+            'packets_late': 0,
+            'packets_duplicate': 0,
+            'packets_invalid': 0,
+            'overruns': 0,
+            'frames': 0,
+            'frames_incomplete': 0,
+            'frame_latency_sum': 0.0,
+            'frame_latency_max': 0.0,
+            'reports_sent': 0,
+        }
+
+        self._rtp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._rtp_sock.bind(('0.0.0.0', int(stream_port)))
+        self._rtp_sock.settimeout(max(latency / 2, 0.001))
+        self._rtcp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._rtcp_sock.bind(('0.0.0.0', int(control_port)))
+        self._rtcp_sock.settimeout(report_period)
+
+        self._alive = True
+        self._threads = [threading.Thread(target=self._rtp_loop),
+                         threading.Thread(target=self._rtcp_loop)]
+        for th in self._threads:
+            th.daemon = True
+            th.start()
+
+    def stop(self):
+        """
+        Stop the receiver.
+
+        Once stopped, a receiver can not be restarted.
+        """
+        self._alive = False
+        for th in self._threads:
+            th.join()
+        self._rtp_sock.close()
+        self._rtcp_sock.close()
+
+    def get_stream_port(self):
+        """ Get the local RTP port """
+        return self._rtp_sock.getsockname()[1]
+
+    def get_control_port(self):
+        """ Get the local RTCP port """
+        return self._rtcp_sock.getsockname()[1]
+
+    def get_stats(self):
+        """
+        Get the reception statistics.
+
+        Return a dictionnary with the following keys:
+        - packets_received : RTP packets received (duplicates excluded)
+        - packets_lost : RTP packets never received (RFC 3550 cumulative
+                         number of packets lost)
+        - packets_late : RTP packets received after being declared lost
+        - packets_duplicate : RTP packets received twice
+        - packets_invalid : Datagrams which are not valid RTP packets
+        - overruns : RTP packets dropped because all the buffers were in use
+                     (including the end of a frame delivered early)
+        - jitter : Interarrival jitter (RFC 3550), in floating point seconds
+        - frames : Frames given to the listener
+        - frames_incomplete : Frames given to the listener with missing
+                              packets
+        - frame_latency_mean/max : Time, in floating point seconds, between
+                                   the reception of the first packet of a
+                                   frame and its delivery to the listener
+        - reports_sent : RTCP receiver reports sent
+        """
+        with self._lock:
+            ret = dict(self._stats)
+            ret['packets_lost'] = self._cumulative_lost()
+            ret['jitter'] = self._jitter / self._clock_rate
+        frames = ret['frames']
+        latency = ret.pop('frame_latency_sum')
+        ret['frame_latency_mean'] = latency / frames if frames else 0.0
+        return ret
+
+    def _cumulative_lost(self):
+        # Called with the lock held
+        if self._base_ext is None:
+            return 0
+        return self._max_ext - self._base_ext + 1 - self._received
+
+    def _rtp_loop(self):
+        while self._alive:
+            slot = self._acquire(time.time())
+            if slot is None:
+                buf = self._scratch
+            else:
+                buf = self._views[slot]
+            try:
+                length = self._rtp_sock.recv_into(buf)
+            except socket.timeout:
+                if slot is not None:
+                    self._free.append(slot)
+                self._release(time.time())
+                continue
+            except (socket.error, OSError):
+                break
+            now = time.time()
+            if slot is None:
+                with self._lock:
+                    self._stats['overruns'] += 1
+                continue
+            if not self._packet_received(slot, length, now):
+                self._free.append(slot)
+            self._release(now)
+
+    def _acquire(self, now):
+        if not self._free:
+            # All the buffers are in use : stop waiting for missing packets
+            self._release(now, force=True)
+        if not self._free and self._au_slots:
+            # The current access unit holds all the buffers : deliver what
+            # was received, and drop the rest of it
+            self._au_damaged = True
+            self._truncated_ts = self._au_ts
+            self._deliver(now)
+        if not self._free:
+            return None
+        return self._free.pop()
+
+    def _packet_received(self, slot, length, now):
+        """ Parse a packet and add it to the jitter buffer """
+        data = self._ring[slot]
+        if length < 12:
+            return self._invalid()
+        flags, mpt, seq, ts, ssrc = _rtp_header.unpack_from(data)
+        if flags >> 6 != 2:
+            return self._invalid()
+        offset = 12 + 4 * (flags & 0x0f)
+        if flags & 0x10:
+            if offset + 4 > length:
+                return self._invalid()
+            offset += 4 + 4 * struct.unpack_from('>H', data, offset + 2)[0]
+        if flags & 0x20:
+            length -= data[length - 1]
+        if offset >= length:
+            return self._invalid()
+
+        with self._lock:
+            if self._source != ssrc:
+                # New stream (or new source), restart from this packet
+                self._reset_source(ssrc, seq)
+            diff = (seq - self._max_ext) & 0xffff
+            if diff < 0x8000:
+                ext = self._max_ext + diff
+            else:
+                ext = self._max_ext - (0x10000 - diff)
+            if ext in self._pending:
+                self._stats['packets_duplicate'] += 1
+                return False
+            if ext < self._next:
+                # Too late (or duplicate of an already depacketized packet)
+                self._stats['packets_late'] += 1
+                return False
+            self._max_ext = max(self._max_ext, ext)
+            self._received += 1
+            self._stats['packets_received'] += 1
+            # Interarrival jitter (RFC 3550 A.8)
+            transit = now * self._clock_rate - ts
+            if self._transit is not None:
+                d = abs(transit - self._transit)
+                self._jitter += (d - self._jitter) / 16.0
+            self._transit = transit
+
+        self._pending[ext] = _Packet(slot, offset, length, ts, mpt & 0x80,
+                                     now)
+        return True
+
+    def _invalid(self):
+        with self._lock:
+            self._stats['packets_invalid'] += 1
+        return False
+
+    def _reset_source(self, ssrc, seq):
+        # Called with the lock held
+        for pkt in self._pending.values():
+            self._free.append(pkt.slot)
+        self._pending.clear()
+        self._source = ssrc
+        self._base_ext = seq
+        self._max_ext = seq
+        self._next = seq
+        self._received = 0
+        self._transit = None
+        self._jitter = 0.0
+        self._expected_prior = 0
+        self._received_prior = 0
+        self._au_damaged = bool(self._au_slots)
+        self._truncated_ts = None
+
+    def _release(self, now, force=False):
+        """
+        Depacketize the packets of the jitter buffer which are in sequence,
+        and skip the missing packets which were waited for too long.
+        """
+        pending = self._pending
+        while pending:
+            pkt = pending.pop(self._next, None)
+            if pkt is not None:
+                self._next += 1
+                self._depacketize(pkt, now)
+                continue
+            oldest = min(pending)
+            if not force and now - pending[oldest].arrival < self._latency:
+                break
+            # Lost packets, the current NAL unit and access unit are broken
+            self._next = oldest
+            self._fu = None
+            self._au_damaged = True
+
+    def _depacketize(self, pkt, now):
+        if pkt.timestamp == self._truncated_ts:
+            # End of an access unit which was already delivered
+            self._free.append(pkt.slot)
+            with self._lock:
+                self._stats['overruns'] += 1
+            return
+        self._truncated_ts = None
+        if self._au_ts is not None and pkt.timestamp != self._au_ts:
+            # No marker on the previous access unit (lost last packet)
+            self._au_damaged = True
+            self._deliver(now)
+        if self._au_ts is None:
+            self._au_ts = pkt.timestamp
+            self._au_first = pkt.arrival
+        self._au_slots.append(pkt.slot)
+
+        payload = self._views[pkt.slot][pkt.offset:pkt.end]
+        nal_type = payload[0] & 0x1f
+        nalus = self._au_nalus
+        if nal_type < _STAP_A:
+            nalus.append(payload)
+        elif nal_type == _STAP_A:
+            idx = 1
+            while idx + 2 <= len(payload):
+                size = (payload[idx] << 8) | payload[idx + 1]
+                idx += 2
+                if size == 0 or idx + size > len(payload):
+                    self._au_damaged = True
+                    break
+                nalus.append(payload[idx:idx + size])
+                idx += size
+        elif nal_type == _FU_A and len(payload) > 2:
+            fu_header = payload[1]
+            if fu_header & 0x80:
+                if self._fu is not None:
+                    self._au_damaged = True
+                self._fu = bytearray(((payload[0] & 0xe0) |
+                                      (fu_header & 0x1f),))
+                self._fu += payload[2:]
+            elif self._fu is not None:
+                self._fu += payload[2:]
+            else:
+                # Missing start fragment
+                self._au_damaged = True
+            if fu_header & 0x40 and self._fu is not None:
+                nalus.append(memoryview(self._fu))
+                self._fu = None
+        else:
+            # STAP-B, MTAP and FU-B are not used by the devices
+            self._au_damaged = True
+
+        if pkt.marker:
+            self._deliver(now)
+
+    def _deliver(self, now):
+        if self._fu is not None:
+            self._fu = None
+            self._au_damaged = True
+        frame = Frame(self._au_ts, self._au_nalus, not self._au_damaged,
+                      self._au_first)
+        latency = now - self._au_first
+        with self._lock:
+            self._stats['frames'] += 1
+            if self._au_damaged:
+                self._stats['frames_incomplete'] += 1
+            self._stats['frame_latency_sum'] += latency
+            if latency > self._stats['frame_latency_max']:
+                self._stats['frame_latency_max'] = latency
+        if Bybop_Metrics.enabled:
+            Bybop_Metrics.observe('stream_frame_latency', int(latency * 1e9))
+        try:
+            self._listener.frame_received(frame)
+        finally:
+            self._free.extend(self._au_slots)
+            self._au_slots = []
+            self._au_nalus = []
+            self._au_ts = None
+            self._au_damaged = False
+
+    def _rtcp_loop(self):
+        next_report = time.time() + self._report_period
+        while self._alive:
+            try:
+                data, addr = self._rtcp_sock.recvfrom(2048)
+            except socket.timeout:
+                data = None
+            except (socket.error, OSError):
+                break
+            now = time.time()
+            if data:
+                self._rtcp_received(data, addr, now)
+            if now >= next_report:
+                next_report = now + self._report_period
+                self._send_report(now)
+
+    def _rtcp_received(self, data, addr, now):
+        # RTCP packets are compound packets
+        idx = 0
+        while idx + 4 <= len(data):
+            flags, pt, length = _rtcp_header.unpack_from(data, idx)
+            size = 4 * (length + 1)
+            if flags >> 6 != 2 or idx + size > len(data):
+                break
+            if pt == RTCP_SR and size >= 4 + _rtcp_sr.size:
+                _, msw, lsw = _rtcp_sr.unpack_from(data, idx + 4)
+                with self._lock:
+                    self._lsr = ((msw & 0xffff) << 16) | (lsw >> 16)
+                    self._lsr_time = now
+                    if self._control_addr is None:
+                        self._control_addr = addr
+            idx += size
+
+    def _send_report(self, now):
+        with self._lock:
+            if self._source is None or self._control_addr is None:
+                return
+            # RFC 3550 A.3
+            expected = self._max_ext - self._base_ext + 1
+            expected_interval = expected - self._expected_prior
+            received_interval = self._received - self._received_prior
+            self._expected_prior = expected
+            self._received_prior = self._received
+            lost_interval = expected_interval - received_interval
+            if expected_interval <= 0 or lost_interval <= 0:
+                fraction = 0
+            else:
+                fraction = (lost_interval << 8) // expected_interval
+            lost = max(-0x800000, min(0x7fffff, self._cumulative_lost()))
+            dlsr = int((now - self._lsr_time) * 65536) if self._lsr else 0
+            report = _rtcp_rr.pack(0x81, RTCP_RR, 7, self._ssrc,
+                                   self._source,
+                                   (fraction << 24) | (lost & 0xffffff),
+                                   self._max_ext & 0xffffffff,
+                                   int(self._jitter) & 0xffffffff,
+                                   self._lsr, dlsr & 0xffffffff)
+            addr = self._control_addr
+        try:
+            self._rtcp_sock.sendto(report, addr)
+        except (socket.error, OSError):
+            return
+        with self._lock:
+            self._stats['reports_sent'] += 1
+
+
+# ARStream (v1) fragment header : frame number, frame flags, fragment number,
+# fragments per frame
+_arstream_header = struct.Struct('<HBBB')
+# ARStream (v1) ack : frame number, fragments bitfield (64-127, 0-63)
+_arstream_ack = struct.Struct('<HQQ')
+
+ARSTREAM_FLUSH_FRAME = 0x01
+
+
+class StreamFrame(object):
+    """
+    A frame (JPEG or H.264, depending on the device) received by an
+    ARStreamReceiver.
+
+    The data is a memoryview on the receiver frame buffer, so it is only
+    valid during the frame_received call. Use bytes(frame.data) to keep a
+    copy.
+    """
+
+    def __init__(self, number, data, keyframe, received):
+        """
+        Create a new frame.
+
+        Arguments:
+        - number : The frame number
+        - data : The frame data
+        - keyframe : Whether the frame is a flush frame (i.e. a keyframe)
+        - received : Reception time (time.time()) of the first fragment
+        """
+        self.number = number
+        self.data = data
+        self.keyframe = keyframe
+        self.received = received
+
+    def is_keyframe(self):
+        """ Whether the frame is a flush frame (i.e. a keyframe) """
+        return self.keyframe
+
+
+class ARStreamReceiver(object):
+    """
+    ARStream (v1) video receiver, used by the Jumping Sumo (and Bebop 1)
+    to send its frames over ARNetworkAL.
+
+    The frames are split in fragments sent on a data buffer of the device.
+    Each fragment is copied at its place in a preallocated frame buffer, and
+    acknowledged by sending the bitfield of the received fragments of the
+    frame, so that the device only retries the missing ones. An incomplete
+    frame is dropped as soon as a fragment of a newer frame is received.
+    Complete frames are given to a listener, which must implement a
+    'frame_received' function receiving a StreamFrame as argument.
+
+    The listener is called from the network thread.
+    """
+
+    def __init__(self, network, listener, data_buffer=125, ack_buffer=13,
+                 fragment_size=1000, max_fragments=128):
+        """
+        Create a new receiver, and add its buffers to the network.
+
+        Arguments:
+        - network : The Network of the device (see Device.get_network)
+        - listener : A listener which will have its frame_received function
+                     called for each complete frame
+
+        Keyword arguments:
+        - data_buffer : The buffer of the fragments (default 125)
+        - ack_buffer : The buffer of the acks (default 13)
+        - fragment_size : The fragments size ('arstream_fragment_size' value
+                          of the connection answer, default 1000)
+        - max_fragments : The maximum number of fragments per frame
+                          ('arstream_fragment_maximum_number' value of the
+                          connection answer, default 128)
+        """
+        self._network = network
+        self._listener = listener
+        self._data_buffer = data_buffer
+        self._ack_buffer = ack_buffer
+        self._fragment_size = fragment_size
+        self._max_fragments = min(max_fragments, 128)
+        self._buffer = bytearray(fragment_size * self._max_fragments)
+        self._view = memoryview(self._buffer)
+
+        self._number = None
+        self._mask = 0
+        self._count = 0
+        self._size = 0
+        self._first = 0.0
+        self._delivered = False
+
+        self._lock = threading.Lock()
+        self._stats = {
+            'fragments_received': 0,
+            'fragments_duplicate': 0,
+            'fragments_invalid': 0,
+            'frames': 0,
+            'frames_dropped': 0,
+            'frame_latency_sum': 0.0,
+            'frame_latency_max': 0.0,
+        }
+        network.add_buffers([ack_buffer], [data_buffer], self)
+
+    def stop(self):
+        """ Remove the receiver buffers from the network """
+        self._network.remove_buffers([self._ack_buffer], [self._data_buffer])
+
+    def get_stats(self):
+        """
+        Get the reception statistics.
+
+        Return a dictionnary with the following keys:
+        - fragments_received : Fragments received (duplicates excluded)
+        - fragments_duplicate : Fragments received twice
+        - fragments_invalid : Fragments with an invalid header
+        - frames : Complete frames given to the listener
+        - frames_dropped : Incomplete frames dropped
+        - completion_rate : Ratio of complete frames
+        - frame_latency_mean/max : Time, in floating point seconds, between
+                                   the reception of the first fragment of a
+                                   frame and its delivery to the listener
+        """
+        with self._lock:
+            ret = dict(self._stats)
+        frames = ret['frames']
+        total = frames + ret['frames_dropped']
+        ret['completion_rate'] = frames / total if total else 1.0
+        latency = ret.pop('frame_latency_sum')
+        ret['frame_latency_mean'] = latency / frames if frames else 0.0
+        return ret
+
+    def data_received(self, buf, data):
+        """
+        Implementation of the Network listener.
+
+        This function should not be called directly by application code !
+        """
+        now = time.time()
+        if len(data) < _arstream_header.size:
+            self._count_stat('fragments_invalid')
+            return
+        number, flags, idx, count = _arstream_header.unpack_from(data)
+        payload = data[_arstream_header.size:]
+        if count == 0 or idx >= count or count > self._max_fragments or \
+                len(payload) > self._fragment_size:
+            self._count_stat('fragments_invalid')
+            return
+
+        if self._number != number:
+            if self._number is not None and \
+                    (number - self._number) & 0xffff >= 0x8000:
+                # Fragment of an older frame
+                self._count_stat('fragments_duplicate')
+                return
+            if self._number is not None and not self._delivered:
+                self._count_stat('frames_dropped')
+            self._number = number
+            self._mask = 0
+            self._count = count
+            self._size = 0
+            self._first = now
+            self._delivered = False
+
+        bit = 1 << idx
+        if self._mask & bit:
+            self._count_stat('fragments_duplicate')
+        else:
+            self._mask |= bit
+            offset = idx * self._fragment_size
+            self._view[offset:offset + len(payload)] = payload
+            if idx == count - 1:
+                self._size = offset + len(payload)
+            self._count_stat('fragments_received')
+        self._send_ack()
+
+        if not self._delivered and self._mask == (1 << self._count) - 1:
+            self._delivered = True
+            latency = now - self._first
+            with self._lock:
+                self._stats['frames'] += 1
+                self._stats['frame_latency_sum'] += latency
+                if latency > self._stats['frame_latency_max']:
+                    self._stats['frame_latency_max'] = latency
+            if Bybop_Metrics.enabled:
+                Bybop_Metrics.observe('stream_frame_latency',
+                                      int(latency * 1e9))
+            self._listener.frame_received(StreamFrame(
+                number, self._view[:self._size],
+                bool(flags & ARSTREAM_FLUSH_FRAME), self._first))
+
+    def _send_ack(self):
+        ack = _arstream_ack.pack(self._number, self._mask >> 64,
+                                 self._mask & 0xffffffffffffffff)
+        self._network.send_data(self._ack_buffer, ack,
+                                Bybop_NetworkAL.DataType.DATA)
+
+    def _count_stat(self, name):
+        with self._lock:
+            self._stats[name] += 1
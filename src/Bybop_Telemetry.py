@@ -0,0 +1,323 @@
+import collections
+import math
+import threading
+import time
+
+# Value of the position/home coordinates when they are unknown
+UNKNOWN_COORDINATE = 500.0
+
+_EARTH_RADIUS = 6371000.0
+
+
+class SlidingWindow(object):
+    """
+    Samples of the last 'duration' seconds, with running aggregates : the
+    mean, and the slope of the least squares line (i.e. the rate of change).
+
+    Adding a sample is O(1) (amortized : each sample is removed once, and
+    the sums are recomputed after about two window lengths of updates).
+    """
+
+    def __init__(self, duration):
+        """
+        Create a new, empty, window.
+
+        Arguments:
+        - duration : The window duration, in floating point seconds
+        """
+        self.duration = duration
+        self._samples = collections.deque()
+        self._origin = None
+        self._n = 0
+        self._st = 0.0
+        self._sv = 0.0
+        self._stt = 0.0
+        self._stv = 0.0
+        self._updates = 0
+
+    def add(self, t, value):
+        """
+        Add a sample, and remove the samples older than the window.
+
+        Arguments:
+        - t : The sample time, in floating point seconds
+        - value : The sample value
+        """
+        if self._origin is None:
+            self._origin = t
+        # Times relative to the first sample, for the precision of the sums
+        rt = t - self._origin
+        self._samples.append((rt, value))
+        self._update(rt, value, 1)
+        limit = rt - self.duration
+        while self._samples[0][0] < limit:
+            old_t, old_v = self._samples.popleft()
+            self._update(old_t, old_v, -1)
+        if self._updates > 2 * len(self._samples) + 16:
+            self._rebase()
+
+    def _rebase(self):
+        # The running sums accumulate rounding errors, and the times grow
+        # with the session : recompute the sums, with the oldest sample as
+        # the time origin
+        shift = self._samples[0][0]
+        self._origin += shift
+        self._samples = collections.deque((t - shift, v)
+                                          for t, v in self._samples)
+        self._n = 0
+        self._st = self._sv = self._stt = self._stv = 0.0
+        for t, v in self._samples:
+            self._update(t, v, 1)
+        self._updates = 0
+
+    def _update(self, t, v, sign):
+        self._updates += 1
+        self._n += sign
+        self._st += sign * t
+        self._sv += sign * v
+        self._stt += sign * t * t
+        self._stv += sign * t * v
+
+    def count(self):
+        """ Get the number of samples in the window """
+        return self._n
+
+    def span(self):
+        """ Get the time between the first and last samples of the window """
+        if not self._samples:
+            return 0.0
+        return self._samples[-1][0] - self._samples[0][0]
+
+    def mean(self):
+        """ Get the mean of the samples, or None if the window is empty """
+        return self._sv / self._n if self._n else None
+
+    def slope(self):
+        """
+        Get the rate of change (per second) of the samples, or None if it
+        can not be computed (less than two samples at different times).
+        """
+        n = self._n
+        den = n * self._stt - self._st * self._st
+        if n < 2 or den <= 1e-9 * max(1.0, n * self._stt):
+            return None
+        return (n * self._stv - self._st * self._sv) / den
+
+
+class DerivedValue(object):
+    """
+    Base class of the derived values.
+
+    A derived value is computed from some input commands (or other derived
+    values), and is published in the state as the 'derived.<class>.<name>'
+    key, so it can be read with get_value and waited for with wait_for.
+
+    Subclasses set the class attributes below, and implement update.
+    """
+
+    # Class and name of the published key
+    cls = None
+    name = None
+    # Names (in 'project.class.command' notation) of the inputs
+    inputs = ()
+
+    def get_key(self):
+        """ Get the published key, in 'project.class.command' notation """
+        return 'derived.%s.%s' % (self.cls, self.name)
+
+    def update(self, name, args, now):
+        """
+        Update the value with a new input.
+
+        Return the arguments dictionnary to publish, or None if the value
+        did not change (or can not be computed yet).
+
+        Arguments:
+        - name : The input name
+        - args : The input arguments dictionnary
+        - now : The reception time (time.monotonic())
+        """
+        raise NotImplementedError()
+
+
+class GroundSpeed(DerivedValue):
+    """
+    Horizontal speed (m/s), and its mean over a window.
+    """
+    cls = 'Flight'
+    name = 'GroundSpeed'
+    inputs = ('ardrone3.PilotingState.SpeedChanged',)
+
+    def __init__(self, window=5.0):
+        self._window = SlidingWindow(window)
+
+    def update(self, name, args, now):
+        speed = math.hypot(args['speedX'], args['speedY'])
+        self._window.add(now, speed)
+        return {'speed': speed, 'mean': self._window.mean()}
+
+
+class ClimbRate(DerivedValue):
+    """
+    Vertical speed (m/s, positive when climbing), from the altitude changes
+    over a window.
+    """
+    cls = 'Flight'
+    name = 'ClimbRate'
+    inputs = ('ardrone3.PilotingState.AltitudeChanged',)
+
+    def __init__(self, window=1.0):
+        self._window = SlidingWindow(window)
+
+    def update(self, name, args, now):
+        self._window.add(now, args['altitude'])
+        rate = self._window.slope()
+        if rate is None:
+            return None
+        return {'rate': rate}
+
+
+class DistanceFromHome(DerivedValue):
+    """
+    Horizontal distance (m) between the drone and its home.
+    """
+    cls = 'Flight'
+    name = 'DistanceFromHome'
+    inputs = ('ardrone3.PilotingState.PositionChanged',
+              'ardrone3.GPSSettingsState.HomeChanged')
+
+    def __init__(self):
+        self._home = None
+        self._position = None
+
+    def update(self, name, args, now):
+        point = (args['latitude'], args['longitude'])
+        if point[0] == UNKNOWN_COORDINATE or \
+                point[1] == UNKNOWN_COORDINATE:
+            point = None
+        if name == self.inputs[1]:
+            self._home = point
+        else:
+            self._position = point
+        if self._home is None or self._position is None:
+            return None
+        return {'distance': haversine(self._home, self._position)}
+
+
+class BatteryDrain(DerivedValue):
+    """
+    Battery drain rate (percent per minute, positive when discharging), from
+    the battery level changes over a window.
+    """
+    cls = 'Battery'
+    name = 'DrainRate'
+    inputs = ('common.CommonState.BatteryStateChanged',)
+
+    def __init__(self, window=120.0):
+        self._window = SlidingWindow(window)
+
+    def update(self, name, args, now):
+        percent = args['percent']
+        self._window.add(now, percent)
+        slope = self._window.slope()
+        if slope is None:
+            return None
+        return {'rate': -slope * 60.0, 'percent': percent}
+
+
+class RemainingFlightTime(DerivedValue):
+    """
+    Estimated remaining flight time (s), at the current drain rate, down to
+    a reserve level.
+    """
+    cls = 'Battery'
+    name = 'RemainingFlightTime'
+    inputs = ('derived.Battery.DrainRate',)
+
+    def __init__(self, reserve=0.0):
+        self._reserve = reserve
+
+    def update(self, name, args, now):
+        rate = args['rate']
+        if rate <= 0:
+            return {'seconds': None}
+        left = max(args['percent'] - self._reserve, 0.0)
+        return {'seconds': left / rate * 60.0}
+
+
+def haversine(a, b):
+    """
+    Get the distance, in meters, between two (latitude, longitude) points.
+    """
+    lat1, lon1 = math.radians(a[0]), math.radians(a[1])
+    lat2, lon2 = math.radians(b[0]), math.radians(b[1])
+    h = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * _EARTH_RADIUS * math.asin(min(1.0, math.sqrt(h)))
+
+
+def default_values():
+    """
+    Get a list of the default derived values (ground speed, climb rate,
+    distance from home, battery drain rate and remaining flight time).
+    """
+    return [GroundSpeed(), ClimbRate(), DistanceFromHome(), BatteryDrain(),
+            RemainingFlightTime()]
+
+
+class DerivedTelemetry(object):
+    """
+    Engine updating derived values on each state update.
+
+    The engine is a state observer : each update of an input is given to the
+    derived values depending on it (a dictionnary lookup per update), and
+    their results are put in the state as normal commands, in the 'derived'
+    project. Derived values can thus depend on other derived values.
+    """
+
+    def __init__(self, state, values=None):
+        """
+        Create a new engine, and start observing the state.
+
+        Arguments:
+        - state : The State (see Device.get_state(copy=False))
+
+        Keyword arguments:
+        - values : List of DerivedValue (default None, see default_values)
+        """
+        self._state = state
+        self._by_input = {}
+        # Reentrant, as the published values notify the engine again
+        self._lock = threading.RLock()
+        for value in (values if values is not None else default_values()):
+            self.add(value)
+        state.add_observer(self._observer)
+
+    def add(self, value):
+        """
+        Add a derived value.
+
+        Arguments:
+        - value : The DerivedValue
+        """
+        with self._lock:
+            for name in value.inputs:
+                self._by_input.setdefault(name, []).append(value)
+
+    def stop(self):
+        """ Stop observing the state """
+        self._state.remove_observer(self._observer)
+
+    def _observer(self, name, args):
+        values = self._by_input.get(name)
+        if not values:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for value in values:
+                try:
+                    result = value.update(name, args, now)
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if result is not None:
+                    self._state.put('derived', value.cls, value.name, result)
@@ -0,0 +1,120 @@
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import Bybop_Connection  # noqa: E402
+
+
+class StandInServer(object):
+    """
+    Local TCP server standing in for a device discovery port : it reads the
+    request, then sends the given chunks, waiting 'delay' seconds before
+    each one.
+    """
+
+    def __init__(self, chunks, delay=0.0, close=True):
+        self.request = None
+        self._chunks = chunks
+        self._delay = delay
+        self._close = close
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(1)
+        self.port = self._sock.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        conn, _ = self._sock.accept()
+        try:
+            self.request = json.loads(conn.recv(4096).decode('utf-8'))
+            for chunk in self._chunks:
+                time.sleep(self._delay)
+                conn.sendall(chunk)
+            if not self._close:
+                time.sleep(2.0)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+            self._sock.close()
+
+    def join(self):
+        self._thread.join()
+
+
+def _connect(server, read_timeout=1.0):
+    connection = Bybop_Connection.Connection('127.0.0.1', server.port)
+    return connection.connect(54321, 'test', 'bybop',
+                              read_timeout=read_timeout)
+
+
+class ConnectionTest(unittest.TestCase):
+
+    def test_answer(self):
+        server = StandInServer([b'{"status": 0, "c2d_port": 54321}\0'])
+        answer = _connect(server)
+        server.join()
+        self.assertEqual(answer, {'status': 0, 'c2d_port': 54321})
+        self.assertEqual(server.request['d2c_port'], 54321)
+        self.assertEqual(server.request['controller_name'], 'bybop')
+
+    def test_split_answer(self):
+        server = StandInServer([b'{"status": ', b'0, "c2d_', b'port": 1}',
+                                b'\0'], delay=0.05)
+        answer = _connect(server)
+        server.join()
+        self.assertEqual(answer, {'status': 0, 'c2d_port': 1})
+
+    def test_no_nul(self):
+        # Complete json, then the device neither ends it nor closes
+        server = StandInServer([b'{"status": 0}'], close=False)
+        start = time.monotonic()
+        answer = _connect(server)
+        self.assertEqual(answer, {'status': 0})
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_no_nul_closed(self):
+        server = StandInServer([b'{"status": ', b'0}'], delay=0.05)
+        answer = _connect(server)
+        server.join()
+        self.assertEqual(answer, {'status': 0})
+
+    def test_timeout(self):
+        server = StandInServer([], close=False)
+        start = time.monotonic()
+        answer = _connect(server, read_timeout=0.3)
+        self.assertIsNone(answer)
+        self.assertLess(time.monotonic() - start, 1.0)
+
+    def test_trickle_timeout(self):
+        # Each byte arrives before the socket timeout, but the whole answer
+        # does not arrive before the read timeout
+        server = StandInServer([b'{'] + [b' '] * 50, delay=0.1)
+        start = time.monotonic()
+        answer = _connect(server, read_timeout=0.5)
+        self.assertIsNone(answer)
+        self.assertLess(time.monotonic() - start, 1.0)
+
+    def test_connect_all(self):
+        servers = [StandInServer([b'{"status": %d}\0' % i], delay=0.2)
+                   for i in range(3)]
+        devices = [('127.0.0.1', s.port, 54321 + i)
+                   for i, s in enumerate(servers)]
+        start = time.monotonic()
+        answers = Bybop_Connection.connect_all(devices, 'test', 'bybop',
+                                               read_timeout=1.0)
+        self.assertEqual(answers, [{'status': i} for i in range(3)])
+        self.assertLess(time.monotonic() - start, 0.55)
+
+
+if __name__ == '__main__':
+    unittest.main()